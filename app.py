@@ -4,14 +4,50 @@ import random
 import math
 import string
 import re
-from flask import Flask, request, jsonify
+import atexit
+import threading
+import itertools
+import heapq
+import hashlib
+import hmac
+import base64
+import json
+import queue
+import socket
+import struct
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+import io
+import gzip
+import cProfile
+import pstats
+import bisect
+import weakref
+from collections import deque
+from urllib.parse import urlsplit
+from flask import Flask, Response, g, redirect, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy import case, event, func, literal, or_, select, text, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError, SQLAlchemyError
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import Pool
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from google.oauth2 import id_token
+from google.auth import exceptions as google_exceptions
+from google.auth import jwt as google_jwt
 from google.auth.transport import requests as google_requests
 
+try:
+    import numpy as np
+except ImportError:  # opzionale: senza numpy il generatore di target resta scalare
+    np = None
+
+try:
+    import brotli
+except ImportError:  # opzionale: senza brotli le risposte si comprimono solo in gzip
+    brotli = None
+
 # ---------------- APP & DB ----------------
 
 app = Flask(__name__)
@@ -35,12 +71,127 @@ LOBBY_MAX_PLAYERS = 20
 LOBBY_TEAM_SIZE = 10
 MATCH_DURATION_SECONDS = 300  # 5 minuti
 TARGET_WIN_CONDITION = 10
+HACK_CAS_RETRIES = 3  # tentativi di compare-and-set sul proprietario di un target conteso
+UNIQUE_ALLOC_RETRIES = 5  # tentativi su collisione del vincolo UNIQUE (username, codici lobby)
+LOBBY_CODE_LENGTH = 6
+LOBBY_CODE_POOL_BATCH = 32  # codici generati e verificati con una sola query
+DEFAULT_TARGET_TEMPLATE = "italia"  # mappa usata dalle lobby senza template scelto
+ACTIVE_SECONDS = 20  # un utente è "attivo" se ha inviato la posizione negli ultimi N secondi
+
+# Posizioni: write-behind in memoria, flush su DB a batch
+POSITION_FLUSH_INTERVAL = float(os.getenv("POSITION_FLUSH_INTERVAL", "5"))  # staleness massima su DB (s)
+POSITION_FLUSH_BATCH = int(os.getenv("POSITION_FLUSH_BATCH", "500"))  # flush anticipato oltre N utenti
+
+# Log degli hack: scrittura a blocchi, aggregati per partita, archiviazione
+HACK_LOG_FLUSH_INTERVAL = float(os.getenv("HACK_LOG_FLUSH_INTERVAL", "2"))  # secondi di buffer in memoria
+HACK_LOG_FLUSH_BATCH = 1000  # flush anticipato oltre N eventi
+HACK_LOG_RETENTION_DAYS = float(os.getenv("HACK_LOG_RETENTION_DAYS", "30"))  # righe grezze tenute su DB
+HACK_LOG_ARCHIVE_DIR = os.getenv("HACK_LOG_ARCHIVE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "hack_archive"))
+HACK_LOG_ARCHIVE_INTERVAL = float(os.getenv("HACK_LOG_ARCHIVE_INTERVAL", "3600"))  # secondi; 0 = disattivato
+HACK_LOG_ARCHIVE_BATCH = 10000  # righe per file .jsonl.gz
+
+# Stato condiviso tra processi (più worker o più nodi dietro lo stesso DB)
+STATE_BACKEND_URL = os.getenv("STATE_BACKEND_URL", "")  # vuoto = in memoria (un solo processo); redis://[:pw@]host:6379/0
+STATE_KEY_PREFIX = os.getenv("STATE_KEY_PREFIX", "geowar")  # prefisso di chiavi e canali
+STATE_POOL_SIZE = int(os.getenv("STATE_POOL_SIZE", "8"))  # connessioni tenute aperte verso il backend
+STATE_SOCKET_TIMEOUT = 2.0  # secondi per comando
+STATE_RECONNECT_DELAY = 1.0  # secondi prima di riaprire la connessione pub/sub caduta
+
+# Proprietà delle lobby: hashing consistente sui nodi del cluster
+CLUSTER_NODES = os.getenv("CLUSTER_NODES", "")  # "a=http://10.0.0.1:5000,b=http://10.0.0.2:5000"; vuoto = nodo singolo
+CLUSTER_NODE_ID = os.getenv("CLUSTER_NODE_ID", "")  # nome di questo processo in CLUSTER_NODES
+CLUSTER_RING_REPLICAS = 64  # nodi virtuali per nodo: distribuzione uniforme delle lobby
+
+# Attori di lobby: stato di gioco in memoria, eventi serializzati per lobby, contatori su DB a delta
+LOBBY_ACTOR_WORKERS = int(os.getenv("LOBBY_ACTOR_WORKERS", "8"))  # thread che servono le mailbox (<= pool DB)
+LOBBY_ACTOR_BATCH = 32  # eventi di una lobby per turno, poi il thread passa alle altre
+LOBBY_ACTOR_TIMEOUT = 10  # secondi di attesa della risposta dell'attore, poi 503
+LOBBY_ACTOR_IDLE = 300  # secondi senza eventi prima di liberare l'attore
+LOBBY_CHECKPOINT_INTERVAL = float(os.getenv("LOBBY_CHECKPOINT_INTERVAL", "5"))  # rilettura periodica dello stato
+LOBBY_RECONCILE_INTERVAL = float(os.getenv("LOBBY_RECONCILE_INTERVAL", "60"))  # ricalcolo completo dei contatori
+LOBBY_VIEW_MAX_AGE = 2 * LOBBY_CHECKPOINT_INTERVAL  # secondi dall'ultima rilettura, poi le letture vanno sul DB
+
+# Formato binario compatto di roster e target (opzionale, scelto dal client con Accept)
+WIRE_MEDIA_TYPE = "application/x-geowar"
+WIRE_VERSION = 1
+WIRE_COORD_SCALE = 1e6  # coordinate in milionesimi di grado (int32, ~11 cm)
+
+# Compressione delle risposte e ritmo di polling consigliato ai client
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))  # sotto soglia la compressione non ripaga
+COMPRESS_GZIP_LEVEL = 5
+COMPRESS_BROTLI_QUALITY = 5
+COMPRESS_CACHE_SIZE = 512  # corpi compressi tenuti in memoria, per (codifica, ETag)
+POLL_INTERVAL_MIN = int(os.getenv("POLL_INTERVAL_MIN", "2"))  # secondi consigliati a carico basso
+POLL_INTERVAL_MAX = int(os.getenv("POLL_INTERVAL_MAX", "15"))  # secondi consigliati a saturazione
+POLL_LOAD_CAPACITY = int(os.getenv("POLL_LOAD_CAPACITY", "16"))  # richieste in corso considerate saturazione
+POLL_LOAD_SMOOTHING = 0.05  # peso di ogni campione nella media mobile del carico
+POLL_SHED_FACTOR = float(os.getenv("POLL_SHED_FACTOR", "2"))  # oltre N volte la capacità i poll ricevono 503; 0 = mai
+
+# Stream SSE di lobby
+LOBBY_STREAM_QUEUE_SIZE = 256  # eventi in coda per client prima di forzare un nuovo snapshot
+LOBBY_STREAM_KEEPALIVE = 15  # secondi tra due commenti keep-alive
+
+# Indice spaziale dei target
+EARTH_RADIUS_M = 6371000
+TARGET_GRID_CELL_DEG = 0.01  # lato cella della griglia (~1.1 km di latitudine)
+TARGET_INDEX_TTL = 60  # secondi: ricostruzione periodica (target creati da altri processi)
+NEARBY_MAX_RADIUS_M = 50000
+NEARBY_DEFAULT_LIMIT = 100
+HACK_MAX_DISTANCE_M = float(os.getenv("HACK_MAX_DISTANCE_M", "50"))  # client: 20 m + margine GPS; 0 = disattivo
+
+# Lista lobby (/lobbies)
+LOBBY_LIST_CACHE_TTL = 2.0  # secondi: limita la staleness verso modifiche fatte da altri processi
+LOBBY_LIST_CACHE_MAX_PAGES = 256
+LOBBY_LIST_MAX_PER_PAGE = 100
+
+# Generazione target casuali
+RANDOM_TARGETS_MAX = 10000  # target per singola richiesta
+RANDOM_TARGETS_MAX_ATTEMPTS = 30  # candidati per target con spaziatura minima (Poisson-disk)
+
+# Profilazione delle richieste (opt-in)
+PROFILE_REQUESTS = os.getenv("PROFILE_REQUESTS", "0") == "1"
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "200"))  # soglia per conservare un profilo cProfile
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0.05"))  # frazione di richieste profilate
+PROFILE_KEEP = 20  # profili lenti conservati in memoria
+
+# Hash delle password: pool dedicato e limitato, separato dai thread delle richieste
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")  # formato werkzeug, costo incluso
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))  # hash in parallelo (core dedicati)
+PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", "16"))  # richieste in attesa oltre i worker, poi 503
+PASSWORD_HASH_TIMEOUT = 10  # secondi
+PASSWORD_HASH_RETRY_AFTER = 2  # secondi suggeriti al client nel 503
+
+# Token di sessione firmati (HMAC)
+AUTH_SECRET = os.getenv("AUTH_SECRET", "")  # condiviso tra i processi; se vuoto, casuale (solo processo singolo)
+AUTH_TOKEN_TTL = int(os.getenv("AUTH_TOKEN_TTL", str(7 * 24 * 3600)))  # secondi
+AUTH_REQUIRE_TOKEN = os.getenv("AUTH_REQUIRE_TOKEN", "0") == "1"  # 0 = accetta ancora lo user_id nudo dei client vecchi
+AUTH_REVOCATION_REFRESH = 10  # secondi tra due riletture degli utenti bannati (ban fatti da altri processi)
+
+# Login Google: verifica locale degli ID token con certificati in cache
+GOOGLE_CLIENT_ID = os.getenv(
+    "GOOGLE_CLIENT_ID",
+    "143510152058-65kf5bucon42l77e7qk1bsgl70qki9so.apps.googleusercontent.com"
+)
+GOOGLE_CERTS_URL = "https://www.googleapis.com/oauth2/v1/certs"  # {kid: certificato x509 PEM}
+GOOGLE_CERTS_FILE = os.getenv("GOOGLE_CERTS_FILE", "")  # stesso formato, da file (test offline)
+GOOGLE_CERTS_DEFAULT_TTL = 3600  # secondi, se la risposta non ha Cache-Control: max-age
+GOOGLE_CERTS_MIN_REFRESH = 30  # secondi tra due download forzati da un kid sconosciuto
+GOOGLE_ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+GOOGLE_CLOCK_SKEW = 10  # secondi di tolleranza su iat/exp
+
+# Metriche Prometheus (/metrics)
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_POOL_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
 
 
 # ---------------- MODELS ----------------
 
 class Lobby(db.Model):
     __tablename__ = "lobby"
+    __table_args__ = (
+        db.Index("ix_lobby_status_private", "status", "is_private"),  # /lobbies
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     status = db.Column(db.String(20), default="WAITING")  # WAITING, ACTIVE, FINISHED
     created_at = db.Column(db.Float, default=time.time)
@@ -48,6 +199,10 @@ class Lobby(db.Model):
     winner_team = db.Column(db.String(10), nullable=True) # RED, BLUE, DRAW
 
     player_count = db.Column(db.Integer, default=0)
+    # giocatori per team (senza team = player_count - players_red - players_blue)
+    players_red = db.Column(db.Integer, default=0)
+    players_blue = db.Column(db.Integer, default=0)
+
     targets_red = db.Column(db.Integer, default=0)
     targets_blue = db.Column(db.Integer, default=0)
 
@@ -55,9 +210,19 @@ class Lobby(db.Model):
     is_private = db.Column(db.Boolean, default=False)
     join_code = db.Column(db.String(10), unique=True, nullable=True)
 
+    # mappa dei target (None = DEFAULT_TARGET_TEMPLATE)
+    template_id = db.Column(db.Integer, db.ForeignKey("target_template.id"), nullable=True)
+
+    # chi ha creato la lobby privata (None = pubblica): può cambiarne la mappa
+    owner_id = db.Column(db.Integer, nullable=True)
+
 
 class User(db.Model):
     __tablename__ = "user"
+    __table_args__ = (
+        db.Index("ix_user_lobby_team", "lobby_id", "team"),  # roster di lobby, conteggi per team
+        db.Index("ix_user_last_active", "last_active"),  # gauge geowar_players_active di /metrics
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False, index=True)
@@ -80,6 +245,9 @@ class User(db.Model):
 
 class Target(db.Model):
     __tablename__ = "target"
+    __table_args__ = (
+        db.Index("ix_target_lobby_owner", "lobby_id", "owner_team"),  # /targets, conteggi per team
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), nullable=False)
@@ -92,50 +260,87 @@ class Target(db.Model):
     lobby_id = db.Column(db.Integer, db.ForeignKey("lobby.id"), nullable=True)
 
 
+class TargetTemplate(db.Model):
+    """Mappa di target riutilizzabile, materializzata nelle lobby all'avvio della partita."""
+    __tablename__ = "target_template"
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), unique=True, nullable=False)
+    created_at = db.Column(db.Float, default=time.time)
+
+
+class TargetTemplatePoint(db.Model):
+    __tablename__ = "target_template_point"
+
+    id = db.Column(db.Integer, primary_key=True)
+    template_id = db.Column(db.Integer, db.ForeignKey("target_template.id"), nullable=False, index=True)
+    name = db.Column(db.String(60), nullable=False)  # + " (Lobby N)" deve stare in Target.name
+    lat = db.Column(db.Float, nullable=False)
+    lon = db.Column(db.Float, nullable=False)
+
+
 class HackLog(db.Model):
     __tablename__ = "hack_log"
+    __table_args__ = (
+        db.Index("ix_hack_log_target_time", "target_id", "timestamp"),  # storico hack di un target
+        db.Index("ix_hack_log_lobby_time", "lobby_id", "timestamp"),  # aggregati di fine partita
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     target_id = db.Column(db.Integer, db.ForeignKey("target.id"), nullable=False)
+    lobby_id = db.Column(db.Integer, nullable=True)  # None = target globale; nessuna FK: le righe sopravvivono alla lobby
 
     team = db.Column(db.String(10), nullable=False)
     timestamp = db.Column(db.Float, default=time.time, nullable=False)
 
 
+class MatchHackStat(db.Model):
+    """
+    Hack di una partita aggregati a fine match: per team, per giocatore, per target.
+    Le colonne non pertinenti allo scope valgono "" / 0 e non NULL: i NULL non collidono in un
+    indice UNIQUE, che invece deve impedire righe doppie da aggregazioni concorrenti.
+    """
+    __tablename__ = "match_hack_stat"
+    __table_args__ = (
+        db.Index("ux_match_hack_stat_key", "lobby_id", "match_start_time", "scope", "team", "user_id", "target_id",
+                 unique=True),
+    )
 
+    id = db.Column(db.Integer, primary_key=True)
+    lobby_id = db.Column(db.Integer, nullable=False)
+    match_start_time = db.Column(db.Float, nullable=False)  # con lobby_id identifica la partita
 
-# ---------------- HELPERS ----------------
-def check_and_finish_match(lobby: Lobby):
-    if lobby.status != "ACTIVE" or not lobby.match_start_time:
-        return False
-
-    elapsed = time.time() - lobby.match_start_time
-    if elapsed < MATCH_DURATION_SECONDS:
-        return False
+    scope = db.Column(db.String(10), nullable=False)  # team / user / target
+    team = db.Column(db.String(10), nullable=False, default="")
+    user_id = db.Column(db.Integer, nullable=False, default=0)
+    target_id = db.Column(db.Integer, nullable=False, default=0)
+    hacks = db.Column(db.Integer, nullable=False, default=0)
 
-    # Fine partita
-    lobby.status = "FINISHED"
 
-    if lobby.targets_red > lobby.targets_blue:
-        lobby.winner_team = "RED"
-    elif lobby.targets_blue > lobby.targets_red:
-        lobby.winner_team = "BLUE"
-    else:
-        lobby.winner_team = "DRAW"
+class SchemaVersion(db.Model):
+    """Migrazioni applicate (vedi MIGRATIONS)."""
+    __tablename__ = "schema_version"
 
-    db.session.commit()
-    return True
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(120), nullable=False)
+    applied_at = db.Column(db.Float, default=time.time, nullable=False)
 
 
+# ---------------- HELPERS ----------------
+def match_deadline(lobby: Lobby):
+    """Istante di fine partita a tempo, None se la lobby non è in partita."""
+    if lobby.status != "ACTIVE" or not lobby.match_start_time:
+        return None
+    return lobby.match_start_time + MATCH_DURATION_SECONDS
 
-def generate_lobby_code(length=6):
-    chars = string.ascii_uppercase + string.digits
-    while True:
-        code = ''.join(random.choice(chars) for _ in range(length))
-        if not Lobby.query.filter_by(join_code=code).first():
-            return code
 
+def match_winner(targets_red: int, targets_blue: int) -> str:
+    if targets_red > targets_blue:
+        return "RED"
+    if targets_blue > targets_red:
+        return "BLUE"
+    return "DRAW"
 
 
 def get_json():
@@ -143,17 +348,27 @@ def get_json():
     return data if isinstance(data, dict) else None
 
 
-def db_commit_or_error():
-    """Ritorna None se ok, altrimenti (response, code)."""
+def db_commit_error_payload():
+    """Come db_commit_or_error, ma l'errore è (dict, code): usabile anche fuori dalle route Flask."""
     try:
         db.session.commit()
         return None
     except IntegrityError as e:
         db.session.rollback()
-        return jsonify({"message": "Errore di integrità database", "detail": str(e)}), 409
+        metrics.inc("geowar_db_commit_failures_total", (("kind", "integrity"),))
+        return {"message": "Errore di integrità database", "detail": str(e)}, 409
     except SQLAlchemyError as e:
         db.session.rollback()
-        return jsonify({"message": "Errore database", "detail": str(e)}), 500
+        metrics.inc("geowar_db_commit_failures_total", (("kind", "database"),))
+        return {"message": "Errore database", "detail": str(e)}, 500
+
+
+def db_commit_or_error():
+    """Ritorna None se ok, altrimenti (response, code)."""
+    err = db_commit_error_payload()
+    if err:
+        return jsonify(err[0]), err[1]
+    return None
 
 
 def lobby_recount_targets(lobby_id: int):
@@ -170,34 +385,193 @@ def lobby_recount_targets(lobby_id: int):
     db.session.commit()
 
 
-def lobby_adjust_target_counters(lobby: Lobby, old_owner: str, new_owner: str):
-    """Aggiorna contatori su cambio ownership del target."""
-    if not lobby:
+def lobby_recount_players(lobby_ids=None):
+    """
+    Riallinea player_count e i contatori di team con un'unica GROUP BY sugli utenti.
+    Safety net per i contatori materializzati; None = tutte le lobby non terminate.
+    """
+    lobby_query = Lobby.query
+    if lobby_ids is None:
+        lobby_query = lobby_query.filter((Lobby.status != "FINISHED") | Lobby.players_red.is_(None))
+    else:
+        lobby_query = lobby_query.filter(Lobby.id.in_(lobby_ids))
+    lobbies = lobby_query.all()
+    if not lobbies:
         return
 
-    if old_owner == new_owner:
-        return
+    counts = {lobby.id: {"RED": 0, "BLUE": 0, None: 0} for lobby in lobbies}
+    rows = (
+        db.session.query(User.lobby_id, User.team, func.count(User.id))
+        .filter(User.lobby_id.in_(list(counts)))
+        .group_by(User.lobby_id, User.team)
+    )
+    for lobby_id, team, n in rows:
+        team_counts = counts[lobby_id]
+        team_counts[team if team in ALLOWED_TEAMS else None] += n
 
-    # decremento vecchio owner
-    if old_owner == "RED":
-        lobby.targets_red = max(0, lobby.targets_red - 1)
-    elif old_owner == "BLUE":
-        lobby.targets_blue = max(0, lobby.targets_blue - 1)
+    for lobby in lobbies:
+        c = counts[lobby.id]
+        lobby.player_count = c["RED"] + c["BLUE"] + c[None]
+        lobby.players_red = c["RED"]
+        lobby.players_blue = c["BLUE"]
+    db.session.commit()
 
-    # incremento nuovo owner
-    if new_owner == "RED":
-        lobby.targets_red += 1
-    elif new_owner == "BLUE":
-        lobby.targets_blue += 1
 
+def lobby_counter_values(lobby_id: int) -> dict:
+    """
+    Contatori materializzati della lobby ricalcolati con subquery sugli utenti e sui target (indici
+    per lobby): una UPDATE con questi valori è esatta anche se più processi hanno toccato la lobby.
+    """
+    def count(model, **filters):
+        conditions = [model.lobby_id == lobby_id]
+        conditions += [getattr(model, name) == value for name, value in filters.items()]
+        return select(func.count(model.id)).where(*conditions).scalar_subquery()
+
+    return {
+        "player_count": count(User),
+        "players_red": count(User, team="RED"),
+        "players_blue": count(User, team="BLUE"),
+        "targets_red": count(Target, owner_team="RED"),
+        "targets_blue": count(Target, owner_team="BLUE"),
+    }
+
+
+def decremented(column):
+    """column - 1 senza scendere sotto zero, valutato dal DB."""
+    return case((column > 0, column - 1), else_=0)
+
+
+def lobby_add_player(lobby_id: int, open_only=True) -> bool:
+    """
+    Incrementa player_count con un UPDATE condizionato: il limite LOBBY_MAX_PLAYERS (e lo stato
+    della lobby) sono nella WHERE, quindi valgono anche con più processi. False se piena o chiusa.
+    """
+    conditions = [Lobby.id == lobby_id, Lobby.player_count < LOBBY_MAX_PLAYERS]
+    if open_only:
+        conditions.append(Lobby.status.in_(("WAITING", "ACTIVE")))
+    return db.session.execute(
+        update(Lobby)
+        .where(*conditions)
+        .values(player_count=Lobby.player_count + 1)
+        .execution_options(synchronize_session=False)
+    ).rowcount == 1
+
+
+def lobby_remove_player(lobby_id: int, team):
+    """Decrementa player_count e il contatore del team di chi esce dalla lobby."""
+    values = {"player_count": decremented(Lobby.player_count)}
+    if team in ALLOWED_TEAMS:
+        column = getattr(Lobby, f"players_{team.lower()}")
+        values[column.key] = decremented(column)
+
+    db.session.execute(
+        update(Lobby)
+        .where(Lobby.id == lobby_id)
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
 
 
-def generate_lobby_targets(lobby_id: int):
-    """Genera 20 target fissi in Italia (5 Roma + 15 luoghi famosi)."""
-    lobby = Lobby.query.get(lobby_id)
-    if not lobby:
+def lobby_change_team(lobby_id: int, old_team, new_team: str) -> bool:
+    """
+    Sposta un giocatore nei contatori di team con un UPDATE condizionato:
+    il limite LOBBY_TEAM_SIZE è nella WHERE, nessun count. False se il team è al completo.
+    """
+    new_column = getattr(Lobby, f"players_{new_team.lower()}")
+    values = {new_column.key: new_column + 1}
+    if old_team in ALLOWED_TEAMS:
+        old_column = getattr(Lobby, f"players_{old_team.lower()}")
+        values[old_column.key] = decremented(old_column)
+
+    return db.session.execute(
+        update(Lobby)
+        .where(Lobby.id == lobby_id, new_column < LOBBY_TEAM_SIZE)
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    ).rowcount == 1
+
+
+def lobby_adjust_target_counters(lobby_id: int, old_owner: str, new_owner: str):
+    """Sposta un target tra i contatori dei team con incrementi in SQL (nessuna lettura in Python)."""
+    values = {}
+    for team in ALLOWED_TEAMS:
+        column = getattr(Lobby, f"targets_{team.lower()}")
+        if team == new_owner:
+            values[column.key] = column + 1
+        elif team == old_owner:
+            values[column.key] = decremented(column)
+    if not values:
         return
 
+    db.session.execute(
+        update(Lobby)
+        .where(Lobby.id == lobby_id)
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def lobby_user_payload(u: User, now: float, position=None) -> dict:
+    lat, lon, last_active = position or position_store.current(u)
+    is_active = (now - last_active) < ACTIVE_SECONDS
+
+    # Se l'utente non ha mai inviato una posizione valida,
+    # restituiamo None così il frontend può ignorare il marker
+    return {
+        "id": u.id,
+        "username": u.username,
+        "team": u.team,
+        "avatar_seed": u.avatar_seed,
+        "is_active": is_active,
+        "lat": lat if lat != 0.0 else None,
+        "lon": lon if lon != 0.0 else None
+    }
+
+
+def lobby_user_payloads(users, now: float) -> list:
+    """lobby_user_payload di più utenti con una sola lettura delle posizioni dal backend."""
+    positions = position_store.current_many(users)
+    return [lobby_user_payload(u, now, positions[u.id]) for u in users]
+
+
+def distance_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Distanza haversine in metri."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def target_payload(t: Target) -> dict:
+    return {"id": t.id, "name": t.name, "lat": t.lat, "lon": t.lon, "owner": t.owner_team, "lobby_id": t.lobby_id}
+
+
+def lobby_status_payload(lobby: Lobby) -> dict:
+    status = lobby.status
+    winner_team = lobby.winner_team
+    time_left = -1
+
+    deadline = match_deadline(lobby)
+    if deadline:
+        time_left = deadline - time.time()
+        if time_left <= 0:
+            # scaduta ma non ancora chiusa dallo scheduler: esito proiettato, in sola lettura
+            status = "FINISHED"
+            winner_team = match_winner(lobby.targets_red, lobby.targets_blue)
+            time_left = -1
+
+    return {
+        "status": status,
+        "winner_team": winner_team,
+        "time_left": time_left,
+        "targets_red": lobby.targets_red,
+        "targets_blue": lobby.targets_blue
+    }
+
+
+def default_template_points():
+    """I 20 target storici in Italia (5 Roma + 15 luoghi famosi): seed del template di default."""
     targets = []
 
     # =========================
@@ -249,33 +623,3019 @@ def generate_lobby_targets(lobby_id: int):
             lon
         ))
 
-    # =========================
-    # CREAZIONE TARGET DB
-    # =========================
-    for i, (name, lat, lon) in enumerate(targets, start=1):
-        target = Target(
-            name=f"{name} (Lobby {lobby_id})",
-            lat=lat,
-            lon=lon,
-            owner_team="NEUTRAL",
-            lobby_id=lobby_id,
+    return targets
+
+
+def create_target_template(name: str, points):
+    """Crea un template con i suoi punti (INSERT multi-riga). Nessun commit."""
+    template = TargetTemplate(name=name)
+    db.session.add(template)
+    db.session.flush()  # ottieni template.id
+
+    db.session.execute(TargetTemplatePoint.__table__.insert(), [
+        {"template_id": template.id, "name": p_name, "lat": lat, "lon": lon}
+        for p_name, lat, lon in points
+    ])
+    return template
+
+
+def parse_template_points(raw_points):
+    """Lista di (name, lat, lon) validata, oppure None se il formato non è valido."""
+    if not isinstance(raw_points, list) or not raw_points:
+        return None
+
+    points = []
+    for p in raw_points:
+        if not isinstance(p, dict):
+            return None
+        name = (p.get("name") or "").strip()
+        try:
+            lat = float(p.get("lat"))
+            lon = float(p.get("lon"))
+        except (ValueError, TypeError):
+            return None
+        if not name or len(name) > 60 or not -90 <= lat <= 90 or not -180 <= lon <= 180:
+            return None
+        points.append((name, lat, lon))
+    return points
+
+
+def resolve_template_id(lobby: Lobby):
+    if lobby.template_id:
+        return lobby.template_id
+    return db.session.query(TargetTemplate.id).filter_by(name=DEFAULT_TARGET_TEMPLATE).scalar()
+
+
+def generate_lobby_targets(lobby: Lobby):
+    """
+    Materializza il template della lobby nei suoi target con un unico INSERT ... SELECT
+    (costo costante lato Python, qualunque sia la dimensione della mappa). Nessun commit:
+    va nella stessa transazione dell'avvio partita.
+    """
+    template_id = resolve_template_id(lobby)
+    point = TargetTemplatePoint.__table__
+
+    rows = select(
+        point.c.name + f" (Lobby {lobby.id})",
+        point.c.lat,
+        point.c.lon,
+        literal("NEUTRAL"),
+        literal(0.0),
+        literal(lobby.id),
+    ).where(point.c.template_id == template_id)
+
+    db.session.execute(
+        Target.__table__.insert().from_select(
+            ["name", "lat", "lon", "owner_team", "last_hacked", "lobby_id"], rows
         )
-        db.session.add(target)
+    )
 
     # reset contatori
     lobby.targets_red = 0
     lobby.targets_blue = 0
 
-    err = db_commit_or_error()
-    return err
 
+# ---------------- UNIQUE VALUES ----------------
+# Username e codici lobby: un candidato libero con al più una query, poi il vincolo UNIQUE del DB
+# decide le collisioni concorrenti e si riprova con un nuovo valore.
+
+def add_with_unique_value(make_row, next_value, retries=UNIQUE_ALLOC_RETRIES):
+    """
+    Aggiunge make_row(valore) e fa flush; su IntegrityError (valore preso nel frattempo) rollback
+    e nuovo tentativo con next_value(). Da chiamare senza altre modifiche pendenti nella sessione.
+    Ritorna la riga, o None se i tentativi finiscono.
+    """
+    for _ in range(retries):
+        row = make_row(next_value())
+        db.session.add(row)
+        try:
+            db.session.flush()
+            return row
+        except IntegrityError:
+            db.session.rollback()
+    return None
+
+
+def free_username(base: str, tried=()) -> str:
+    """
+    Primo tra base, base_1, base_2, ... non usato: una sola query sul prefisso (range sull'indice).
+    Confronto senza maiuscole/minuscole come la collation del DB; `tried` (già in casefold) sono i
+    candidati respinti dal vincolo UNIQUE nei tentativi precedenti, da saltare.
+    """
+    base = base[:User.username.type.length - 8]  # spazio per il suffisso
+    escaped = base.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    taken = {
+        username.casefold() for (username,) in db.session.query(User.username).filter(
+            or_(User.username == base, User.username.like(escaped + "\\_%", escape="\\"))
+        )
+    }
+    taken.update(tried)
+
+    if base.casefold() not in taken:
+        return base
+    counter = 1
+    while f"{base}_{counter}".casefold() in taken:
+        counter += 1
+    return f"{base}_{counter}"
+
+
+class LobbyCodePool:
+    """Codici di lobby privata pre-generati a blocchi: ogni blocco è verificato con una sola query IN."""
+
+    def __init__(self, length=LOBBY_CODE_LENGTH, batch_size=LOBBY_CODE_POOL_BATCH):
+        self.length = length
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._codes = []
+
+    def take(self) -> str:
+        while True:
+            with self._lock:
+                if self._codes:
+                    return self._codes.pop()
+            # query fuori dal lock: gli altri thread non aspettano il round trip (più refill insieme vanno bene)
+            fresh = self._generate()
+            with self._lock:
+                self._codes.extend(fresh)
+
+    def _generate(self):
+        chars = string.ascii_uppercase + string.digits
+        candidates = {"".join(random.choices(chars, k=self.length)) for _ in range(self.batch_size)}
+        taken = {code for (code,) in db.session.query(Lobby.join_code).filter(Lobby.join_code.in_(candidates))}
+        return list(candidates - taken)
+
+
+lobby_code_pool = LobbyCodePool()
+
+
+# ---------------- SHARED STATE ----------------
+# Con più processi lo stato "in memoria" (posizioni, roster, eventi, contatori) deve essere condiviso:
+# il backend in memoria vale per un solo processo, quello Redis (protocollo RESP, nessuna dipendenza)
+# per più worker e nodi. publish() raggiunge solo gli *altri* processi: la consegna locale resta diretta.
+
+class StateBackendError(Exception):
+    pass
+
+
+class MemoryStateBackend:
+    """Stato del solo processo corrente: il comportamento storico, senza fan-out."""
+
+    shared = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._positions = {}  # user_id -> (lat, lon, ts)
+        self._counters = {}
+
+    def set_position(self, user_id: int, lat: float, lon: float, ts: float):
+        with self._lock:
+            self._positions[user_id] = (lat, lon, ts)
+
+    def seed_position(self, user_id: int, lat: float, lon: float, ts: float):
+        with self._lock:
+            cached = self._positions.get(user_id)
+            if not cached or cached[2] < ts:
+                self._positions[user_id] = (lat, lon, ts)
+
+    def seed_positions(self, positions):
+        for uid, (lat, lon, ts) in positions.items():
+            self.seed_position(uid, lat, lon, ts)
+
+    def get_positions(self, user_ids):
+        """{user_id: (lat, lon, ts)} per gli utenti con una posizione nota."""
+        with self._lock:
+            return {uid: self._positions[uid] for uid in user_ids if uid in self._positions}
+
+    def incr(self, name: str, amount=1) -> int:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+            return self._counters[name]
+
+    def counter(self, name: str) -> int:
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def publish(self, channel: str, message):
+        pass
+
+    def listen(self, channel: str, callback):
+        pass
+
+    def on_resync(self, callback):
+        pass
+
+    def ensure_listening(self):
+        pass
+
+
+class RespConnection:
+    """Connessione minima in protocollo Redis (RESP2): comandi e lettura delle risposte."""
+
+    def __init__(self, host: str, port: int, password=None, db_index=0, timeout=STATE_SOCKET_TIMEOUT):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.broken = False  # dopo un errore di I/O lo stream non è più allineato: mai più nel pool
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile("rb")
+        if password:
+            self.command("AUTH", password)
+        if db_index:
+            self.command("SELECT", db_index)
+
+    @staticmethod
+    def encode(args) -> bytes:
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(parts)
+
+    def send(self, *args):
+        self.sock.sendall(self.encode(args))
+
+    def read_reply(self):
+        line = self.reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Connessione al backend di stato chiusa")
+
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise StateBackendError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            size = int(rest)
+            return None if size < 0 else self.reader.read(size + 2)[:-2]
+        if kind == b"*":
+            size = int(rest)
+            return None if size < 0 else [self.read_reply() for _ in range(size)]
+        self.broken = True
+        raise StateBackendError(f"Risposta RESP non valida: {line!r}")
+
+    def command(self, *args):
+        self.send(*args)
+        return self.read_reply()
+
+    def pipeline(self, commands):
+        """Più comandi con un solo round trip; un errore del server si solleva dopo tutte le risposte."""
+        self.sock.sendall(b"".join(self.encode(args) for args in commands))
+        replies, error = [], None
+        for _ in commands:
+            try:
+                replies.append(self.read_reply())
+            except StateBackendError as e:
+                error = error or e
+                replies.append(None)
+        if error:
+            raise error
+        return replies
+
+    def close(self):
+        # il reader tiene un riferimento al socket: va chiuso anche lui
+        self.broken = True
+        for stream in (self.reader, self.sock):
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+
+class RedisStateBackend:
+    """
+    Stato condiviso su un server che parla il protocollo Redis.
+    Posizioni in un hash, contatori con INCRBY, fan-out con PUBLISH/SUBSCRIBE su una
+    connessione dedicata servita da un thread. Il pub/sub non ha garanzie di consegna:
+    se la connessione cade, alla riconnessione si chiamano le callback di on_resync().
+    Se il server non risponde le letture e le scritture ripiegano su una copia locale (valori del
+    solo processo, poi il DB), per STATE_RECONNECT_DELAY secondi senza ritentare.
+    """
+
+    shared = True
+
+    def __init__(self, url: str, prefix=STATE_KEY_PREFIX, pool_size=STATE_POOL_SIZE):
+        parts = urlsplit(url)
+        if parts.scheme != "redis":
+            raise ValueError(f"STATE_BACKEND_URL non supportato: {url}")
+        self._address = (parts.hostname or "127.0.0.1", parts.port or 6379)
+        self._password = parts.password
+        self._db_index = int(parts.path.strip("/") or 0)
+
+        self.prefix = prefix
+        self.origin = os.urandom(6).hex()  # i messaggi pubblicati da questo processo tornano indietro: si scartano
+        self._pool = queue.LifoQueue(pool_size)
+
+        self._listeners = {}  # canale completo -> [callback]
+        self._resync = []
+        self._listen_lock = threading.Lock()
+        self._thread = None
+
+        self._local = MemoryStateBackend()  # posizioni e contatori di questo processo, per i guasti
+        self._retry_at = 0.0  # fino a questo istante il server è considerato giù
+
+    def _connect(self, timeout=STATE_SOCKET_TIMEOUT):
+        return RespConnection(*self._address, password=self._password, db_index=self._db_index, timeout=timeout)
+
+    def _call(self, *args, pipeline=None):
+        """Un comando, oppure la lista di comandi `pipeline` in un solo round trip."""
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+
+        try:
+            reply = conn.pipeline(pipeline) if pipeline is not None else conn.command(*args)
+        except OSError:
+            conn.close()
+            raise
+        finally:
+            if not conn.broken:
+                # anche dopo una risposta di errore la connessione resta allineata: torna nel pool
+                try:
+                    self._pool.put_nowait(conn)
+                except queue.Full:
+                    conn.close()
+        return reply
+
+    def _call_or(self, op: str, fallback, *args, pipeline=None):
+        """_call che non propaga gli errori: con il server giù ritorna fallback() e conta il guasto."""
+        if time.time() < self._retry_at:
+            return fallback()
+        try:
+            reply = self._call(*args, pipeline=pipeline)
+        except (OSError, StateBackendError) as e:
+            metrics.inc("geowar_state_backend_failures_total", (("op", op),))
+            if not self._retry_at:
+                app.logger.warning("Backend di stato non disponibile, valori locali: %s", e)
+            self._retry_at = time.time() + STATE_RECONNECT_DELAY
+            return fallback()
+        if self._retry_at:
+            self._retry_at = 0.0
+            app.logger.warning("Backend di stato di nuovo disponibile")
+        return reply
+
+    def _key(self, name: str) -> str:
+        return f"{self.prefix}:{name}"
+
+    def set_position(self, user_id: int, lat: float, lon: float, ts: float):
+        self._local.set_position(user_id, lat, lon, ts)
+        self._call_or("set_position", lambda: None, "HSET", self._key("pos"), user_id, f"{lat!r},{lon!r},{ts!r}")
+
+    def seed_positions(self, positions):
+        """{user_id: (lat, lon, ts)} letti da DB, scritti solo dove il backend non ha già un valore."""
+        if not positions:
+            return
+        for uid, (lat, lon, ts) in positions.items():
+            self._local.seed_position(uid, lat, lon, ts)
+        # il valore in Redis è sempre più recente di quello su DB (che arriva dal flush)
+        key = self._key("pos")
+        self._call_or("seed_positions", lambda: None, pipeline=[
+            ("HSETNX", key, uid, f"{lat!r},{lon!r},{ts!r}") for uid, (lat, lon, ts) in positions.items()
+        ])
+
+    def get_positions(self, user_ids):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        values = self._call_or("get_positions", lambda: None, "HMGET", self._key("pos"), *user_ids)
+        if values is None:
+            return self._local.get_positions(user_ids)
+        positions = {}
+        for uid, raw in zip(user_ids, values):
+            if raw is not None:
+                lat, lon, ts = raw.split(b",")
+                positions[uid] = (float(lat), float(lon), float(ts))
+        return positions
+
+    def incr(self, name: str, amount=1) -> int:
+        local = self._local.incr(name, amount)
+        return self._call_or("incr", lambda: local, "INCRBY", self._key(name), amount)
+
+    def counter(self, name: str) -> int:
+        return int(self._call_or("counter", lambda: self._local.counter(name), "GET", self._key(name)) or 0)
+
+    def publish(self, channel: str, message):
+        payload = json.dumps({"o": self.origin, "d": message}, separators=(",", ":"))
+        # fan-out best effort: i client degli altri processi si riallineano con lo snapshot.
+        # Con il server giù non si attende il timeout a ogni publish (stesso _retry_at delle altre operazioni).
+        if self._call_or("publish", lambda: False, "PUBLISH", self._key(channel), payload) is False:
+            metrics.inc("geowar_state_publish_failures_total")
+
+    def listen(self, channel: str, callback):
+        """Registra una callback(message) per i messaggi degli altri processi (prima di ensure_listening)."""
+        self._listeners.setdefault(self._key(channel), []).append(callback)
+
+    def on_resync(self, callback):
+        self._resync.append(callback)
+
+    def ensure_listening(self):
+        if self._thread is not None or not self._listeners:
+            return
+        with self._listen_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="state-subscriber", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        connected_before = False
+        while True:
+            conn = None
+            try:
+                conn = self._connect(timeout=None)
+                conn.send("SUBSCRIBE", *self._listeners)
+                for _ in self._listeners:
+                    conn.read_reply()  # una conferma per canale
+
+                # messaggi persi durante la disconnessione: lo stato locale va riallineato
+                if connected_before:
+                    for callback in self._resync:
+                        callback()
+                connected_before = True
+
+                while True:
+                    reply = conn.read_reply()
+                    if not isinstance(reply, list) or reply[0] != b"message":
+                        continue
+                    self._dispatch(reply[1].decode(), reply[2])
+            except (OSError, StateBackendError) as e:
+                app.logger.warning("Connessione pub/sub al backend di stato persa: %s", e)
+            finally:
+                if conn:
+                    conn.close()
+            time.sleep(STATE_RECONNECT_DELAY)
+
+    def _dispatch(self, channel: str, raw: bytes):
+        try:
+            envelope = json.loads(raw)
+        except ValueError:
+            return
+        if envelope.get("o") == self.origin:
+            return
+        for callback in self._listeners.get(channel, ()):
+            try:
+                callback(envelope.get("d"))
+            except Exception:
+                app.logger.exception("Messaggio di stato non gestito (%s)", channel)
+
+
+def make_state_backend(url=STATE_BACKEND_URL):
+    return RedisStateBackend(url) if url else MemoryStateBackend()
+
+
+state_backend = make_state_backend()
+
+
+@app.before_request
+def _state_listen():
+    state_backend.ensure_listening()
+
+
+class HashRing:
+    """
+    Hashing consistente delle lobby sui nodi: ogni lobby ha un solo proprietario, che ne serializza
+    le scritture calde. Aggiungere o togliere un nodo sposta solo ~1/N delle lobby.
+    """
+
+    def __init__(self, nodes, replicas=CLUSTER_RING_REPLICAS):
+        self.nodes = dict(nodes)
+        points = []
+        for node in self.nodes:
+            for i in range(replicas):
+                points.append((self._hash(f"{node}#{i}"), node))
+        points.sort()
+        self._points = [p for p, _ in points]
+        self._owners = [n for _, n in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def owner(self, lobby_id: int):
+        if not self._points:
+            return None
+        i = bisect.bisect(self._points, self._hash(f"lobby:{lobby_id}")) % len(self._points)
+        return self._owners[i]
+
+
+def parse_cluster_nodes(raw: str) -> dict:
+    nodes = {}
+    for item in raw.split(","):
+        if item.strip():
+            name, _, url = item.strip().partition("=")
+            nodes[name.strip()] = url.strip().rstrip("/")
+    return nodes
+
+
+cluster_ring = HashRing(parse_cluster_nodes(CLUSTER_NODES))
+if len(cluster_ring.nodes) > 1 and CLUSTER_NODE_ID not in cluster_ring.nodes:
+    app.logger.warning("CLUSTER_NODE_ID %r non è in CLUSTER_NODES: nessuna lobby sarà servita qui", CLUSTER_NODE_ID)
+
+
+def lobby_owner_redirect(lobby_id):
+    """
+    307 verso il nodo proprietario della lobby (il client ripete la stessa richiesta, corpo incluso),
+    oppure None se la lobby è di questo nodo o il cluster ha un solo nodo.
+    Instradare è un'ottimizzazione: le scritture restano corrette su qualunque nodo (UPDATE
+    condizionate sul DB, con la partita ancora in corso nella stessa istruzione dell'hack); le letture
+    dallo stato degli attori hanno al più LOBBY_VIEW_MAX_AGE secondi.
+    """
+    if lobby_id is None or len(cluster_ring.nodes) < 2:
+        return None
+    owner = cluster_ring.owner(lobby_id)
+    if owner == CLUSTER_NODE_ID:
+        return None
+
+    response = redirect(cluster_ring.nodes[owner] + request.full_path.rstrip("?"), code=307)
+    response.headers["X-Lobby-Owner"] = owner
+    return response
+
+
+# ---------------- POSITION STORE ----------------
+
+class PositionStore:
+    """
+    Ultima posizione nota di ogni utente, tenuta nel backend di stato (write-behind).
+    Le route leggono da qui; il DB viene aggiornato a batch da un thread di flush
+    ogni `flush_interval` secondi (staleness massima) o prima se i "dirty" superano `batch_size`.
+    Ogni processo scrive su DB le posizioni ricevute da lui.
+    """
+
+    def __init__(self, flush_interval=POSITION_FLUSH_INTERVAL, batch_size=POSITION_FLUSH_BATCH):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+        self._lock = threading.Lock()
+        self._dirty = {}  # user_id -> (lat, lon, last_active) da scrivere su DB
+
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def update(self, user_id: int, lat: float, lon: float, ts: float):
+        state_backend.set_position(user_id, lat, lon, ts)
+        with self._lock:
+            self._dirty[user_id] = (lat, lon, ts)
+            batch_full = len(self._dirty) >= self.batch_size
+
+        self._ensure_thread()
+        if batch_full:
+            self._wakeup.set()
+
+    def current(self, user: User):
+        """(lat, lon, last_active) più recenti tra backend e DB."""
+        return self.current_many((user,))[user.id]
+
+    def current_many(self, users) -> dict:
+        """{user_id: (lat, lon, last_active)} con una sola lettura dal backend."""
+        cached = state_backend.get_positions([u.id for u in users])
+        positions = {}
+        for u in users:
+            position = cached.get(u.id)
+            if not position or position[2] < (u.last_active or 0.0):
+                position = (u.lat, u.lon, u.last_active)
+            positions[u.id] = position
+        return positions
+
+    def seed_many(self, users):
+        """Registra le posizioni lette da DB dove lo store non ne ha una più recente (senza dirty)."""
+        state_backend.seed_positions({u.id: (u.lat, u.lon, u.last_active or 0.0) for u in users})
+
+    def last_active_many(self, user_ids) -> dict:
+        """{user_id: last_active} con una sola lettura dal backend (0.0 se sconosciuto)."""
+        positions = state_backend.get_positions(user_ids)
+        return {uid: positions[uid][2] if uid in positions else 0.0 for uid in user_ids}
+
+    def flush(self) -> int:
+        """Scrive su DB le posizioni sporche con un unico UPDATE batch. Ritorna il numero di righe."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return 0
+                pending, self._dirty = self._dirty, {}
+                batch = [
+                    {"id": uid, "lat": lat, "lon": lon, "last_active": ts}
+                    for uid, (lat, lon, ts) in pending.items()
+                ]
+
+            try:
+                db.session.bulk_update_mappings(User, batch)
+                db.session.commit()
+            except SQLAlchemyError as e:
+                db.session.rollback()
+                metrics.inc("geowar_db_commit_failures_total", (("kind", "position_flush"),))
+                # rimetti in coda, senza sovrascrivere posizioni arrivate nel frattempo
+                with self._lock:
+                    for uid, position in pending.items():
+                        self._dirty.setdefault(uid, position)
+                app.logger.warning("Flush posizioni fallito (%d utenti): %s", len(batch), e)
+                return 0
+
+            return len(batch)
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._flush_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="position-flush", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            with app.app_context():
+                self.flush()
+
+
+position_store = PositionStore()
+
+
+@atexit.register
+def _flush_positions_on_exit():
+    with app.app_context():
+        position_store.flush()
+
+
+# ---------------- HACK LOG ----------------
+
+def aggregate_match_hacks(lobby_id: int, match_start_time: float, persist=True):
+    """
+    Aggrega gli hack di una partita con una GROUP BY sul log grezzo (indice lobby_id, timestamp).
+    Con persist le righe di MatchHackStat vengono (ri)scritte: idempotente, e l'indice UNIQUE
+    scarta la scrittura perdente di due aggregazioni concorrenti (stesse righe).
+    """
+    rows = (
+        db.session.query(HackLog.user_id, HackLog.team, HackLog.target_id, func.count(HackLog.id))
+        .filter(HackLog.lobby_id == lobby_id, HackLog.timestamp >= match_start_time)
+        .group_by(HackLog.user_id, HackLog.team, HackLog.target_id)
+        .all()
+    )
+
+    per_team, per_user, per_target = {}, {}, {}
+    for user_id, team, target_id, n in rows:
+        per_team[team] = per_team.get(team, 0) + n
+        per_user[(user_id, team)] = per_user.get((user_id, team), 0) + n
+        per_target[target_id] = per_target.get(target_id, 0) + n
+
+    stats = [{"scope": "team", "team": team, "hacks": n} for team, n in per_team.items()]
+    stats += [{"scope": "user", "user_id": uid, "team": team, "hacks": n} for (uid, team), n in per_user.items()]
+    stats += [{"scope": "target", "target_id": tid, "hacks": n} for tid, n in per_target.items()]
+
+    if persist:
+        MatchHackStat.query.filter_by(lobby_id=lobby_id, match_start_time=match_start_time).delete()
+        if stats:
+            db.session.execute(MatchHackStat.__table__.insert(), [
+                {"lobby_id": lobby_id, "match_start_time": match_start_time, "team": "",
+                 "user_id": 0, "target_id": 0, **row}
+                for row in stats
+            ])
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()  # la stessa partita è stata aggregata e scritta nel frattempo
+    return stats
+
+
+def match_hack_stats(lobby: Lobby):
+    """Statistiche di fine partita: dagli aggregati; se mancano (processo riavviato) si calcolano ora."""
+    rows = MatchHackStat.query.filter_by(lobby_id=lobby.id, match_start_time=lobby.match_start_time).all()
+    if rows:
+        stats = [
+            {"scope": r.scope, "team": r.team or None, "user_id": r.user_id or None,
+             "target_id": r.target_id or None, "hacks": r.hacks}
+            for r in rows
+        ]
+    else:
+        # si salva solo quando i buffer di tutti i processi sono sicuramente su DB
+        # (una vittoria ai target chiude prima: per prudenza si attende comunque la scadenza)
+        deadline = (lobby.match_start_time or 0.0) + MATCH_DURATION_SECONDS
+        ended = lobby.status == "FINISHED" and time.time() > deadline + 2 * HACK_LOG_FLUSH_INTERVAL
+        stats = aggregate_match_hacks(lobby.id, lobby.match_start_time, persist=ended)
+
+    return {
+        "teams": {s["team"]: s["hacks"] for s in stats if s["scope"] == "team"},
+        "players": sorted(
+            ({"user_id": s["user_id"], "team": s["team"], "hacks": s["hacks"]} for s in stats if s["scope"] == "user"),
+            key=lambda p: -p["hacks"],
+        ),
+        "targets": sorted(
+            ({"target_id": s["target_id"], "hacks": s["hacks"]} for s in stats if s["scope"] == "target"),
+            key=lambda t: -t["hacks"],
+        ),
+    }
+
+
+def archive_hack_log(cutoff: float) -> int:
+    """
+    Sposta le righe di hack_log più vecchie di `cutoff` in file .jsonl.gz (HACK_LOG_ARCHIVE_DIR),
+    a blocchi di HACK_LOG_ARCHIVE_BATCH. Il file è scritto prima della DELETE; il nome deriva
+    dagli id, quindi un blocco archiviato due volte produce lo stesso file.
+    """
+    os.makedirs(HACK_LOG_ARCHIVE_DIR, exist_ok=True)
+    log = HackLog.__table__
+    archived = 0
+
+    while True:
+        rows = db.session.execute(
+            select(log.c.id, log.c.user_id, log.c.target_id, log.c.lobby_id, log.c.team, log.c.timestamp)
+            .where(log.c.timestamp < cutoff)
+            .order_by(log.c.id)
+            .limit(HACK_LOG_ARCHIVE_BATCH)
+        ).all()
+        if not rows:
+            return archived
+
+        first_id, last_id = rows[0].id, rows[-1].id
+        path = os.path.join(HACK_LOG_ARCHIVE_DIR, f"hack_log_{first_id:012d}_{last_id:012d}.jsonl.gz")
+        with gzip.open(path + ".tmp", "wt", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row._asdict(), separators=(",", ":")) + "\n")
+        os.replace(path + ".tmp", path)
+
+        db.session.execute(
+            log.delete().where(log.c.id.between(first_id, last_id), log.c.timestamp < cutoff)
+        )
+        db.session.commit()
+        archived += len(rows)
+
+
+class HackLogBuffer:
+    """
+    Eventi di hack in memoria, scritti su DB con un INSERT multi-riga ogni `flush_interval` secondi
+    (o prima, oltre `batch_size` eventi). Lo stesso thread aggrega le partite finite e archivia il log.
+    """
+
+    def __init__(self, flush_interval=HACK_LOG_FLUSH_INTERVAL, batch_size=HACK_LOG_FLUSH_BATCH):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+        self._lock = threading.Lock()
+        self._events = []
+        self._finished_matches = []  # heap (scadenza, lobby_id, match_start_time)
+
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._last_archive = 0.0
+
+    def append(self, user_id: int, target_id: int, lobby_id, team: str, ts: float):
+        with self._lock:
+            self._events.append({"user_id": user_id, "target_id": target_id, "lobby_id": lobby_id,
+                                 "team": team, "timestamp": ts})
+            batch_full = len(self._events) >= self.batch_size
+
+        self._ensure_thread()
+        if batch_full:
+            self._wakeup.set()
+
+    def finish_match(self, lobby_id: int, match_start_time: float):
+        """Aggrega la partita appena i buffer di tutti i processi sono stati scritti (due flush)."""
+        with self._lock:
+            heapq.heappush(self._finished_matches, (time.time() + 2 * self.flush_interval, lobby_id, match_start_time))
+        self._ensure_thread()
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                batch, self._events = self._events, []
+            if not batch:
+                return 0
+
+            try:
+                db.session.execute(HackLog.__table__.insert(), batch)
+                db.session.commit()
+            except OperationalError as e:
+                # errore transitorio (connessione, lock): il batch torna in testa e si riprova al prossimo giro
+                db.session.rollback()
+                metrics.inc("geowar_db_commit_failures_total", (("kind", "hack_log_flush"),))
+                self._requeue(batch)
+                app.logger.warning("Flush hack log fallito (%d eventi): %s", len(batch), e)
+                return 0
+            except SQLAlchemyError as e:
+                # una riga non valida (es. target cancellato nel frattempo) fallirebbe a ogni tentativo
+                db.session.rollback()
+                app.logger.warning("Flush hack log rifiutato (%d eventi), riprovo riga per riga: %s", len(batch), e)
+                return self._flush_rows(batch)
+            return len(batch)
+
+    def _flush_rows(self, batch) -> int:
+        written = 0
+        for i, event in enumerate(batch):
+            try:
+                db.session.execute(HackLog.__table__.insert(), [event])
+                db.session.commit()
+            except OperationalError as e:
+                db.session.rollback()
+                metrics.inc("geowar_db_commit_failures_total", (("kind", "hack_log_flush"),))
+                self._requeue(batch[i:])
+                app.logger.warning("Flush hack log fallito (%d eventi): %s", len(batch) - i, e)
+                break
+            except SQLAlchemyError as e:
+                db.session.rollback()
+                metrics.inc("geowar_hack_log_dropped_total")
+                app.logger.error("Evento di hack scartato %s: %s", event, e)
+            else:
+                written += 1
+        return written
+
+    def _requeue(self, batch):
+        with self._lock:
+            self._events[:0] = batch
+
+    def _due_matches(self):
+        now = time.time()
+        due = []
+        with self._lock:
+            while self._finished_matches and self._finished_matches[0][0] <= now:
+                _, lobby_id, match_start_time = heapq.heappop(self._finished_matches)
+                due.append((lobby_id, match_start_time))
+        return due
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._flush_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="hack-log", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            with app.app_context():
+                self.flush()
+
+                for lobby_id, match_start_time in self._due_matches():
+                    try:
+                        aggregate_match_hacks(lobby_id, match_start_time)
+                    except SQLAlchemyError as e:
+                        db.session.rollback()
+                        app.logger.warning("Aggregati partita lobby %s falliti: %s", lobby_id, e)
+
+                if HACK_LOG_ARCHIVE_INTERVAL > 0 and time.time() - self._last_archive >= HACK_LOG_ARCHIVE_INTERVAL:
+                    self._last_archive = time.time()
+                    try:
+                        archive_hack_log(time.time() - HACK_LOG_RETENTION_DAYS * 86400)
+                    except (SQLAlchemyError, OSError) as e:
+                        db.session.rollback()
+                        app.logger.warning("Archiviazione hack log fallita: %s", e)
+
+
+hack_log_buffer = HackLogBuffer()
+
+
+@atexit.register
+def _flush_hack_log_on_exit():
+    with app.app_context():
+        hack_log_buffer.flush()
+
+
+# ---------------- ROSTER CURSORS ----------------
+
+class LobbyRosterTracker:
+    """
+    Versiona i cambiamenti del roster di ogni lobby (posizione, team, profilo, ingresso/uscita)
+    per rispondere a /lobby/<id>/users?since=<cursor> con i soli utenti cambiati.
+    Il cursore è "<epoch>-<versione>-<timestamp ms>": l'epoch cambia a ogni riavvio del processo,
+    così un cursore di un altro processo (o troppo vecchio) fa ripartire dallo snapshot completo.
+    I cambiamenti sono replicati agli altri processi dal backend di stato.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Dimentica tutto (replica persa): nuovo epoch, i client ripartono dallo snapshot completo."""
+        with self._lock:
+            self._epoch = os.urandom(4).hex()
+            self._version = 0
+
+            self._changed = {}  # lobby_id -> {user_id: versione ultimo cambiamento}
+            self._profile = {}  # lobby_id -> {user_id: versione ultimo cambio dei campi statici}
+            self._removed = {}  # lobby_id -> {user_id: versione uscita}
+            self._floor = {}    # lobby_id -> versione sotto la quale i removed sono stati potati
+            self._member = {}   # user_id -> lobby_id (None = nessuna lobby)
+
+    def knows(self, user_id: int) -> bool:
+        with self._lock:
+            return user_id in self._member
+
+    def lobby_of(self, user_id: int):
+        with self._lock:
+            return self._member.get(user_id)
+
+    def track(self, user_id: int, lobby_id):
+        """Registra la lobby corrente di un utente senza generare un cambiamento."""
+        with self._lock:
+            self._set_member(user_id, lobby_id)
+            if lobby_id is not None:
+                self._changed.setdefault(lobby_id, {}).setdefault(user_id, 0)
+
+    def touch(self, lobby_id, user_id: int, profile=False):
+        """Cambiamento di un utente; profile=True se cambiano anche i campi statici (ingresso, profilo)."""
+        if lobby_id is None:
+            self.track(user_id, None)
+            return
+        self._touch(lobby_id, user_id, profile)
+        state_backend.publish("roster", ["touch", lobby_id, user_id, profile])
+
+    def remove(self, lobby_id, user_id: int):
+        self._remove(lobby_id, user_id)
+        state_backend.publish("roster", ["remove", lobby_id, user_id, False])
+
+    def drop_lobby(self, lobby_id):
+        self._drop_lobby(lobby_id)
+        state_backend.publish("roster", ["drop", lobby_id, None, False])
+
+    def apply_remote(self, message):
+        action, lobby_id, user_id, profile = message
+        if action == "touch":
+            self._touch(lobby_id, user_id, profile)
+        elif action == "remove":
+            self._remove(lobby_id, user_id)
+        elif action == "drop":
+            self._drop_lobby(lobby_id)
+
+    def _touch(self, lobby_id, user_id: int, profile=False):
+        with self._lock:
+            self._version += 1
+            self._set_member(user_id, lobby_id)
+            self._changed.setdefault(lobby_id, {})[user_id] = self._version
+            if profile:
+                self._profile.setdefault(lobby_id, {})[user_id] = self._version
+            self._removed.get(lobby_id, {}).pop(user_id, None)
+
+    def _remove(self, lobby_id, user_id: int):
+        with self._lock:
+            self._member[user_id] = None
+            if lobby_id is None:
+                return
+            self._version += 1
+            self._changed.get(lobby_id, {}).pop(user_id, None)
+            self._profile.get(lobby_id, {}).pop(user_id, None)
+            removed = self._removed.setdefault(lobby_id, {})
+            removed[user_id] = self._version
+
+            if len(removed) > LOBBY_MAX_PLAYERS * 10:
+                oldest = min(removed, key=removed.get)
+                self._floor[lobby_id] = removed.pop(oldest)
+
+    def _drop_lobby(self, lobby_id):
+        with self._lock:
+            for user_id in self._changed.pop(lobby_id, {}):
+                self._member[user_id] = None
+            self._profile.pop(lobby_id, None)
+            self._removed.pop(lobby_id, None)
+            self._floor.pop(lobby_id, None)
+
+    def cursor(self) -> str:
+        with self._lock:
+            return self._make_cursor()
+
+    def changes_since(self, lobby_id: int, cursor: str):
+        """
+        (changed_ids, removed_ids, members, since_ts, new_cursor, profile_ids),
+        oppure None se il cursore non è utilizzabile (serve lo snapshot completo).
+        profile_ids: utenti i cui campi statici il client non ha ancora (entrati o profilo cambiato).
+        """
+        try:
+            epoch, version, since_ms = cursor.split("-")
+            version, since_ms = int(version), int(since_ms)
+        except (AttributeError, ValueError):
+            return None
+
+        with self._lock:
+            if epoch != self._epoch or version > self._version or version < self._floor.get(lobby_id, 0):
+                return None
+
+            changed = self._changed.get(lobby_id, {})
+            changed_ids = [uid for uid, v in changed.items() if v > version]
+            removed_ids = [uid for uid, v in self._removed.get(lobby_id, {}).items() if v > version]
+            profile_ids = {uid for uid, v in self._profile.get(lobby_id, {}).items() if v > version}
+            return changed_ids, removed_ids, list(changed), since_ms / 1000.0, self._make_cursor(), profile_ids
+
+    def _set_member(self, user_id: int, lobby_id):
+        previous = self._member.get(user_id)
+        if previous is not None and previous != lobby_id:
+            self._changed.get(previous, {}).pop(user_id, None)
+            self._profile.get(previous, {}).pop(user_id, None)
+        self._member[user_id] = lobby_id
+
+    def _make_cursor(self) -> str:
+        return f"{self._epoch}-{self._version}-{int(time.time() * 1000)}"
+
+
+roster_tracker = LobbyRosterTracker()
+state_backend.listen("roster", roster_tracker.apply_remote)
+state_backend.on_resync(roster_tracker.reset)
+
+
+# ---------------- TARGET SPATIAL INDEX ----------------
+
+class TargetGridIndex:
+    """
+    Griglia lat/lon in memoria sui target, separata per scope (lobby_id, None = target globali).
+    Ogni scope si costruisce al primo uso con una query sulle sole colonne (id, lat, lon),
+    si invalida quando i target cambiano e scade dopo `ttl` secondi.
+    """
+
+    def __init__(self, cell_deg=TARGET_GRID_CELL_DEG, ttl=TARGET_INDEX_TTL):
+        self.cell_deg = cell_deg
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._scopes = {}  # lobby_id -> (built_at, {cell: [(id, lat, lon)]}, n_targets)
+
+    def invalidate(self, lobby_id=None):
+        with self._lock:
+            self._scopes.pop(lobby_id, None)
+
+    def _cell(self, lat: float, lon: float):
+        return int(math.floor(lat / self.cell_deg)), int(math.floor(lon / self.cell_deg))
+
+    def _scope(self, lobby_id):
+        with self._lock:
+            scope = self._scopes.get(lobby_id)
+        if scope and time.time() - scope[0] < self.ttl:
+            return scope
+
+        rows = db.session.query(Target.id, Target.lat, Target.lon).filter(Target.lobby_id == lobby_id).all()
+        cells = {}
+        for tid, lat, lon in rows:
+            cells.setdefault(self._cell(lat, lon), []).append((tid, lat, lon))
+
+        scope = (time.time(), cells, len(rows))
+        with self._lock:
+            self._scopes[lobby_id] = scope
+        return scope
+
+    def nearby(self, lobby_id, lat: float, lon: float, radius_m: float, limit=None):
+        """[(target_id, distanza_m)] entro radius_m, ordinati per distanza."""
+        _, cells, n_targets = self._scope(lobby_id)
+
+        dlat = math.degrees(radius_m / EARTH_RADIUS_M)
+        coslat = max(math.cos(math.radians(lat)), 1e-6)
+        dlon = min(180.0, math.degrees(radius_m / (EARTH_RADIUS_M * coslat)))
+
+        lat_lo, lon_lo = self._cell(lat - dlat, lon - dlon)
+        lat_hi, lon_hi = self._cell(lat + dlat, lon + dlon)
+
+        # raggio enorme rispetto alla griglia: conviene scorrere le celle esistenti
+        if (lat_hi - lat_lo + 1) * (lon_hi - lon_lo + 1) > len(cells):
+            candidates = (p for bucket in cells.values() for p in bucket)
+        else:
+            candidates = (
+                p
+                for i in range(lat_lo, lat_hi + 1)
+                for j in range(lon_lo, lon_hi + 1)
+                for p in cells.get((i, j), ())
+            )
+
+        found = []
+        for tid, tlat, tlon in candidates:
+            d = distance_m(lat, lon, tlat, tlon)
+            if d <= radius_m:
+                found.append((tid, d))
+
+        found.sort(key=lambda item: item[1])
+        return found[:limit] if limit else found
+
+
+target_index = TargetGridIndex()
+
+
+# ---------------- LOBBY LIST CACHE ----------------
+
+class LobbyListCache:
+    """
+    Snapshot versionati di /lobbies, uno per combinazione di filtri e pagina, già serializzati
+    con il loro ETag. Ogni mutazione di una lobby chiama invalidate(), che incrementa anche il
+    contatore condiviso: le modifiche fatte da altri processi invalidano la cache alla lettura
+    successiva. Il TTL resta come limite alla staleness.
+    """
+
+    def __init__(self, ttl=LOBBY_LIST_CACHE_TTL, max_pages=LOBBY_LIST_CACHE_MAX_PAGES):
+        self.ttl = ttl
+        self.max_pages = max_pages
+        self._lock = threading.Lock()
+        self._version = 0
+        self._pages = {}  # key -> (version, built_at, body, etag, total)
+
+    def invalidate(self):
+        state_backend.incr("lobby_list_version")
+        with self._lock:
+            self._version += 1
+            self._pages.clear()
+
+    def get(self, key, build):
+        """(body, etag, total) per la chiave; `build()` -> (body, total) solo se manca o è scaduta."""
+        now = time.time()
+        shared_version = state_backend.counter("lobby_list_version")
+        with self._lock:
+            version = self._version
+            entry = self._pages.get(key)
+        if entry and entry[0] == (version, shared_version) and now - entry[1] < self.ttl:
+            return entry[2], entry[3], entry[4]
+
+        body, total = build()
+        etag = hashlib.sha1(body).hexdigest()[:20]
+        version = (version, shared_version)
+
+        with self._lock:
+            # se nel frattempo qualcuno ha invalidato, il risultato non va in cache
+            if self._version == version[0]:
+                if len(self._pages) >= self.max_pages:
+                    self._pages.clear()
+                self._pages[key] = (version, now, body, etag, total)
+        return body, etag, total
+
+
+lobby_list_cache = LobbyListCache()
+
+
+# ---------------- MATCH SCHEDULER ----------------
+
+class MatchScheduler:
+    """
+    Heap di scadenze (match_start_time + MATCH_DURATION_SECONDS) servito da un thread:
+    chiude ogni partita all'istante giusto, anche se nessuno fa poll della lobby.
+    Le scadenze cancellate o riprogrammate restano nell'heap e vengono scartate all'estrazione.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap = []  # (deadline, lobby_id)
+        self._deadlines = {}  # lobby_id -> deadline valida
+        self._thread = None
+
+    def schedule(self, lobby_id: int, deadline: float):
+        with self._cond:
+            if self._deadlines.get(lobby_id) == deadline:
+                return
+            self._deadlines[lobby_id] = deadline
+            heapq.heappush(self._heap, (deadline, lobby_id))
+            self._cond.notify()
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="match-scheduler", daemon=True)
+                self._thread.start()
+
+    def schedule_lobby(self, lobby: Lobby):
+        deadline = match_deadline(lobby)
+        if deadline:
+            self.schedule(lobby.id, deadline)
+
+    def cancel(self, lobby_id: int):
+        with self._cond:
+            self._deadlines.pop(lobby_id, None)
+
+    def _next_due(self):
+        with self._cond:
+            while True:
+                while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+                    heapq.heappop(self._heap)
+
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+
+                deadline, lobby_id = self._heap[0]
+                delay = deadline - time.time()
+                if delay <= 0:
+                    heapq.heappop(self._heap)
+                    del self._deadlines[lobby_id]
+                    return lobby_id
+
+                self._cond.wait(delay)
+
+    def _run(self):
+        while True:
+            lobby_id = self._next_due()
+            try:
+                with app.app_context():
+                    finish_due_match(lobby_id)
+            except Exception:
+                app.logger.exception("Chiusura partita fallita (lobby %s)", lobby_id)
+
+
+match_scheduler = MatchScheduler()
+
+
+def release_lobby_resources(lobby_id: int):
+    """Libera lo stato in memoria legato alla partita (indice spaziale, scadenza)."""
+    match_scheduler.cancel(lobby_id)
+    target_index.invalidate(lobby_id)
+    metrics.drop("geowar_lobby_hacks_total", (("lobby", str(lobby_id)),))
+
+
+def finish_due_match(lobby_id: int):
+    # la chiusura a tempo è un evento dell'attore: serializzata con gli hack della stessa lobby
+    lobby_actors.submit(lobby_id, "tick")
+
+
+# ---------------- LOBBY ACTORS ----------------
+# Ogni lobby ha un attore: una mailbox servita da un thread alla volta (pool condiviso) che tiene
+# lo stato di gioco in memoria e applica ingressi, uscite, cambi team, hack e scadenze in sequenza.
+# I contatori della lobby si aggiornano su DB a delta, nella transazione dell'evento (limiti di
+# capienza e di team nella WHERE); il ricalcolo completo con i COUNT è solo una riconciliazione
+# periodica ogni LOBBY_RECONCILE_INTERVAL e alla fine della partita.
+# Con più processi lo stato in memoria è una cache: si rilegge dopo ogni evento, a ogni checkpoint
+# periodico e sugli eventi della lobby pubblicati altrove; le decisioni (capienza, hack a partita
+# chiusa, vittoria, fine partita) restano nelle UPDATE condizionate sul DB.
+
+class LobbyState:
+    """Campi di gioco di una lobby letti dal DB: stessi nomi delle colonne, usabile al posto di Lobby."""
+
+    FIELDS = ("id", "status", "winner_team", "match_start_time", "is_private", "template_id",
+              "player_count", "players_red", "players_blue", "targets_red", "targets_blue")
+
+    def __init__(self, row):
+        for name in self.FIELDS:
+            setattr(self, name, row[name])
+
+    def copy(self):
+        clone = object.__new__(LobbyState)
+        clone.__dict__.update(self.__dict__)
+        return clone
+
+
+class LobbyActor:
+    def __init__(self, lobby_id: int, executor):
+        self.lobby_id = lobby_id
+        self.state = None  # LobbyState autorevole: solo dal thread che serve la mailbox
+        self.view = None   # copia pubblicata dopo ogni evento, per le letture dagli altri thread
+        self.last_event = time.time()
+        self.loaded_at = 0.0  # ultima rilettura della riga dal DB
+        self.reconciled_at = time.time()  # ultimo ricalcolo completo dei contatori
+        self.refresh_pending = False  # checkpoint di rilettura già in mailbox
+
+        self._executor = executor
+        self._lock = threading.Lock()
+        self._mailbox = deque()
+        self._running = False
+
+    def submit(self, event: str, *args) -> Future:
+        future = Future()
+        with self._lock:
+            self._mailbox.append((future, event, args))
+            if event != "checkpoint":
+                self.last_event = time.time()
+            if self._running:
+                return future
+            self._running = True
+        self._executor.submit(self._drain)
+        return future
+
+    def idle(self) -> bool:
+        with self._lock:
+            return not self._running and not self._mailbox
+
+    def _drain(self):
+        with app.app_context():
+            for _ in range(LOBBY_ACTOR_BATCH):
+                with self._lock:
+                    if not self._mailbox:
+                        self._running = False
+                        return
+                    future, event, args = self._mailbox.popleft()
+
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(self._handle(event, args))
+                except Exception as e:
+                    db.session.rollback()
+                    self.state = None  # stato incerto: si rilegge dal DB al prossimo evento
+                    future.set_exception(e)
+
+        # mailbox ancora piena: il thread passa alle altre lobby, questa torna in coda al pool
+        self._executor.submit(self._drain)
+
+    def _handle(self, event: str, args):
+        if self.state is None:
+            self._commit_and_reload()
+        if self.state is None and event != "leave":
+            return {"success": False, "message": "Lobby non trovata"}, 404
+
+        result = getattr(self, "on_" + event)(*args)
+        self.view = self.state.copy() if self.state else None
+        return result
+
+    # ---------- checkpoint ----------
+
+    def _write_counters(self):
+        """Ricalcolo completo dei contatori (riconciliazione): gli eventi applicano solo delta."""
+        db.session.flush()
+        db.session.execute(
+            update(Lobby)
+            .where(Lobby.id == self.lobby_id)
+            .values(**lobby_counter_values(self.lobby_id))
+            .execution_options(synchronize_session=False)
+        )
+        self.reconciled_at = time.time()
+
+    def _commit_and_reload(self):
+        """Commit e rilettura della riga (modifiche di altri processi incluse). Errore come (dict, code)."""
+        err = db_commit_error_payload()
+        if err:
+            self.state = None
+            return err
+
+        lobby = Lobby.__table__
+        row = db.session.execute(select(lobby).where(lobby.c.id == self.lobby_id)).mappings().first()
+        self.state = LobbyState(row) if row else None
+        self.view = self.state.copy() if self.state else None
+        self.loaded_at = time.time()
+        return None
+
+    def _reconcile(self):
+        self._write_counters()
+        return self._commit_and_reload()
+
+    def _apply_capped(self, apply) -> bool:
+        """Delta condizionato sui contatori; se rifiutato, riconcilia (contatori disallineati) e riprova."""
+        if apply():
+            return True
+        db.session.rollback()
+        if self._reconcile():
+            return False
+        return apply()
+
+    def on_checkpoint(self):
+        # rilettura (modifiche di altri processi), di tanto in tanto con il ricalcolo completo
+        self.refresh_pending = False
+        if time.time() - self.reconciled_at >= LOBBY_RECONCILE_INTERVAL:
+            self._reconcile()
+        else:
+            self._commit_and_reload()
+
+    # ---------- giocatori ----------
+
+    def on_join(self, user_id: int, open_only=True):
+        s = self.state
+        if open_only and s.status not in ("WAITING", "ACTIVE"):
+            return {"message": "La lobby non è disponibile"}, 403
+
+        # capienza e stato nella WHERE: la vista in memoria può non contare gli ingressi di altri processi
+        if not self._apply_capped(lambda: lobby_add_player(self.lobby_id, open_only)):
+            db.session.rollback()
+            self._commit_and_reload()
+            if self.state and open_only and self.state.status not in ("WAITING", "ACTIVE"):
+                return {"message": "La lobby non è disponibile"}, 403
+            return {"message": "Lobby piena"}, 409
+
+        # condizionata: un ingresso concorrente in un'altra lobby non viene sovrascritto
+        joined = db.session.execute(
+            update(User)
+            .where(User.id == user_id, User.lobby_id.is_(None))
+            .values(lobby_id=self.lobby_id, team=None)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if not joined:
+            db.session.rollback()  # annulla anche l'incremento di player_count
+            return {"message": "Sei già in una lobby"}, 400
+
+        err = self._commit_and_reload()
+        if err:
+            return err
+
+        roster_tracker.touch(self.lobby_id, user_id, profile=True)
+        lobby_list_cache.invalidate()
+        lobby_hub.publish(self.lobby_id, "player", lobby_user_payload(db.session.get(User, user_id), time.time()))
+        return {"message": "Entrato nella lobby"}, 200
+
+    def on_leave(self, user_id: int):
+        user = db.session.get(User, user_id)
+        if not user or user.lobby_id != self.lobby_id:
+            return {"message": "Utente non è in una lobby", "success": True}, 200
+
+        lobby_remove_player(self.lobby_id, user.team)
+        user.lobby_id = None
+        user.team = None
+        err = self._commit_and_reload()
+        if err:
+            return err
+
+        roster_tracker.remove(self.lobby_id, user_id)
+        lobby_list_cache.invalidate()
+        lobby_hub.publish(self.lobby_id, "player_left", {"id": user_id})
+
+        # se era ACTIVE: verifica requisiti minimi (1 per team)
+        s = self.state
+        if s and s.status == "ACTIVE" and (s.players_red < 1 or s.players_blue < 1):
+            return self._cancel_match()
+        return {"message": "Lobby lasciata con successo", "success": True}, 200
+
+    def on_set_team(self, user_id: int, team: str):
+        user = db.session.get(User, user_id)
+        if not user or user.lobby_id != self.lobby_id:
+            return {"success": False, "message": "Lobby non valida"}, 400
+
+        if user.team != team:
+            # limite del team nella WHERE dell'UPDATE dei contatori
+            old_team = user.team
+            if not self._apply_capped(lambda: lobby_change_team(self.lobby_id, old_team, team)):
+                db.session.rollback()
+                return {"success": False, "message": f"Team {team} completo nella lobby"}, 409
+            user = db.session.get(User, user_id)  # dopo un'eventuale riconciliazione (rollback)
+            if not user or user.lobby_id != self.lobby_id:
+                db.session.rollback()
+                return {"success": False, "message": "Lobby non valida"}, 400
+
+        user.team = team
+        err = self._commit_and_reload()
+        if err:
+            return err
+
+        roster_tracker.touch(self.lobby_id, user_id)
+        lobby_hub.publish(self.lobby_id, "player", lobby_user_payload(user, time.time()))
+
+        # ---------- VERIFICA AVVIO MATCH ----------
+        s = self.state
+        # lobby privata → basta 2 giocatori; lobby pubblica → almeno 1 per team
+        if s.is_private:
+            should_start = s.player_count >= 2
+        else:
+            should_start = s.players_red >= 1 and s.players_blue >= 1
+
+        if s.status == "WAITING" and should_start and self._start_match():
+            return {"success": True, "message": "Match avviato", "lobby_status": self.state.status}, 200
+        return {"success": True, "message": f"Team aggiornato a {team}"}, 200
+
+    # ---------- partita ----------
+
+    def _start_match(self) -> bool:
+        # condizionato: se un altro processo l'ha già avviata, i target non si generano due volte
+        started = db.session.execute(
+            update(Lobby)
+            .where(Lobby.id == self.lobby_id, Lobby.status == "WAITING")
+            .values(status="ACTIVE", match_start_time=time.time(), targets_red=0, targets_blue=0)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if not started:
+            db.session.rollback()
+            self._commit_and_reload()
+            return False
+
+        # target della lobby nella stessa transazione
+        generate_lobby_targets(self.state)
+        if self._commit_and_reload():
+            return False
+
+        target_index.invalidate(self.lobby_id)
+        match_scheduler.schedule_lobby(self.state)
+        lobby_list_cache.invalidate()
+
+        lobby_hub.publish(self.lobby_id, "status", lobby_status_payload(self.state))
+        lobby_hub.publish(self.lobby_id, "targets", [
+            target_payload(t) for t in Target.query.filter_by(lobby_id=self.lobby_id).all()
+        ])
+        return True
+
+    def _cancel_match(self):
+        # partita annullata per mancanza giocatori: target cancellati, contatori dei target a zero
+        db.session.execute(
+            update(Lobby)
+            .where(Lobby.id == self.lobby_id, Lobby.status == "ACTIVE")
+            .values(status="WAITING", targets_red=0, targets_blue=0)
+            .execution_options(synchronize_session=False)
+        )
+        Target.query.filter_by(lobby_id=self.lobby_id).delete(synchronize_session=False)
+        err = self._commit_and_reload()
+        if err:
+            return err
+
+        release_lobby_resources(self.lobby_id)
+        lobby_list_cache.invalidate()
+        lobby_hub.publish(self.lobby_id, "status", lobby_status_payload(self.state))
+        lobby_hub.publish(self.lobby_id, "targets", [])
+        return {"message": "Lobby lasciata. Partita annullata per mancanza giocatori.", "success": True}, 200
+
+    def on_hack(self, user_id: int, team: str, target_id: int, old_owner: str, payload: dict):
+        deadline = match_deadline(self.state)
+        now = time.time()
+        if deadline is None or now >= deadline:
+            return {"message": "La partita è già terminata"}, 400
+
+        old_owner, err = swap_target_owner(target_id, old_owner, team, now, lobby_id=self.lobby_id)
+        if err:
+            if err[1] == 400:
+                self._commit_and_reload()  # partita chiusa o annullata da un altro processo
+            return err
+
+        # delta sui contatori nella stessa transazione; la rilettura include gli hack di altri processi
+        lobby_adjust_target_counters(self.lobby_id, old_owner, team)
+        err = self._commit_and_reload()
+        if err:
+            return err
+        s = self.state
+        if s is None:
+            return {"message": "Lobby non trovata"}, 404
+
+        # i contatori sono nella lista /lobbies
+        lobby_list_cache.invalidate()
+        hack_log_buffer.append(user_id, target_id, self.lobby_id, team, now)
+        metrics.inc("geowar_hacks_total")
+        metrics.inc("geowar_lobby_hacks_total", (("lobby", str(self.lobby_id)),))
+
+        lobby_hub.publish(self.lobby_id, "target", {**payload, "owner": team})
+        lobby_hub.publish(self.lobby_id, "counters", {"targets_red": s.targets_red, "targets_blue": s.targets_blue})
+
+        # Condizione di vittoria #1: 10 target, rilevata subito in memoria
+        if max(s.targets_red, s.targets_blue) >= TARGET_WIN_CONDITION:
+            self._finish()
+        return {"message": "Hack registrato"}, 200
+
+    def on_tick(self):
+        # rilettura prima di decidere: la partita può essere stata chiusa o riavviata altrove
+        if self._commit_and_reload():
+            return
+        deadline = match_deadline(self.state) if self.state else None
+        if deadline is None:
+            return
+        if time.time() < deadline:
+            match_scheduler.schedule(self.lobby_id, deadline)
+            return
+        self._finish()
+
+    def _finish(self):
+        """Fine partita: contatori riconciliati e vincitore calcolato in SQL; con più processi solo uno la chiude."""
+        self._write_counters()
+        finished = db.session.execute(
+            update(Lobby)
+            .where(Lobby.id == self.lobby_id, Lobby.status == "ACTIVE")
+            .values(
+                status="FINISHED",
+                winner_team=case(
+                    (Lobby.targets_red >= TARGET_WIN_CONDITION, "RED"),
+                    (Lobby.targets_blue >= TARGET_WIN_CONDITION, "BLUE"),
+                    (Lobby.targets_red > Lobby.targets_blue, "RED"),
+                    (Lobby.targets_blue > Lobby.targets_red, "BLUE"),
+                    else_="DRAW",
+                ),
+            )
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if self._commit_and_reload() or self.state is None:
+            return
+
+        if finished:
+            hack_log_buffer.finish_match(self.lobby_id, self.state.match_start_time)
+            lobby_list_cache.invalidate()
+            lobby_hub.publish(self.lobby_id, "match_end", lobby_status_payload(self.state))
+        elif self.state.status == "FINISHED" and not state_backend.shared:
+            # chiusa da un altro processo: senza backend condiviso il suo match_end qui non arriva
+            lobby_hub.publish(self.lobby_id, "match_end", lobby_status_payload(self.state))
+        release_lobby_resources(self.lobby_id)
+
+
+class LobbyActorSystem:
+    """Attori per lobby id, creati al primo evento; checkpoint periodico e rilascio degli attori inattivi."""
+
+    def __init__(self, workers=LOBBY_ACTOR_WORKERS, checkpoint_interval=LOBBY_CHECKPOINT_INTERVAL,
+                 idle_seconds=LOBBY_ACTOR_IDLE):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="lobby-actor")
+        self.checkpoint_interval = checkpoint_interval
+        self.idle_seconds = idle_seconds
+
+        self._lock = threading.Lock()
+        self._actors = {}  # lobby_id -> LobbyActor
+        self._thread = None
+
+    def submit(self, lobby_id: int, event: str, *args) -> Future:
+        # accodato sotto il lock: _run non può rilasciare l'attore tra la scelta e l'accodamento
+        with self._lock:
+            actor = self._actors.get(lobby_id)
+            if actor is None:
+                actor = self._actors[lobby_id] = LobbyActor(lobby_id, self.executor)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="lobby-checkpoint", daemon=True)
+                self._thread.start()
+            return actor.submit(event, *args)
+
+    def refresh(self, lobby_id: int):
+        """Rilettura dello stato dal DB (con riconciliazione se scaduta), se la lobby ha un attore."""
+        with self._lock:
+            actor = self._actors.get(lobby_id)
+            if actor is None or actor.refresh_pending:
+                return
+            actor.refresh_pending = True
+            actor.submit("checkpoint")
+
+    def call(self, lobby_id: int, event: str, *args):
+        """Evento con risposta (dict, code). Il chiamante non deve avere scritture non committate."""
+        # chiude la transazione del chiamante: dopo la risposta le sue letture vedono i commit dell'attore
+        db.session.commit()
+        try:
+            return self.submit(lobby_id, event, *args).result(LOBBY_ACTOR_TIMEOUT)
+        except FutureTimeout:
+            return {"message": "Lobby occupata, riprova"}, 503
+
+    def view(self, lobby_id: int):
+        """Ultimo stato pubblicato dall'attore, None senza attore o se riletto da più di LOBBY_VIEW_MAX_AGE."""
+        with self._lock:
+            actor = self._actors.get(lobby_id)
+        if actor is None or time.time() - actor.loaded_at > LOBBY_VIEW_MAX_AGE:
+            return None
+        return actor.view
+
+    def drop(self, lobby_id: int):
+        with self._lock:
+            self._actors.pop(lobby_id, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.checkpoint_interval)
+            now = time.time()
+            with self._lock:
+                actors = list(self._actors.items())
+
+            for lobby_id, actor in actors:
+                if now - actor.last_event > self.idle_seconds:
+                    # verificato sotto il lock di sistema: nessun evento può essere accodato nel frattempo
+                    with self._lock:
+                        if self._actors.get(lobby_id) is actor and actor.idle():
+                            del self._actors[lobby_id]
+                            continue
+                # rilettura (e riconciliazione periodica): la vista non invecchia oltre l'intervallo
+                self.refresh(lobby_id)
+
+
+lobby_actors = LobbyActorSystem()
+
+
+def lobby_view(lobby_id: int):
+    """Stato di gioco della lobby: dall'attore se attivo (nessuna query), altrimenti dal DB."""
+    return lobby_actors.view(lobby_id) or Lobby.query.get(lobby_id)
+
+
+# ---------------- RANDOM TARGET GENERATION ----------------
+
+def _cap_points(lat: float, lon: float, radius_rad: float, n: int):
+    """n punti uniformi sulla calotta sferica di raggio angolare radius_rad: (lats, lons) in gradi."""
+    lat0, lon0 = math.radians(lat), math.radians(lon)
+
+    if np is not None:
+        rng = np.random.default_rng()
+        r = np.arccos(1 - rng.random(n) * (1 - math.cos(radius_rad)))
+        theta = 2 * math.pi * rng.random(n)
+
+        sin_lat = math.sin(lat0) * np.cos(r) + math.cos(lat0) * np.sin(r) * np.cos(theta)
+        new_lat = np.arcsin(sin_lat)
+        new_lon = lon0 + np.arctan2(
+            np.sin(theta) * np.sin(r) * math.cos(lat0),
+            np.cos(r) - math.sin(lat0) * sin_lat
+        )
+        lons = (np.degrees(new_lon) + 180.0) % 360.0 - 180.0
+        return np.degrees(new_lat).tolist(), lons.tolist()
+
+    lats, lons = [], []
+    for _ in range(n):
+        r = math.acos(1 - random.random() * (1 - math.cos(radius_rad)))
+        theta = 2 * math.pi * random.random()
+
+        sin_lat = math.sin(lat0) * math.cos(r) + math.cos(lat0) * math.sin(r) * math.cos(theta)
+        new_lat = math.asin(sin_lat)
+        new_lon = lon0 + math.atan2(
+            math.sin(theta) * math.sin(r) * math.cos(lat0),
+            math.cos(r) - math.sin(lat0) * sin_lat
+        )
+        lats.append(math.degrees(new_lat))
+        lons.append((math.degrees(new_lon) + 180.0) % 360.0 - 180.0)
+    return lats, lons
+
+
+def random_points_in_cap(lat: float, lon: float, radius_km: float, count: int, min_spacing_m: float = 0.0):
+    """
+    `count` punti uniformi entro radius_km da (lat, lon), generati a batch (vettoriale con numpy).
+    Con min_spacing_m > 0 i punti distano almeno min_spacing_m tra loro (Poisson-disk a dart throwing
+    su griglia): se la calotta non ne contiene abbastanza, ne ritorna meno di `count`.
+    """
+    radius_rad = radius_km * 1000 / EARTH_RADIUS_M
+    if min_spacing_m <= 0:
+        return _cap_points(lat, lon, radius_rad, count)
+
+    # griglia in metri (proiezione locale): lato spacing/√2 → al più un punto per cella
+    m_per_deg = math.pi / 180 * EARTH_RADIUS_M
+    m_per_deg_lon = m_per_deg * max(math.cos(math.radians(lat)), 1e-6)
+    cell = min_spacing_m / math.sqrt(2)
+    min_sq = min_spacing_m * min_spacing_m
+    grid = {}
+
+    lats, lons = [], []
+    budget = count * RANDOM_TARGETS_MAX_ATTEMPTS
+    while len(lats) < count and budget > 0:
+        batch = min(budget, max(64, 2 * (count - len(lats))))
+        budget -= batch
+
+        for clat, clon in zip(*_cap_points(lat, lon, radius_rad, batch)):
+            y = (clat - lat) * m_per_deg
+            x = ((clon - lon + 180.0) % 360.0 - 180.0) * m_per_deg_lon
+            ci, cj = int(math.floor(y / cell)), int(math.floor(x / cell))
+
+            too_close = False
+            for i in range(ci - 2, ci + 3):
+                for j in range(cj - 2, cj + 3):
+                    other = grid.get((i, j))
+                    if other and (other[0] - y) ** 2 + (other[1] - x) ** 2 < min_sq:
+                        too_close = True
+                        break
+                if too_close:
+                    break
+            if too_close:
+                continue
+
+            grid[(ci, cj)] = (y, x)
+            lats.append(clat)
+            lons.append(clon)
+            if len(lats) == count:
+                break
+
+    return lats, lons
+
+
+# ---------------- LOBBY EVENTS (PUB/SUB) ----------------
+
+class LobbySubscription:
+    """Coda di eventi di un singolo client. Se il client è troppo lento la coda trabocca e va risincronizzato."""
+
+    def __init__(self, maxsize=LOBBY_STREAM_QUEUE_SIZE):
+        self.queue = queue.Queue(maxsize)
+        self.overflowed = False
+
+    def put_nowait(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            self.overflowed = True
+
+
+class LobbyHub:
+    """
+    Pub/sub di lobby: le route pubblicano eventi, gli stream li consegnano ai client.
+    Gli eventi vanno subito agli iscritti del processo e, tramite il backend di stato, a quelli degli altri.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}  # lobby_id -> set(LobbySubscription)
+        self._seq = itertools.count(1)
+
+    def subscribe(self, lobby_id: int, subscription=None):
+        subscription = subscription or LobbySubscription()
+        with self._lock:
+            self._subscribers.setdefault(lobby_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, lobby_id: int, subscription):
+        with self._lock:
+            subs = self._subscribers.get(lobby_id)
+            if subs:
+                subs.discard(subscription)
+                if not subs:
+                    del self._subscribers[lobby_id]
+
+    def publish(self, lobby_id, event: str, data):
+        if lobby_id is None:
+            return
+        self._deliver(lobby_id, event, data)
+        state_backend.publish("lobby", [lobby_id, event, data])
+
+    def apply_remote(self, message):
+        lobby_id, event, data = message
+        if event != "position":
+            lobby_actors.refresh(lobby_id)  # stato di gioco cambiato da un altro processo
+        self._deliver(lobby_id, event, data)
+
+    def resync(self):
+        """Eventi persi: ogni stream rimanda lo snapshot completo (come per una coda traboccata)."""
+        with self._lock:
+            subs = [sub for subs in self._subscribers.values() for sub in subs]
+        for sub in subs:
+            sub.overflowed = True
+
+    def _deliver(self, lobby_id, event: str, data):
+        with self._lock:
+            subs = list(self._subscribers.get(lobby_id, ()))
+        if not subs:
+            return
+
+        message = (next(self._seq), event, data)
+        for sub in subs:
+            sub.put_nowait(message)
+
+
+lobby_hub = LobbyHub()
+state_backend.listen("lobby", lobby_hub.apply_remote)
+state_backend.on_resync(lobby_hub.resync)
+
+
+def sse_message(event: str, data, event_id=None) -> str:
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, separators=(',', ':'))}")
+    return "\n".join(lines) + "\n\n"
+
+
+# ---------------- WIRE FORMAT ----------------
+# Alternativa binaria al JSON di /lobby/<id>/users e /targets per i client che mandano
+# Accept: application/x-geowar. Interi senza segno in varint (LEB128), coordinate in int32
+# little-endian (WIRE_COORD_SCALE), stringhe come varint lunghezza + UTF-8.
+#
+#   roster:  "G" versione "R" | flag (bit0 snapshot completo) | cursore | n | utente * n | n rimossi | id * n
+#            utente: id | flag (bit0 attivo, bit1 posizione, bit2 campi statici, bit3-4 team) |
+#                    [lat lon] | [username avatar_seed]
+#   target:  "G" versione "T" | flag (bit0 campi statici) | n | target * n
+#            target: id | proprietario | [lat lon nome]
+#
+# team e proprietario: 0 nessuno/NEUTRAL, 1 RED, 2 BLUE. I campi statici viaggiano solo quando il
+# client non può averli: snapshot completo, utenti entrati o con profilo cambiato dopo il cursore,
+# target senza ?static=0 (la mappa di una partita non cambia).
+
+WIRE_TEAM_CODES = {"RED": 1, "BLUE": 2}
+
+
+def wire_requested() -> bool:
+    # con Accept assente o */* vince il JSON: i client esistenti non cambiano formato
+    return request.accept_mimetypes.best_match(["application/json", WIRE_MEDIA_TYPE]) == WIRE_MEDIA_TYPE
+
+
+class WireWriter:
+    def __init__(self, kind: bytes):
+        self.buf = bytearray(b"G" + bytes((WIRE_VERSION,)) + kind)
+
+    def uvarint(self, n: int):
+        while n >= 0x80:
+            self.buf.append((n & 0x7F) | 0x80)
+            n >>= 7
+        self.buf.append(n)
+
+    def byte(self, n: int):
+        self.buf.append(n)
+
+    def coords(self, lat: float, lon: float):
+        self.buf += struct.pack("<ii", round(lat * WIRE_COORD_SCALE), round(lon * WIRE_COORD_SCALE))
+
+    def string(self, value):
+        data = (value or "").encode("utf-8")
+        self.uvarint(len(data))
+        self.buf += data
+
+    def response(self):
+        response = Response(bytes(self.buf), mimetype=WIRE_MEDIA_TYPE)
+        response.vary.add("Accept")
+        return response
+
+
+def wire_roster(users, removed, cursor: str, full: bool, static_ids=None):
+    """users: payload di lobby_user_payload; campi statici per tutti se full, altrimenti per static_ids."""
+    w = WireWriter(b"R")
+    w.byte(1 if full else 0)
+    w.string(cursor)
+
+    w.uvarint(len(users))
+    for u in users:
+        has_position = u["lat"] is not None and u["lon"] is not None
+        with_static = full or u["id"] in static_ids
+        w.uvarint(u["id"])
+        w.byte(
+            (1 if u["is_active"] else 0)
+            | (2 if has_position else 0)
+            | (4 if with_static else 0)
+            | WIRE_TEAM_CODES.get(u["team"], 0) << 3
+        )
+        if has_position:
+            w.coords(u["lat"], u["lon"])
+        if with_static:
+            w.string(u["username"])
+            w.string(u["avatar_seed"])
+
+    w.uvarint(len(removed))
+    for uid in removed:
+        w.uvarint(uid)
+    return w.response()
+
+
+def wire_targets(targets, with_static=True):
+    w = WireWriter(b"T")
+    w.byte(1 if with_static else 0)
+    w.uvarint(len(targets))
+    for t in targets:
+        w.uvarint(t.id)
+        w.byte(WIRE_TEAM_CODES.get(t.owner_team, 0))
+        if with_static:
+            w.coords(t.lat, t.lon)
+            w.string(t.name)
+    return w.response()
+
+
+# ---------------- REQUEST PROFILING ----------------
+# Per ogni richiesta: query, tempo DB, commit e tempo di serializzazione JSON, aggregati per route.
+# Attiva solo con PROFILE_REQUESTS=1; i valori sono per processo.
+
+class RequestProfile:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.commits = 0
+        self.serialize_time = 0.0
+        self.query_start = None
+        self.profiler = None
+
+
+class RouteProfiler:
+    """Statistiche per route da eventi dell'engine SQLAlchemy e hook di richiesta Flask."""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._routes = {}  # "METHOD /rule" -> totali
+        self._slow = deque(maxlen=PROFILE_KEEP)
+        # un solo cProfile attivo alla volta (da Python 3.12 il profiler è globale al processo)
+        self._cprofile_lock = threading.Lock()
+
+    def current(self):
+        return getattr(self._local, "profile", None)
+
+    def install(self, flask_app):
+        event.listen(Engine, "before_cursor_execute", self._before_query)
+        event.listen(Engine, "after_cursor_execute", self._after_query)
+        event.listen(Engine, "commit", self._on_commit)
+        flask_app.before_request(self.begin)
+        flask_app.after_request(self.finish)
+        flask_app.teardown_request(self.teardown)
+        flask_app.json = TimedJSONProvider(flask_app)
+
+    # ---------- eventi engine (thread della richiesta; i thread in background non hanno profilo) ----------
+    def _before_query(self, *args):
+        p = self.current()
+        if p:
+            p.query_start = time.perf_counter()
+
+    def _after_query(self, *args):
+        p = self.current()
+        if p and p.query_start is not None:
+            p.queries += 1
+            p.db_time += time.perf_counter() - p.query_start
+            p.query_start = None
+
+    def _on_commit(self, conn):
+        p = self.current()
+        if p:
+            p.commits += 1
+
+    # ---------- hook Flask ----------
+    def begin(self):
+        p = RequestProfile()
+        self._local.profile = p
+
+        if random.random() < PROFILE_SAMPLE_RATE and self._cprofile_lock.acquire(blocking=False):
+            p.profiler = cProfile.Profile()
+            try:
+                p.profiler.enable()
+            except ValueError:  # un altro profiler è già attivo
+                p.profiler = None
+                self._cprofile_lock.release()
+
+    def finish(self, response):
+        p = self.current()
+        if not p:
+            return response
+
+        self._stop_profiler(p)
+        total = time.perf_counter() - p.start
+        route = f"{request.method} {request.url_rule.rule if request.url_rule else '<404>'}"
+
+        with self._lock:
+            stats = self._routes.get(route)
+            if stats is None:
+                stats = self._routes[route] = {
+                    "count": 0, "total": 0.0, "max": 0.0,
+                    "queries": 0, "db_time": 0.0, "commits": 0, "serialize_time": 0.0,
+                }
+            stats["count"] += 1
+            stats["total"] += total
+            stats["max"] = max(stats["max"], total)
+            stats["queries"] += p.queries
+            stats["db_time"] += p.db_time
+            stats["commits"] += p.commits
+            stats["serialize_time"] += p.serialize_time
+
+        response.headers["X-DB-Queries"] = str(p.queries)
+        response.headers["X-DB-Commits"] = str(p.commits)
+        response.headers["Server-Timing"] = (
+            f"db;dur={p.db_time * 1000:.2f};desc=\"{p.queries} query\", "
+            f"json;dur={p.serialize_time * 1000:.2f}, "
+            f"total;dur={total * 1000:.2f}"
+        )
+
+        if p.profiler and total * 1000 >= PROFILE_SLOW_MS:
+            out = io.StringIO()
+            pstats.Stats(p.profiler, stream=out).sort_stats("cumulative").print_stats(25)
+            with self._lock:
+                self._slow.append({
+                    "route": route,
+                    "path": request.full_path,
+                    "ms": round(total * 1000, 2),
+                    "queries": p.queries,
+                    "timestamp": time.time(),
+                    "profile": out.getvalue(),
+                })
+        p.profiler = None
+        return response
+
+    def teardown(self, exc):
+        # eccezioni non gestite: finish potrebbe non aver liberato il profiler
+        p = self.current()
+        if p:
+            self._stop_profiler(p)
+        self._local.profile = None
+
+    def _stop_profiler(self, p):
+        if p.profiler:
+            p.profiler.disable()
+            self._cprofile_lock.release()
+
+    # ---------- lettura ----------
+    def routes_payload(self):
+        with self._lock:
+            items = list(self._routes.items())
+
+        rows = []
+        for route, s in items:
+            n = s["count"]
+            rows.append({
+                "route": route,
+                "count": n,
+                "avg_ms": round(s["total"] / n * 1000, 3),
+                "max_ms": round(s["max"] * 1000, 3),
+                "total_ms": round(s["total"] * 1000, 1),
+                "queries_per_request": round(s["queries"] / n, 2),
+                "db_ms_per_request": round(s["db_time"] / n * 1000, 3),
+                "commits_per_request": round(s["commits"] / n, 2),
+                "serialize_ms_per_request": round(s["serialize_time"] / n * 1000, 3),
+            })
+        rows.sort(key=lambda r: r["total_ms"], reverse=True)
+        return rows
+
+    def slow_payload(self):
+        with self._lock:
+            return list(self._slow)
+
+    def reset(self):
+        with self._lock:
+            self._routes.clear()
+            self._slow.clear()
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """jsonify che somma il tempo di serializzazione al profilo della richiesta."""
+
+    def response(self, *args, **kwargs):
+        start = time.perf_counter()
+        resp = super().response(*args, **kwargs)
+        p = route_profiler.current()
+        if p:
+            p.serialize_time += time.perf_counter() - start
+        return resp
+
+
+route_profiler = RouteProfiler()
+if PROFILE_REQUESTS:
+    route_profiler.install(app)
+
+
+# ---------------- METRICS ----------------
+# Contatori e istogrammi in stile Prometheus, esposti da /metrics.
+# Ogni thread scrive solo sul proprio shard (nessun lock sul percorso caldo); /metrics somma gli shard.
+
+METRIC_HELP = {
+    "geowar_http_requests_total": ("counter", "Richieste HTTP per route, metodo e status"),
+    "geowar_http_request_duration_seconds": ("histogram", "Latenza delle richieste HTTP per route"),
+    "geowar_hacks_total": ("counter", "Hack andati a buon fine"),
+    "geowar_lobby_hacks_total": ("counter", "Hack andati a buon fine per lobby (partite in corso)"),
+    "geowar_db_commit_failures_total": ("counter", "Commit falliti e annullati"),
+    "geowar_db_pool_checkout_wait_seconds": ("histogram", "Attesa per ottenere una connessione dal pool"),
+    "geowar_db_connections_opened_total": ("counter", "Connessioni DB aperte (pool_recycle, pre_ping, overflow)"),
+    "geowar_db_connections_invalidated_total": ("counter", "Connessioni DB invalidate"),
+    "geowar_password_hash_rejected_total": ("counter", "Login/registrazioni rifiutati con 503 (pool hash pieno)"),
+    "geowar_state_publish_failures_total": ("counter", "Eventi non inoltrati agli altri processi (backend di stato)"),
+    "geowar_state_backend_failures_total": ("counter", "Operazioni sul backend di stato ripiegate sui valori locali"),
+    "geowar_http_polls_shed_total": ("counter", "Poll respinti con 503 per sovraccarico del processo"),
+    "geowar_hack_log_dropped_total": ("counter", "Eventi di hack scartati dal flush perché rifiutati dal DB"),
+}
+
+
+class MetricShards:
+    def __init__(self, buckets):
+        self.buckets = buckets  # nome istogramma -> limiti superiori dei bucket
+        self._local = threading.local()
+        self._shards = []  # (weakref al thread proprietario, shard)
+        self._base = ({}, {})  # shard dei thread terminati, accorpati da collect()
+        self._shards_lock = threading.Lock()  # creazione shard, accorpamento e drop
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = ({}, {})  # (contatori, istogrammi)
+            with self._shards_lock:
+                self._shards.append((weakref.ref(threading.current_thread()), shard))
+        return shard
+
+    def inc(self, name, labels=(), value=1):
+        counters = self._shard()[0]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        histograms = self._shard()[1]
+        key = (name, labels)
+        h = histograms.get(key)
+        if h is None:
+            h = histograms[key] = [[0] * (len(self.buckets[name]) + 1), 0.0]  # conteggi per bucket (+Inf), somma
+        h[0][bisect.bisect_left(self.buckets[name], value)] += 1
+        h[1] += value
+
+    @staticmethod
+    def _merge(into, shard):
+        counters, histograms = into
+        shard_counters, shard_histograms = shard
+        # copia atomica sotto GIL: gli altri thread possono scrivere nel frattempo
+        for key, value in list(shard_counters.items()):
+            counters[key] = counters.get(key, 0) + value
+        for key, (buckets, total) in list(shard_histograms.items()):
+            merged = histograms.setdefault(key, [[0] * len(buckets), 0.0])
+            for i, n in enumerate(buckets):
+                merged[0][i] += n
+            merged[1] += total
+
+    def drop(self, name, labels=()):
+        """Rimuove una serie (es. lobby terminata) da tutti gli shard."""
+        with self._shards_lock:
+            for counters, histograms in [self._base] + [shard for _, shard in self._shards]:
+                counters.pop((name, labels), None)
+                histograms.pop((name, labels), None)
+
+    def collect(self):
+        """Somma degli shard: ({(nome, label): valore}, {(nome, label): [bucket, somma]})."""
+        result = ({}, {})
+        with self._shards_lock:
+            # i thread terminati non scrivono più: il loro shard confluisce nella base e non resta in lista
+            live = []
+            for thread_ref, shard in self._shards:
+                thread = thread_ref()
+                if thread is None or not thread.is_alive():
+                    self._merge(self._base, shard)
+                else:
+                    live.append((thread_ref, shard))
+            self._shards = live
+            self._merge(result, self._base)
+
+        for _, shard in live:
+            self._merge(result, shard)
+        return result
+
+
+metrics = MetricShards({
+    "geowar_http_request_duration_seconds": METRICS_LATENCY_BUCKETS,
+    "geowar_db_pool_checkout_wait_seconds": METRICS_POOL_WAIT_BUCKETS,
+})
+
+_metrics_local = threading.local()
+
+
+@app.before_request
+def _metrics_request_start():
+    _metrics_local.request_start = time.perf_counter()
+
+
+@app.after_request
+def _metrics_request_end(response):
+    start = getattr(_metrics_local, "request_start", None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else "<404>"
+        metrics.inc("geowar_http_requests_total", (
+            ("route", route), ("method", request.method), ("code", str(response.status_code)),
+        ))
+        metrics.observe("geowar_http_request_duration_seconds", (("route", route), ("method", request.method)),
+                        time.perf_counter() - start)
+        _metrics_local.request_start = None
+    return response
+
+
+# Attesa sul pool: la sessione chiede una connessione dopo do_orm_execute; se il checkout avviene
+# prima della query successiva, il tempo trascorso è l'attesa (pool esaurito = attesa lunga).
+@event.listens_for(Session, "do_orm_execute")
+def _metrics_checkout_requested(orm_execute_state):
+    _metrics_local.checkout_requested = time.perf_counter()
+
+
+@event.listens_for(Pool, "checkout")
+def _metrics_checkout(dbapi_connection, connection_record, connection_proxy):
+    requested = getattr(_metrics_local, "checkout_requested", None)
+    if requested is not None:
+        metrics.observe("geowar_db_pool_checkout_wait_seconds", (), time.perf_counter() - requested)
+        _metrics_local.checkout_requested = None
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _metrics_connection_in_use(*args):
+    # connessione già in mano alla sessione: nessun checkout da misurare
+    _metrics_local.checkout_requested = None
+
+
+@event.listens_for(Pool, "connect")
+def _metrics_connection_opened(dbapi_connection, connection_record):
+    metrics.inc("geowar_db_connections_opened_total")
+
+
+@event.listens_for(Pool, "invalidate")
+def _metrics_connection_invalidated(dbapi_connection, connection_record, exception):
+    metrics.inc("geowar_db_connections_invalidated_total")
+
+
+def prometheus_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for k, v in labels:
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def metrics_text():
+    """Esposizione in formato testo Prometheus 0.0.4: metriche di processo + gauge letti dal DB."""
+    counters, histograms = metrics.collect()
+    by_name = {}
+    for (name, labels), value in counters.items():
+        by_name.setdefault(name, []).append((labels, value))
+    for (name, labels), value in histograms.items():
+        by_name.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name in sorted(METRIC_HELP):
+        kind, help_text = METRIC_HELP[name]
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in sorted(by_name.get(name, [])):
+            if kind == "counter":
+                lines.append(f"{name}{prometheus_labels(labels)} {value}")
+                continue
+
+            buckets, total = value
+            cumulative = 0
+            for bound, n in zip(list(metrics.buckets[name]) + ["+Inf"], buckets):
+                cumulative += n
+                lines.append(f"{name}_bucket{prometheus_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{prometheus_labels(labels)} {total}")
+            lines.append(f"{name}_count{prometheus_labels(labels)} {cumulative}")
+
+    # gauge di gioco: letti dal DB, validi anche con più processi
+    lines.append("# HELP geowar_lobbies Lobby per stato")
+    lines.append("# TYPE geowar_lobbies gauge")
+    for status, count in db.session.query(Lobby.status, func.count(Lobby.id)).group_by(Lobby.status):
+        lines.append(f"geowar_lobbies{prometheus_labels((('status', status),))} {count}")
+
+    # last_active su DB è in ritardo al massimo di un intervallo di flush; range scan su ix_user_last_active
+    active_since = time.time() - ACTIVE_SECONDS - POSITION_FLUSH_INTERVAL
+    active_players = db.session.query(func.count(User.id)).filter(User.last_active >= active_since).scalar()
+    in_lobby = db.session.query(func.count(User.id)).filter(User.lobby_id.isnot(None)).scalar()
+    lines.append("# HELP geowar_players_active Giocatori che hanno inviato la posizione di recente")
+    lines.append("# TYPE geowar_players_active gauge")
+    lines.append(f"geowar_players_active {active_players}")
+    lines.append("# HELP geowar_players_in_lobby Giocatori dentro una lobby")
+    lines.append("# TYPE geowar_players_in_lobby gauge")
+    lines.append(f"geowar_players_in_lobby {in_lobby}")
+
+    lines.append("# HELP geowar_poll_interval_seconds Intervallo di poll consigliato ai client (max-age)")
+    lines.append("# TYPE geowar_poll_interval_seconds gauge")
+    lines.append(f"geowar_poll_interval_seconds {poll_pacer.interval()}")
+
+    # stato del pool (QueuePool; con SQLite il pool può non avere questi metodi)
+    pool = db.engine.pool
+    if hasattr(pool, "checkedout"):
+        lines.append("# HELP geowar_db_pool_checked_out Connessioni in uso")
+        lines.append("# TYPE geowar_db_pool_checked_out gauge")
+        lines.append(f"geowar_db_pool_checked_out {pool.checkedout()}")
+    if hasattr(pool, "size"):
+        lines.append("# HELP geowar_db_pool_size Dimensione configurata del pool (oltre: max_overflow)")
+        lines.append("# TYPE geowar_db_pool_size gauge")
+        lines.append(f"geowar_db_pool_size {pool.size()}")
+
+    return "\n".join(lines) + "\n"
+
+
+# ---------------- RESPONSE COMPRESSION & POLL PACING ----------------
+# I client interrogano /targets, /lobby/<id>/users, /lobby/<id>/status e /lobbies a intervalli fissi.
+# Le risposte ai poll hanno un ETag (invariata → 304 senza body) e Cache-Control: max-age con
+# l'intervallo consigliato, che cresce con il carico del processo; oltre la soglia di shedding i poll
+# ricevono 503 + Retry-After. I body sopra COMPRESS_MIN_BYTES escono compressi (brotli o gzip).
+
+POLLED_ENDPOINTS = {"get_targets", "get_lobby_users", "get_lobby_status", "get_lobbies"}
+COMPRESSIBLE_MIMETYPES = {"application/json", WIRE_MEDIA_TYPE, "text/plain", "text/html"}
+COMPRESS_ENCODINGS = ["br", "gzip"] if brotli else ["gzip"]  # a parità di q vince la prima
+
+
+class PollPacer:
+    """
+    Carico del processo come media mobile delle richieste in corso, tradotto in un intervallo di
+    poll: POLL_INTERVAL_MIN a riposo, POLL_INTERVAL_MAX a saturazione (POLL_LOAD_CAPACITY).
+    """
+
+    def __init__(self, capacity=POLL_LOAD_CAPACITY):
+        self.capacity = max(1, capacity)
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self._load = 0.0
+
+    def begin(self):
+        """Richiesta iniziata: restituisce le richieste in corso, questa compresa."""
+        with self._lock:
+            self._inflight += 1
+            self._load += POLL_LOAD_SMOOTHING * (self._inflight - self._load)
+            return self._inflight
+
+    def end(self):
+        with self._lock:
+            self._inflight -= 1
+
+    def interval(self):
+        ratio = min(1.0, self._load / self.capacity)
+        return round(POLL_INTERVAL_MIN + (POLL_INTERVAL_MAX - POLL_INTERVAL_MIN) * ratio)
+
+    def overloaded(self, inflight):
+        return POLL_SHED_FACTOR > 0 and inflight > self.capacity * POLL_SHED_FACTOR
+
+
+poll_pacer = PollPacer()
+
+
+def compress_body(encoding, body):
+    if encoding == "br":
+        return brotli.compress(body, quality=COMPRESS_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=COMPRESS_GZIP_LEVEL, mtime=0)
+
+
+class CompressedBodies:
+    """
+    Body già compressi per (codifica, ETag): uno snapshot condiviso (i target di una lobby, una
+    pagina di /lobbies) si comprime una volta per tutti i client che lo leggono.
+    Gli ETag di questa app sono hash del body, quindi la chiave identifica il contenuto.
+    """
+
+    def __init__(self, max_entries=COMPRESS_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._bodies = {}
+
+    def get(self, encoding, etag, body):
+        if etag is None:
+            return compress_body(encoding, body)
+        key = (encoding, etag)
+        with self._lock:
+            compressed = self._bodies.get(key)
+        if compressed is None:
+            compressed = compress_body(encoding, body)
+            with self._lock:
+                if len(self._bodies) >= self.max_entries:
+                    self._bodies.clear()
+                self._bodies[key] = compressed
+        return compressed
+
+
+compressed_bodies = CompressedBodies()
+
+
+@app.before_request
+def _poll_pacing_start():
+    g.poll_inflight = poll_pacer.begin()
+    if (request.method == "GET" and request.endpoint in POLLED_ENDPOINTS
+            and poll_pacer.overloaded(g.poll_inflight)):
+        # le scritture (hack, posizioni) passano sempre: si rinuncia prima alle letture ripetibili
+        metrics.inc("geowar_http_polls_shed_total")
+        return (
+            jsonify({"message": "Server sovraccarico, riprova più tardi"}),
+            503,
+            {"Retry-After": str(POLL_INTERVAL_MAX)},
+        )
+    return None
+
+
+@app.teardown_request
+def _poll_pacing_end(exc):
+    if g.pop("poll_inflight", None) is not None:
+        poll_pacer.end()
+
+
+# gli after_request girano in ordine inverso di registrazione: la compressione, registrata per
+# prima, vede la risposta finale (già convertita in 304 dove serve)
+@app.after_request
+def _compress_response(response):
+    if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES or "Content-Encoding" in response.headers):
+        return response
+
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = request.accept_encodings.best_match(COMPRESS_ENCODINGS)
+    if encoding is None:
+        return response
+
+    # stesso ETag per ogni codifica: il 304 si decide sul contenuto, prima della compressione
+    response.set_data(compressed_bodies.get(encoding, response.get_etag()[0], body))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+@app.after_request
+def _poll_hints(response):
+    if (request.method != "GET" or request.endpoint not in POLLED_ENDPOINTS
+            or response.status_code not in (200, 304) or response.is_streamed):
+        return response
+
+    if response.status_code == 200 and not response.get_etag()[0]:
+        response.add_etag()
+        response.make_conditional(request)  # If-None-Match invariato → 304
+
+    # il client può riusare la risposta per `max-age` secondi: è il ritmo di poll consigliato
+    response.headers["Cache-Control"] = f"private, max-age={poll_pacer.interval()}"
+    return response
+
+
+# ---------------- PASSWORD HASHING ----------------
+# Gli hash (scrypt/pbkdf2) sono CPU-bound: girano in un pool con al massimo PASSWORD_HASH_WORKERS
+# thread e una coda limitata. A coda piena si risponde subito 503, così un picco di login
+# non occupa i worker WSGI che servono heartbeat e polling.
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    def __init__(self, method=PASSWORD_HASH_METHOD, workers=PASSWORD_HASH_WORKERS, queue_size=PASSWORD_HASH_QUEUE):
+        self.method = method
+        # prefisso "metodo:parametri" scritto da werkzeug: gli hash con prefisso diverso vanno rigenerati
+        self.prefix = generate_password_hash("", method).split("$", 1)[0]
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="password-hash")
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            metrics.inc("geowar_password_hash_rejected_total")
+            raise PasswordHasherBusy()
+        try:
+            future = self._executor.submit(fn, *args)
+        except RuntimeError:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=PASSWORD_HASH_TIMEOUT)
+        except FutureTimeout:  # coda troppo lenta: stesso esito di coda piena
+            raise PasswordHasherBusy()
 
+    def hash(self, password: str) -> str:
+        return self._run(generate_password_hash, password, self.method)
+
+    def check(self, password_hash: str, password: str) -> bool:
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        return password_hash.split("$", 1)[0] != self.prefix
+
+
+password_hasher = PasswordHasher()
+
+
+def password_hasher_busy_response():
+    return (
+        jsonify({"message": "Server occupato, riprova tra poco"}),
+        503,
+        {"Retry-After": str(PASSWORD_HASH_RETRY_AFTER)},
+    )
+
+
+# ---------------- AUTH TOKENS ----------------
+# Token "<payload>.<firma>": payload JSON base64url con uid, team, lobby, iat, exp; firma HMAC-SHA256.
+# Verificabili senza DB: i ban passano dalla cache di revoca, team e lobby vengono riemessi
+# (header X-Auth-Token) dalle route che li cambiano.
+
+if not AUTH_SECRET:
+    # con più processi un segreto casuale per processo invalida i token emessi dagli altri
+    if AUTH_REQUIRE_TOKEN or CLUSTER_NODES or STATE_BACKEND_URL:
+        raise RuntimeError("AUTH_SECRET obbligatorio con AUTH_REQUIRE_TOKEN, CLUSTER_NODES o STATE_BACKEND_URL")
+    AUTH_SECRET = os.urandom(32).hex()
+    app.logger.error("AUTH_SECRET non impostato: i token valgono solo per questo processo")
+_auth_key = AUTH_SECRET.encode()
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def issue_token(user: User) -> str:
+    now = round(time.time(), 3)  # millisecondi: un login subito dopo lo sblocco resta valido
+    claims = {"uid": user.id, "team": user.team, "lobby": user.lobby_id, "iat": now, "exp": int(now) + AUTH_TOKEN_TTL}
+    payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+    signature = _b64encode(hmac.new(_auth_key, payload.encode(), hashlib.sha256).digest())
+    return f"{payload}.{signature}"
+
+
+class TokenRevocations:
+    """
+    Utenti i cui token non valgono più: bannati (riletti dal DB ogni AUTH_REVOCATION_REFRESH secondi)
+    e revoche locali per timestamp (token emessi prima del ban restano invalidi anche dopo lo sblocco).
+    """
+
+    def __init__(self, refresh_interval=AUTH_REVOCATION_REFRESH):
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._banned = set()
+        self._revoked_before = {}  # user_id -> iat minimo valido
+        self._loaded_at = 0.0
+
+    def revoke(self, user_id: int):
+        now = time.time()
+        self._revoke(user_id, now)
+        state_backend.publish("revocations", ["revoke", user_id, now])
+
+    def restore(self, user_id: int):
+        self._restore(user_id)
+        state_backend.publish("revocations", ["restore", user_id, None])
+
+    def apply_remote(self, message):
+        action, user_id, revoked_at = message
+        if action == "revoke":
+            self._revoke(user_id, revoked_at)
+        elif action == "restore":
+            self._restore(user_id)
+
+    def _revoke(self, user_id: int, revoked_at: float):
+        with self._lock:
+            self._banned.add(user_id)
+            self._revoked_before[user_id] = max(revoked_at, self._revoked_before.get(user_id, 0))
+
+    def _restore(self, user_id: int):
+        with self._lock:
+            self._banned.discard(user_id)
+
+    def is_revoked(self, user_id: int, issued_at: float) -> bool:
+        if time.time() - self._loaded_at > self.refresh_interval:
+            self._refresh()
+        with self._lock:
+            return user_id in self._banned or issued_at < self._revoked_before.get(user_id, 0)
+
+    def _refresh(self):
+        banned = {uid for (uid,) in db.session.query(User.id).filter(User.banned.is_(True))}
+        with self._lock:
+            self._banned = banned
+            self._loaded_at = time.time()
+
+
+token_revocations = TokenRevocations()
+state_backend.listen("revocations", token_revocations.apply_remote)
+
+
+def verify_token(token: str):
+    """Claims del token se firma, scadenza e revoca sono valide, altrimenti None."""
+    try:
+        payload, signature = token.split(".")
+        expected = _b64encode(hmac.new(_auth_key, payload.encode(), hashlib.sha256).digest())
+        if not hmac.compare_digest(signature, expected):
+            return None
+        claims = json.loads(_b64decode(payload))
+    except (ValueError, TypeError):
+        return None
+
+    if not isinstance(claims, dict) or claims.get("exp", 0) < time.time():
+        return None
+    if token_revocations.is_revoked(claims.get("uid"), claims.get("iat", 0)):
+        return None
+    return claims
+
+
+def authenticate(token, claimed_user_id):
+    """
+    Utente di una richiesta: (user_id, claims, errore come (dict, code)).
+    Con token valido lo user_id viene dal token (quello nel body, se c'è, deve coincidere);
+    senza token si accetta lo user_id dichiarato, salvo AUTH_REQUIRE_TOKEN.
+    """
+    if not token:
+        if AUTH_REQUIRE_TOKEN:
+            return None, None, ({"message": "Token mancante"}, 401)
+        return claimed_user_id, None, None
+
+    claims = verify_token(token)
+    if not claims:
+        return None, None, ({"message": "Token non valido o scaduto"}, 401)
+    if claimed_user_id not in (None, "") and str(claimed_user_id) != str(claims["uid"]):
+        return None, None, ({"message": "Token non valido per questo utente"}, 403)
+    return claims["uid"], claims, None
+
+
+def request_user(claimed_user_id):
+    """authenticate() con il token dell'header Authorization: Bearer; errore già come risposta Flask."""
+    header = request.headers.get("Authorization", "")
+    token = header[7:].strip() if header.startswith("Bearer ") else None
+
+    user_id, claims, err = authenticate(token, claimed_user_id)
+    if err:
+        body, code = err
+        return None, None, (jsonify(body), code)
+    return user_id, claims, None
+
+
+def refresh_token_for(user: User):
+    """Lobby o team dell'utente cambiati: la risposta riporta un token aggiornato in X-Auth-Token."""
+    g.auth_token_user = user
+
+
+@app.after_request
+def _attach_refreshed_token(response):
+    user = g.pop("auth_token_user", None)
+    if user is not None and response.status_code < 400:
+        response.headers["X-Auth-Token"] = issue_token(user)
+    return response
+
+
+# ---------------- GOOGLE ID TOKEN ----------------
+# Le firme degli ID token si verificano in locale: i certificati pubblici di Google si scaricano
+# solo alla scadenza indicata da Cache-Control, con una sessione HTTP riusata.
+# La sorgente dei certificati è intercambiabile (file locale per i test offline).
+
+class GoogleCertsUnavailable(Exception):
+    pass
+
+
+def cache_max_age(headers, default=GOOGLE_CERTS_DEFAULT_TTL) -> float:
+    """Secondi di validità di una risposta HTTP: max-age di Cache-Control meno Age."""
+    match = re.search(r"max-age=(\d+)", headers.get("Cache-Control", ""))
+    if not match:
+        return default
+    try:
+        age = int(headers.get("Age", 0))
+    except ValueError:
+        age = 0
+    return max(0, int(match.group(1)) - age)
+
+
+class HttpCertSource:
+    def __init__(self, url=GOOGLE_CERTS_URL):
+        self.url = url
+        self._request = google_requests.Request()  # una requests.Session: connessioni keep-alive riusate
+        self._lock = threading.Lock()
+        self._certs = {}
+        self._fetched_at = 0.0
+        self._expires_at = 0.0
+
+    def get_certs(self, force=False):
+        """{kid: PEM}; force = kid sconosciuto (rotazione chiavi), ricarica al più ogni GOOGLE_CERTS_MIN_REFRESH s."""
+        if self._certs and not force and time.time() < self._expires_at:
+            return self._certs
+
+        with self._lock:
+            now = time.time()
+            if self._certs:
+                if not force and now < self._expires_at:
+                    return self._certs  # già ricaricati da un altro thread
+                if force and now - self._fetched_at < GOOGLE_CERTS_MIN_REFRESH:
+                    return self._certs
+
+            try:
+                response = self._request(self.url, method="GET")
+                if response.status != 200:
+                    raise google_exceptions.TransportError(f"HTTP {response.status}")
+                certs = json.loads(response.data)
+            except (google_exceptions.TransportError, ValueError) as e:
+                if self._certs:
+                    # Google ruota le chiavi con sovrapposizione: meglio certificati vecchi che nessun login
+                    app.logger.warning("Aggiornamento certificati Google fallito, uso quelli in cache: %s", e)
+                    return self._certs
+                raise GoogleCertsUnavailable(str(e))
+
+            self._certs = certs
+            self._fetched_at = now
+            self._expires_at = now + cache_max_age(response.headers)
+            return certs
+
+
+class StaticCertSource:
+    """Certificati fissi (es. chiavi di test generate in locale): nessun accesso alla rete."""
+
+    def __init__(self, certs):
+        self._certs = dict(certs)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def get_certs(self, force=False):
+        return self._certs
+
+
+class GoogleTokenVerifier:
+    def __init__(self, audience, cert_source):
+        self.audience = audience
+        self.cert_source = cert_source
+
+    def verify(self, token):
+        """Claims dell'ID token; ValueError se firma, audience, issuer o scadenza non sono validi."""
+        header = google_jwt.decode_header(token)
+
+        certs = self.cert_source.get_certs()
+        if header.get("kid") not in certs:
+            certs = self.cert_source.get_certs(force=True)
+
+        claims = google_jwt.decode(token, certs=certs, audience=self.audience, clock_skew_in_seconds=GOOGLE_CLOCK_SKEW)
+        if claims.get("iss") not in GOOGLE_ISSUERS:
+            raise ValueError(f"Issuer non valido: {claims.get('iss')}")
+        return claims
+
+
+google_verifier = GoogleTokenVerifier(
+    GOOGLE_CLIENT_ID,
+    StaticCertSource.from_file(GOOGLE_CERTS_FILE) if GOOGLE_CERTS_FILE else HttpCertSource(),
+)
+
+
+# ---------------- GAME ACTIONS ----------------
+# Regole di gioco condivise dalle route HTTP e dal gateway WebSocket (gateway.py).
+# Ritornano (dict, code) e vanno chiamate dentro un app context.
+
+def apply_hack(user_id, target_id):
+    user = User.query.get(user_id)
+    target = Target.query.get(target_id)
+
+    if not user or user.banned:
+        return {"message": "Utente non valido"}, 403
+    if not target:
+        return {"message": "Target non trovato"}, 404
+    if not user.team:
+        return {"message": "Utente senza team"}, 400
+
+    # target accessibile solo se globale o della stessa lobby
+    if target.lobby_id is not None and target.lobby_id != user.lobby_id:
+        return {"message": "Target non accessibile"}, 403
+
+    # se target è di lobby, l'utente deve essere in lobby
+    if target.lobby_id is not None and user.lobby_id is None:
+        return {"message": "Devi essere in una lobby per hackare questo target"}, 403
+
+    lobby = lobby_view(user.lobby_id) if user.lobby_id else None
+    if lobby and lobby_status_payload(lobby)["status"] == "FINISHED":
+        return {"message": "La partita è già terminata"}, 400
+
+    # il giocatore deve essere davvero vicino al target (ultima posizione nota al server)
+    if HACK_MAX_DISTANCE_M > 0:
+        lat, lon, _ = position_store.current(user)
+        if lat == 0.0 or lon == 0.0:
+            return {"message": "Posizione del giocatore sconosciuta"}, 400
+        if distance_m(lat, lon, target.lat, target.lon) > HACK_MAX_DISTANCE_M:
+            return {"message": "Target troppo lontano"}, 403
+
+    # target di lobby: contatori, vittoria e log li gestisce l'attore della lobby
+    if target.lobby_id is not None:
+        return lobby_actors.call(
+            target.lobby_id, "hack", user.id, user.team, target.id, target.owner_team, target_payload(target)
+        )
+
+    now = time.time()
+    old_owner, err = swap_target_owner(target.id, target.owner_team, user.team, now)
+    if err:
+        return err
+    err = db_commit_error_payload()
+    if err:
+        return err
+
+    # si logga solo il cambio di proprietario, a blocchi fuori dalla transazione
+    hack_log_buffer.append(user.id, target.id, None, user.team, now)
+    metrics.inc("geowar_hacks_total")
+    return {"message": "Hack registrato"}, 200
+
+
+def swap_target_owner(target_id: int, old_owner: str, new_owner: str, now: float, lobby_id=None):
+    """
+    Compare-and-set sul proprietario: se nel frattempo un altro hack l'ha cambiato, la UPDATE non
+    tocca righe e si riprova con il proprietario aggiornato. Per un target di lobby la stessa UPDATE
+    richiede la partita ACTIVE e non scaduta (vale qualunque processo l'abbia chiusa). Senza commit.
+    Ritorna (proprietario precedente, None) oppure (None, (dict, code)).
+    """
+    match_running = [
+        Lobby.id == lobby_id,
+        Lobby.status == "ACTIVE",
+        Lobby.match_start_time > now - MATCH_DURATION_SECONDS,
+    ]
+    conditions = [Target.id == target_id]
+    if lobby_id is not None:
+        conditions.append(select(Lobby.id).where(*match_running).exists())
+
+    for attempt in range(HACK_CAS_RETRIES):
+        if old_owner == new_owner:
+            return None, ({"message": "Target già conquistato dal tuo team"}, 200)
+
+        swapped = db.session.execute(
+            update(Target)
+            .where(*conditions, Target.owner_team == old_owner)
+            .values(owner_team=new_owner, last_hacked=now)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if swapped:
+            return old_owner, None
+
+        # nuova transazione: la rilettura deve vedere il valore appena committato dall'altro hack
+        db.session.rollback()
+        if lobby_id is not None and db.session.query(Lobby.id).filter(*match_running).first() is None:
+            return None, ({"message": "La partita è già terminata"}, 400)
+        old_owner = db.session.query(Target.owner_team).filter_by(id=target_id).scalar()
+
+    return None, ({"message": "Target conteso, riprova"}, 409)
+
+
+def track_user(user_id: int, claims=None):
+    """Utente e lobby in memoria; lookup su DB solo la prima volta. Errore (dict, code) se non esiste."""
+    if roster_tracker.knows(user_id):
+        return None
+    if claims:
+        # token verificato: utente esistente e non bannato, lobby dai claim
+        roster_tracker.track(user_id, claims["lobby"])
+        return None
+    user = User.query.get(user_id)
+    if not user:
+        return {"message": "Utente non trovato"}, 404
+    roster_tracker.track(user.id, user.lobby_id)
+    return None
+
+
+def record_position(user_id: int, lat: float, lon: float, claims=None):
+    err = track_user(user_id, claims)
+    if err:
+        return err
+
+    # 1. Protezione contro coordinate 0,0 (spesso errori GPS)
+    if lat == 0.0 or lon == 0.0:
+        return {"success": False, "message": "Coordinate GPS non valide"}, 400
+
+    # 2. Usa sempre il tempo del server per last_active.
+    # Nessun commit qui: la posizione resta in memoria e viene scritta a batch dal flush.
+    now = time.time()
+    position_store.update(user_id, lat, lon, now)
+
+    lobby_id = roster_tracker.lobby_of(user_id)
+    roster_tracker.touch(lobby_id, user_id)
+    lobby_hub.publish(lobby_id, "position", {"id": user_id, "lat": lat, "lon": lon, "last_active": now})
+
+    return {"success": True}, 200
 
 
 # ---------------- INIT ----------------
 
+# Migrazioni versionate: create_all crea solo le tabelle mancanti (con i loro indici), le modifiche
+# a tabelle esistenti passano da qui. Ogni migrazione è idempotente: i DB creati prima del
+# versionamento possono già avere colonne o indici, e più worker possono avviarsi insieme.
+
+MYSQL_DUPLICATE_SCHEMA_ERRORS = {1060, 1061}  # ER_DUP_FIELDNAME, ER_DUP_KEYNAME
+
+
+def is_duplicate_schema_error(exc):
+    """Colonna o indice già esistente: l'ha creato un altro worker tra il controllo e l'ALTER."""
+    args = getattr(exc.orig, "args", ())
+    if args and args[0] in MYSQL_DUPLICATE_SCHEMA_ERRORS:
+        return True
+    message = str(exc.orig).lower()
+    return "duplicate column name" in message or "already exists" in message
+
+
+def execute_ddl_once(ddl, description):
+    # check-then-act: se un altro worker ci precede il nostro ALTER fallisce, e va bene così.
+    # Su MySQL e SQLite l'errore di un singolo statement non annulla la transazione della sessione.
+    try:
+        ddl()
+    except (OperationalError, ProgrammingError) as exc:
+        if not is_duplicate_schema_error(exc):
+            raise
+        app.logger.info("Migrazione: %s già presente (creato da un altro worker)", description)
+
+
+def add_column_if_missing(table, column_name):
+    inspector = db.inspect(db.session.connection())
+    if column_name in {c["name"] for c in inspector.get_columns(table.name)}:
+        return
+
+    preparer = db.engine.dialect.identifier_preparer
+    column_type = table.c[column_name].type.compile(dialect=db.engine.dialect)
+    statement = text(
+        f"ALTER TABLE {preparer.quote(table.name)} ADD COLUMN {preparer.quote(column_name)} {column_type} NULL"
+    )
+    execute_ddl_once(lambda: db.session.execute(statement), f"{table.name}.{column_name}")
+
+
+def create_indexes_if_missing(*tables):
+    inspector = db.inspect(db.session.connection())
+    for table in tables:
+        existing = {ix["name"] for ix in inspector.get_indexes(table.name)}
+        columns = {c["name"] for c in inspector.get_columns(table.name)}
+        for index in table.indexes:
+            # un indice su colonne non ancora aggiunte spetta alla migrazione che le aggiunge
+            if index.name not in existing and all(c.name in columns for c in index.columns):
+                execute_ddl_once(lambda: index.create(db.session.connection()), f"indice {index.name}")
+
+
+def migrate_lobby_template():
+    add_column_if_missing(Lobby.__table__, "template_id")
+
+
+def migrate_lobby_team_counters():
+    add_column_if_missing(Lobby.__table__, "players_red")
+    add_column_if_missing(Lobby.__table__, "players_blue")
+
+
+def migrate_hot_query_indexes():
+    create_indexes_if_missing(User.__table__, Target.__table__, Lobby.__table__, HackLog.__table__)
+
+
+def migrate_hack_log_lobby():
+    add_column_if_missing(HackLog.__table__, "lobby_id")
+    create_indexes_if_missing(HackLog.__table__)
+
+
+def migrate_lobby_owner():
+    add_column_if_missing(Lobby.__table__, "owner_id")
+
+
+def migrate_user_last_active_index():
+    create_indexes_if_missing(User.__table__)
+
+
+def migrate_match_hack_stat_key():
+    stat = MatchHackStat.__table__
+    key = (stat.c.lobby_id, stat.c.match_start_time, stat.c.scope, stat.c.team, stat.c.user_id, stat.c.target_id)
+
+    # chiavi vuote al posto dei NULL, poi via i doppioni (si tiene la riga più vecchia)
+    db.session.execute(update(stat).where(stat.c.team.is_(None)).values(team=""))
+    db.session.execute(update(stat).where(stat.c.user_id.is_(None)).values(user_id=0))
+    db.session.execute(update(stat).where(stat.c.target_id.is_(None)).values(target_id=0))
+    keep = select(func.min(stat.c.id).label("id")).group_by(*key).subquery()  # tabella derivata: ok su MySQL
+    db.session.execute(stat.delete().where(stat.c.id.notin_(select(keep.c.id))))
+    create_indexes_if_missing(stat)
+
+
+MIGRATIONS = [
+    (1, "lobby.template_id", migrate_lobby_template),
+    (2, "lobby.players_red, lobby.players_blue", migrate_lobby_team_counters),
+    (3, "indici per le query di lobby", migrate_hot_query_indexes),
+    (4, "hack_log.lobby_id", migrate_hack_log_lobby),
+    (5, "match_hack_stat: chiave UNIQUE", migrate_match_hack_stat_key),
+    (6, "user.last_active: indice", migrate_user_last_active_index),
+    (7, "lobby.owner_id", migrate_lobby_owner),
+]
+
+
+def run_migrations():
+    """Applica in ordine le migrazioni non ancora registrate in schema_version."""
+    applied = {version for (version,) in db.session.query(SchemaVersion.version)}
+
+    for version, name, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        migrate()
+        db.session.add(SchemaVersion(version=version, name=name))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()  # registrata nel frattempo da un altro worker
+        app.logger.info("Migrazione %d applicata: %s", version, name)
+
+
 with app.app_context():
     db.create_all()
+    run_migrations()
+
+    # contatori di team: backfill delle colonne nuove e riallineamento dopo un riavvio
+    lobby_recount_players()
+
+    # partite in corso al riavvio: lo scheduler le chiuderà alla scadenza
+    for active_lobby in Lobby.query.filter_by(status="ACTIVE").all():
+        match_scheduler.schedule_lobby(active_lobby)
+
+    # seed della mappa di default per le lobby
+    if not TargetTemplate.query.filter_by(name=DEFAULT_TARGET_TEMPLATE).first():
+        create_target_template(DEFAULT_TARGET_TEMPLATE, default_template_points())
+        db.session.commit()
 
     # seed target globali se non esistono
     if not Target.query.first():
@@ -304,7 +3664,9 @@ def create_private_lobby():
     if not data:
         return jsonify({"message": "JSON mancante"}), 400
 
-    user_id = data.get("user_id")
+    user_id, claims, err = request_user(data.get("user_id"))
+    if err:
+        return err
     if not user_id:
         return jsonify({"message": "User ID mancante"}), 400
 
@@ -315,17 +3677,29 @@ def create_private_lobby():
     if user.lobby_id:
         return jsonify({"message": "Sei già in una lobby"}), 400
 
-    code = generate_lobby_code()
-
-    lobby = Lobby(
-        is_private=True,
-        join_code=code,
-        status="WAITING",
-        player_count=1
+    template = None
+    if data.get("template"):
+        template = TargetTemplate.query.filter_by(name=data["template"]).first()
+        if not template:
+            return jsonify({"message": "Template non trovato"}), 404
+
+    # flush: ottieni lobby.id; un codice preso da un altro processo nel frattempo viene sostituito
+    lobby = add_with_unique_value(
+        lambda code: Lobby(
+            is_private=True,
+            join_code=code,
+            status="WAITING",
+            player_count=1,
+            players_red=0,
+            players_blue=0,
+            template_id=template.id if template else None,
+            owner_id=user.id
+        ),
+        lobby_code_pool.take,
     )
-
-    db.session.add(lobby)
-    db.session.flush()  # ottieni lobby.id
+    if lobby is None:
+        return jsonify({"message": "Impossibile generare il codice lobby, riprova"}), 503
+    code = lobby.join_code
 
     user.lobby_id = lobby.id
     user.team = None
@@ -334,6 +3708,10 @@ def create_private_lobby():
     if err:
         return err
 
+    roster_tracker.touch(lobby.id, user.id, profile=True)
+    refresh_token_for(user)
+    lobby_hub.publish(lobby.id, "player", lobby_user_payload(user, time.time()))
+
     return jsonify({
         "message": "Lobby privata creata",
         "lobby_id": lobby.id,
@@ -350,6 +3728,12 @@ def delete_lobby(lobby_id):
     db.session.delete(lobby)
     db.session.commit()
 
+    roster_tracker.drop_lobby(lobby_id)
+    lobby_actors.drop(lobby_id)
+    release_lobby_resources(lobby_id)
+    lobby_list_cache.invalidate()
+    lobby_hub.publish(lobby_id, "lobby_closed", {"lobby_id": lobby_id})
+
     return jsonify({"message": "Lobby eliminata con successo"}), 200
 
 @app.route("/lobby/join_by_code", methods=["POST"])
@@ -358,7 +3742,9 @@ def join_lobby_by_code():
     if not data:
         return jsonify({"message": "JSON mancante"}), 400
 
-    user_id = data.get("user_id")
+    user_id, claims, err = request_user(data.get("user_id"))
+    if err:
+        return err
     code = (data.get("code") or "").strip().upper()
 
     if not user_id or not code:
@@ -375,16 +3761,11 @@ def join_lobby_by_code():
     if not lobby:
         return jsonify({"message": "Codice lobby non valido"}), 404
 
-    if lobby.player_count >= LOBBY_MAX_PLAYERS:
-        return jsonify({"message": "Lobby piena"}), 409
-
-    user.lobby_id = lobby.id
-    user.team = None
-    lobby.player_count += 1
-
-    err = db_commit_or_error()
-    if err:
-        return err
+    # capienza e ingresso li verifica l'attore della lobby
+    body, code = lobby_actors.call(lobby.id, "join", user.id, False)
+    if code != 200:
+        return jsonify(body), code
+    refresh_token_for(user)
 
     return jsonify({
         "message": "Entrato nella lobby privata",
@@ -419,10 +3800,15 @@ def register():
     if User.query.filter_by(email=email).first():
         return jsonify({"message": "Email già registrata"}), 400
 
+    try:
+        password_hash = password_hasher.hash(password)
+    except PasswordHasherBusy:
+        return password_hasher_busy_response()
+
     new_user = User(
         username=username,
         email=email,
-        password_hash=generate_password_hash(password),
+        password_hash=password_hash,
     )
 
     db.session.add(new_user)
@@ -451,9 +3837,24 @@ def login():
     if user.banned:
         return jsonify({"message": "Utente bannato"}), 403
 
-    if not check_password_hash(user.password_hash, password):
+    try:
+        password_ok = password_hasher.check(user.password_hash, password)
+    except PasswordHasherBusy:
+        return password_hasher_busy_response()
+
+    if not password_ok:
         return jsonify({"message": "Credenziali errate"}), 401
 
+    # hash con metodo o costo vecchi: si aggiorna ora che la password è nota
+    if password_hasher.needs_rehash(user.password_hash):
+        try:
+            user.password_hash = password_hasher.hash(password)
+        except PasswordHasherBusy:
+            pass  # pool pieno: il login riesce comunque, si riprova al prossimo
+        else:
+            if db_commit_error_payload():
+                app.logger.warning("Rehash password fallito per utente %s", user.id)
+
     return jsonify({
         "message": "Login effettuato",
         "user": {
@@ -464,7 +3865,7 @@ def login():
             "admin": user.admin,
             "lobby_id": user.lobby_id
         },
-        "token": "fake-jwt-token-12345"
+        "token": issue_token(user)
     }), 200
 
 
@@ -479,12 +3880,7 @@ def google_login():
         return jsonify({"message": "Token mancante"}), 400
 
     try:
-        CLIENT_ID = os.getenv(
-            "GOOGLE_CLIENT_ID",
-            "143510152058-65kf5bucon42l77e7qk1bsgl70qki9so.apps.googleusercontent.com"
-        )
-
-        idinfo = id_token.verify_oauth2_token(token, google_requests.Request(), CLIENT_ID)
+        idinfo = google_verifier.verify(token)
 
         email = (idinfo.get("email") or "").strip().lower()
         name = (idinfo.get("name") or "Utente Google").strip()
@@ -505,23 +3901,29 @@ def google_login():
                     "score": user.score,
                     "admin": user.admin,
                     "lobby_id": user.lobby_id
-                }
+                },
+                "token": issue_token(user)
             }), 200
 
         base_username = name.replace(" ", "_").lower() or "utente_google"
-        new_username = base_username
-        counter = 1
-        while User.query.filter_by(username=new_username).first():
-            new_username = f"{base_username}_{counter}"
-            counter += 1
-
-        new_user = User(
-            username=new_username,
-            email=email,
-            password_hash=generate_password_hash(os.urandom(16).hex()),
+        password_hash = password_hasher.hash(os.urandom(16).hex())
+
+        tried = set()
+
+        def next_username():
+            # su IntegrityError si passa al suffisso successivo invece di riproporre lo stesso nome
+            username = free_username(base_username, tried)
+            tried.add(username.casefold())
+            return username
+
+        new_user = add_with_unique_value(
+            lambda username: User(username=username, email=email, password_hash=password_hash),
+            next_username,
         )
+        if new_user is None:
+            # collisioni ripetute: tipicamente lo stesso account creato da una richiesta parallela
+            return jsonify({"message": "Registrazione in corso, riprova il login"}), 409
 
-        db.session.add(new_user)
         err = db_commit_or_error()
         if err:
             return err
@@ -535,11 +3937,16 @@ def google_login():
                 "score": new_user.score,
                 "admin": new_user.admin,
                 "lobby_id": new_user.lobby_id
-            }
+            },
+            "token": issue_token(new_user)
         }), 200
 
     except ValueError:
         return jsonify({"message": "Token Google non valido"}), 401
+    except PasswordHasherBusy:
+        return password_hasher_busy_response()
+    except GoogleCertsUnavailable:
+        return jsonify({"message": "Verifica Google non disponibile, riprova tra poco"}), 503
     except Exception as e:
         db.session.rollback()
         return jsonify({"message": f"Errore interno del server: {str(e)}"}), 500
@@ -549,21 +3956,27 @@ def google_login():
 
 @app.route("/user/<int:user_id>", methods=["GET"])
 def get_user_details(user_id):
+    user_id, claims, err = request_user(user_id)
+    if err:
+        return err
+
     user = User.query.get(user_id)
     if not user:
         return jsonify({"message": "Utente non trovato"}), 404
     if user.banned:
         return jsonify({"message": "Utente bannato"}), 403
 
+    lat, lon, last_active = position_store.current(user)
+
     return jsonify({
         "id": user.id,
         "username": user.username,
         "email": user.email,
         "team": user.team,
         "score": user.score,
-        "lat": user.lat,
-        "lon": user.lon,
-        "last_active": user.last_active,
+        "lat": lat,
+        "lon": lon,
+        "last_active": last_active,
         "avatar_seed": user.avatar_seed,
         "admin": user.admin,
         "lobby_id": user.lobby_id
@@ -576,6 +3989,11 @@ def update_user_details(user_id):
     if not data:
         return jsonify({"message": "JSON mancante o non valido"}), 400
 
+    # con un token valido si può modificare solo il proprio profilo (403 se l'id nel path è un altro)
+    user_id, claims, err = request_user(user_id)
+    if err:
+        return err
+
     user = User.query.get(user_id)
     if not user:
         return jsonify({"message": "Utente non trovato"}), 404
@@ -604,16 +4022,26 @@ def update_user_details(user_id):
     if err:
         return err
 
+    roster_tracker.touch(user.lobby_id, user.id, profile=True)
+    lobby_hub.publish(user.lobby_id, "player", lobby_user_payload(user, time.time()))
+
     return jsonify({"message": "Profilo aggiornato con successo"}), 200
 
 
 # ---------- LOBBIES ----------
 
-@app.route("/lobbies", methods=["GET"])
-def get_lobbies():
-    lobbies = Lobby.query.filter(Lobby.status.in_(['WAITING', 'ACTIVE']),Lobby.is_private == False).all()
+def build_lobby_list(statuses, min_free_slots, page, per_page):
+    query = Lobby.query.filter(Lobby.status.in_(statuses), Lobby.is_private == False)
+    if min_free_slots:
+        query = query.filter(Lobby.player_count <= LOBBY_MAX_PLAYERS - min_free_slots)
+
+    total = None
+    if page:
+        total = query.count()
+        query = query.order_by(Lobby.id).limit(per_page).offset((page - 1) * per_page)
+
     result = []
-    for lobby in lobbies:
+    for lobby in query.all():
         result.append({
             "id": lobby.id,
             "status": lobby.status,
@@ -622,7 +4050,50 @@ def get_lobbies():
             "targets_red": lobby.targets_red,
             "targets_blue": lobby.targets_blue,
         })
-    return jsonify(result), 200
+
+    body = json.dumps(result, separators=(",", ":")).encode("utf-8")
+    return body, total if total is not None else len(result)
+
+
+@app.route("/lobbies", methods=["GET"])
+def get_lobbies():
+    """
+    Lobby pubbliche in attesa o in corso. Filtri opzionali: status=WAITING|ACTIVE, free_slots=N
+    (almeno N posti liberi), page/per_page. Risposta con ETag: con If-None-Match invariato → 304.
+    """
+    statuses = ["WAITING", "ACTIVE"]
+    raw_status = (request.args.get("status") or "").strip().upper()
+    if raw_status:
+        statuses = sorted(set(raw_status.split(",")))
+        if not set(statuses) <= {"WAITING", "ACTIVE"}:
+            return jsonify({"message": "status non valido (WAITING, ACTIVE)"}), 400
+
+    try:
+        min_free_slots = int(request.args.get("free_slots", 0))
+        page = int(request.args.get("page", 0))
+        per_page = int(request.args.get("per_page", 20))
+    except ValueError:
+        return jsonify({"message": "Parametri di paginazione non validi"}), 400
+
+    if min_free_slots < 0 or page < 0 or not 1 <= per_page <= LOBBY_LIST_MAX_PER_PAGE:
+        return jsonify({"message": "Parametri di paginazione non validi"}), 400
+
+    key = (tuple(statuses), min_free_slots, page, per_page if page else 0)
+    body, etag, total = lobby_list_cache.get(
+        key, lambda: build_lobby_list(statuses, min_free_slots, page, per_page)
+    )
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, status=200, mimetype="application/json")
+
+    response.set_etag(etag)  # Cache-Control (ritmo di poll) lo aggiunge _poll_hints
+    response.headers["X-Total-Count"] = str(total)
+    if page:
+        response.headers["X-Page"] = str(page)
+        response.headers["X-Per-Page"] = str(per_page)
+    return response
 
 
 @app.route("/lobby/join", methods=["POST"])
@@ -631,7 +4102,9 @@ def join_lobby():
     if not data:
         return jsonify({"message": "JSON mancante"}), 400
 
-    user_id = data.get("user_id")
+    user_id, claims, err = request_user(data.get("user_id"))
+    if err:
+        return err
     lobby_id_raw = data.get("lobby_id")
 
     if not user_id:
@@ -660,18 +4133,13 @@ def join_lobby():
             return jsonify({"message": "Già in questa lobby", "lobby_id": str(target_lobby.id), "team": user.team}), 200
         return jsonify({"message": "Lascia la lobby corrente prima di unirtene ad un'altra"}), 400
 
-    if target_lobby.player_count >= LOBBY_MAX_PLAYERS:
-        return jsonify({"message": "Lobby piena"}), 409
-
-    user.lobby_id = target_lobby.id
-    user.team = None  # reset team
-    target_lobby.player_count += 1
-
-    err = db_commit_or_error()
-    if err:
-        return err
+    # capienza, stato e ingresso (team azzerato) li verifica l'attore della lobby
+    body, code = lobby_actors.call(lobby_id, "join", user.id)
+    if code != 200:
+        return jsonify(body), code
+    refresh_token_for(user)
 
-    return jsonify({"message": "Lobby assegnata", "lobby_id": str(target_lobby.id)}), 200
+    return jsonify({"message": "Lobby assegnata", "lobby_id": str(lobby_id)}), 200
 
 
 @app.route("/lobby/leave", methods=["POST"])
@@ -680,10 +4148,16 @@ def leave_lobby():
     if not data:
         return jsonify({"message": "JSON mancante"}), 400
 
-    user_id = data.get("user_id")
+    user_id, claims, err = request_user(data.get("user_id"))
+    if err:
+        return err
     if not user_id:
         return jsonify({"message": "User ID mancante"}), 400
 
+    forward = lobby_owner_redirect(routing_lobby(user_id, claims))
+    if forward:
+        return forward
+
     user = User.query.get(user_id)
     if not user:
         return jsonify({"message": "Utente non trovato"}), 404
@@ -692,91 +4166,231 @@ def leave_lobby():
     if not lobby_id:
         return jsonify({"message": "Utente non è in una lobby", "success": True}), 200
 
+    # uscita, contatori ed eventuale annullamento della partita nell'attore della lobby
+    body, code = lobby_actors.call(lobby_id, "leave", user.id)
+    if code == 200:
+        refresh_token_for(user)
+    return jsonify(body), code
+
+
+def lobby_roster(lobby_id: int, since, now: float):
+    """
+    Giocatori della lobby per /users e /sync: (payload, rimossi, cursore, completo, id_statici).
+    Con un cursore valido solo i cambiati da allora (id_statici: chi ha anche nome/avatar nuovi),
+    altrimenti lo snapshot completo (id_statici None: tutti).
+    """
+    delta = roster_tracker.changes_since(lobby_id, since) if since else None
+
+    # ---------- SNAPSHOT COMPLETO ----------
+    if delta is None:
+        cursor = roster_tracker.cursor()
+        users = User.query.filter_by(lobby_id=lobby_id, banned=False).all()
+        for u in users:
+            roster_tracker.track(u.id, lobby_id)
+        position_store.seed_many(users)
+        return lobby_user_payloads(users, now), [], cursor, True, None
+
+    # ---------- DELTA ----------
+    changed_ids, removed_ids, members, since_ts, cursor, profile_ids = delta
+
+    # utenti diventati inattivi dopo il cursore (nessun evento li segnala: è il tempo che passa)
+    changed = set(changed_ids)
+    for uid, last_active in position_store.last_active_many(members).items():
+        if since_ts - ACTIVE_SECONDS < last_active <= now - ACTIVE_SECONDS:
+            changed.add(uid)
+
+    users = []
+    if changed:
+        users = User.query.filter(
+            User.id.in_(changed), User.lobby_id == lobby_id, User.banned == False
+        ).all()
+
+    # cambiati ma non più visibili qui (uscita da un altro processo, ban): vanno rimossi
+    removed = set(removed_ids) | (changed - {u.id for u in users})
+    return lobby_user_payloads(users, now), sorted(removed), cursor, False, profile_ids
+
+
+@app.route("/lobby/<int:lobby_id>/users", methods=["GET"])
+def get_lobby_users(lobby_id):
+    # i delta per cursore sono precisi sul nodo proprietario, che riceve le scritture della lobby
+    forward = lobby_owner_redirect(lobby_id)
+    if forward:
+        return forward
+
     lobby = Lobby.query.get(lobby_id)
+    if not lobby:
+        return jsonify({"message": "Lobby non trovata"}), 404
 
-    # rimuovi utente
-    user.lobby_id = None
-    user.team = None
+    since = request.args.get("since")
+    users, removed, cursor, full, profile_ids = lobby_roster(lobby_id, since, time.time())
 
-    if lobby:
-        lobby.player_count = max(0, lobby.player_count - 1)
+    if wire_requested():
+        return wire_roster(users, removed, cursor, full=full, static_ids=profile_ids), 200
 
-    err = db_commit_or_error()
-    if err:
-        return err
+    # Senza cursore: formato storico (lista), il cursore viaggia nell'header
+    if since is None:
+        response = jsonify(users)
+        response.headers["X-Roster-Cursor"] = cursor
+        return response, 200
 
-    # se era ACTIVE: verifica requisiti minimi (1 per team)
-    lobby = Lobby.query.get(lobby_id)
-    if lobby and lobby.status == "ACTIVE":
-        red_count = User.query.filter_by(lobby_id=lobby_id, team="RED").count()
-        blue_count = User.query.filter_by(lobby_id=lobby_id, team="BLUE").count()
+    return jsonify({"full": full, "cursor": cursor, "users": users, "removed": removed}), 200
 
-        if red_count < 1 or blue_count < 1:
-            lobby.status = "WAITING"
+@app.route("/lobby/<int:lobby_id>/status", methods=["GET"])
+def get_lobby_status(lobby_id):
+    forward = lobby_owner_redirect(lobby_id)
+    if forward:
+        return forward
 
-            # cancella target lobby + reset contatori
-            Target.query.filter_by(lobby_id=lobby_id).delete()
-            lobby.targets_red = 0
-            lobby.targets_blue = 0
+    lobby = lobby_view(lobby_id)
+    if not lobby:
+        return jsonify({"message": "Lobby non trovata"}), 404
 
-            err2 = db_commit_or_error()
-            if err2:
-                return err2
+    # sola lettura: la chiusura a tempo è dello scheduler (qui al più lo si ricorda della scadenza)
+    match_scheduler.schedule_lobby(lobby)
 
-            return jsonify({"message": "Lobby lasciata. Partita annullata per mancanza giocatori.", "success": True}), 200
+    return jsonify(lobby_status_payload(lobby)), 200
 
-    return jsonify({"message": "Lobby lasciata con successo", "success": True}), 200
 
+@app.route("/lobby/<int:lobby_id>/sync", methods=["POST"])
+def sync_lobby(lobby_id):
+    """
+    Un ciclo di polling della mappa in una richiesta: heartbeat, stato della partita, target e giocatori.
+    Corpo: {"user_id", "lat", "lon", "versions"}, con lat/lon e versions opzionali. "versions" è
+    quello dell'ultima risposta: i target invariati vengono omessi e i giocatori arrivano come delta
+    dal cursore (vuoto = sezione omessa). Nessun commit: la posizione va nel buffer, il resto è lettura.
+    """
+    data = get_json()
+    if data is None:
+        return jsonify({"message": "JSON non valido"}), 400
 
-@app.route("/lobby/<int:lobby_id>/users", methods=["GET"])
-def get_lobby_users(lobby_id):
-    lobby = Lobby.query.get(lobby_id)
+    user_id, claims, err = request_user(data.get("user_id"))
+    if err:
+        return err
+
+    try:
+        user_id = int(user_id)
+    except (ValueError, TypeError):
+        return jsonify({"message": "Utente non trovato"}), 404
+
+    forward = lobby_owner_redirect(lobby_id)
+    if forward:
+        return forward
+
+    lobby = lobby_view(lobby_id)
     if not lobby:
         return jsonify({"message": "Lobby non trovata"}), 404
 
-    users = User.query.filter_by(lobby_id=lobby_id, banned=False).all()
+    err = track_user(user_id, claims)
+    if err:
+        body, code = err
+        return jsonify(body), code
+    if roster_tracker.lobby_of(user_id) != lobby_id:
+        return jsonify({"message": "Non sei in questa lobby"}), 403
+
+    versions = data.get("versions")
+    if not isinstance(versions, dict):
+        versions = {}
     now = time.time()
-    ACTIVE_SECONDS = 20
-
-    results = []
-    for u in users:
-        is_active = (now - u.last_active) < ACTIVE_SECONDS
-
-        # Se l'utente non ha mai inviato una posizione valida,
-        # restituiamo None così il frontend può ignorare il marker
-        payload = {
-            "id": u.id,
-            "username": u.username,
-            "team": u.team,
-            "avatar_seed": u.avatar_seed,
-            "is_active": is_active,
-            "lat": u.lat if u.lat != 0.0 else None,
-            "lon": u.lon if u.lon != 0.0 else None
-        }
-        results.append(payload)
-
-    return jsonify(results), 200
+    result = {"lobby_id": lobby_id}
+
+    # ---------- HEARTBEAT ----------
+    if "lat" in data or "lon" in data:
+        try:
+            lat = float(data.get("lat", 0))
+            lon = float(data.get("lon", 0))
+        except (ValueError, TypeError):
+            result["position"] = {"success": False, "message": "Coordinate non numeriche"}
+        else:
+            result["position"], _ = record_position(user_id, lat, lon, claims)
+
+    # ---------- STATO E CONTATORI ----------
+    match_scheduler.schedule_lobby(lobby)
+    result["status"] = lobby_status_payload(lobby)
+
+    # ---------- TARGET (omessi se invariati) ----------
+    targets = [target_payload(t) for t in Target.query.filter(Target.lobby_id == lobby_id).all()]
+    targets_version = hashlib.sha1(
+        json.dumps(targets, sort_keys=True, separators=(",", ":")).encode()
+    ).hexdigest()[:20]
+    if versions.get("targets") != targets_version:
+        result["targets"] = targets
+
+    # ---------- GIOCATORI (delta dal cursore) ----------
+    since = versions.get("users")
+    users, removed, cursor, full, _ = lobby_roster(lobby_id, since if isinstance(since, str) else None, now)
+    if full or users or removed:
+        result["users"] = {"full": full, "users": users, "removed": removed}
+
+    result["versions"] = {"targets": targets_version, "users": cursor}
+    result["poll_interval"] = poll_pacer.interval()  # risposta a una POST: il max-age non si applica
+    return jsonify(result), 200
 
-@app.route("/lobby/<int:lobby_id>/status", methods=["GET"])
-def get_lobby_status(lobby_id):
+def lobby_stream_snapshot(lobby: Lobby) -> dict:
+    now = time.time()
+    users = User.query.filter_by(lobby_id=lobby.id, banned=False).all()
+    targets = Target.query.filter_by(lobby_id=lobby.id).all()
+
+    snapshot = lobby_status_payload(lobby_actors.view(lobby.id) or lobby)
+    snapshot["users"] = lobby_user_payloads(users, now)
+    snapshot["targets"] = [target_payload(t) for t in targets]
+    return snapshot
+
+
+@app.route("/lobby/<int:lobby_id>/stream", methods=["GET"])
+def stream_lobby(lobby_id):
+    """
+    Stream Server-Sent Events dello stato live della lobby: uno snapshot iniziale,
+    poi target, contatori, posizioni, giocatori e fine partita man mano che accadono.
+    Il polling (/sync, oppure /targets, /status e /users) resta disponibile come fallback.
+    """
     lobby = Lobby.query.get(lobby_id)
     if not lobby:
         return jsonify({"message": "Lobby non trovata"}), 404
 
-    check_and_finish_match(lobby)
-
-    time_left = -1
-    if lobby.status == "ACTIVE" and lobby.match_start_time:
-        elapsed = time.time() - lobby.match_start_time
-        time_left = max(0, MATCH_DURATION_SECONDS - elapsed)
+    subscription = lobby_hub.subscribe(lobby_id)
+    snapshot = lobby_stream_snapshot(lobby)
+
+    # lo stream vive a lungo: la connessione DB torna subito al pool
+    db.session.remove()
+
+    # la fine partita arriva come evento match_end dallo scheduler
+    match_scheduler.schedule_lobby(lobby)
+
+    def generate():
+        nonlocal snapshot
+        try:
+            yield sse_message("snapshot", snapshot)
+            while True:
+                if subscription.overflowed:
+                    # client troppo lento: svuota la coda e rimanda lo stato completo
+                    with app.app_context():
+                        current = Lobby.query.get(lobby_id)
+                        if not current:
+                            yield sse_message("lobby_closed", {"lobby_id": lobby_id})
+                            return
+                        while not subscription.queue.empty():
+                            subscription.queue.get_nowait()
+                        subscription.overflowed = False
+                        snapshot = lobby_stream_snapshot(current)
+                    yield sse_message("snapshot", snapshot)
+
+                try:
+                    event_id, event, data = subscription.queue.get(timeout=LOBBY_STREAM_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+
+                yield sse_message(event, data, event_id)
+                if event == "lobby_closed":
+                    return
+        finally:
+            lobby_hub.unsubscribe(lobby_id, subscription)
+
+    return Response(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
 
-    return jsonify({
-        "status": lobby.status,
-        "winner_team": lobby.winner_team,
-        "time_left": time_left,
-        "targets_red": lobby.targets_red,
-        "targets_blue": lobby.targets_blue
-    }), 200
 
 @app.route("/lobby/<int:lobby_id>/endgame", methods=["GET"])
 def get_endgame(lobby_id):
@@ -784,25 +4398,66 @@ def get_endgame(lobby_id):
     if not lobby:
         return jsonify({"message": "Lobby non trovata"}), 404
 
-    if lobby.status != "FINISHED":
+    state = lobby_status_payload(lobby)
+    if state["status"] != "FINISHED":
         return jsonify({"message": "La partita non è ancora terminata"}), 400
 
     return jsonify({
-        "status": lobby.status,
-        "winner_team": lobby.winner_team,
+        "status": state["status"],
+        "winner_team": state["winner_team"],
         "targets_red": lobby.targets_red,
         "targets_blue": lobby.targets_blue,
-        "ended_at": lobby.match_start_time + MATCH_DURATION_SECONDS
+        "ended_at": lobby.match_start_time + MATCH_DURATION_SECONDS,
+        "stats": match_hack_stats(lobby),
     }), 200
 
 
+@app.route("/lobby/<int:lobby_id>/template", methods=["POST"])
+def set_lobby_template(lobby_id):
+    data = get_json()
+    if not data or not data.get("template"):
+        return jsonify({"message": "Template mancante"}), 400
+
+    user_id, claims, err = request_user(data.get("user_id"))
+    if err:
+        return err
+    if not user_id:
+        return jsonify({"message": "User ID mancante"}), 400
+
+    user = User.query.get(user_id)
+    if not user or user.banned:
+        return jsonify({"message": "Utente non valido"}), 403
+
+    lobby = Lobby.query.get(lobby_id)
+    if not lobby:
+        return jsonify({"message": "Lobby non trovata"}), 404
+    # lobby privata: solo chi l'ha creata; lobby pubbliche: solo gli admin
+    if lobby.owner_id != user.id and not user.admin:
+        return jsonify({"message": "Solo chi ha creato la lobby può cambiarne la mappa"}), 403
+    if lobby.status != "WAITING":
+        return jsonify({"message": "La mappa si può cambiare solo prima dell'inizio della partita"}), 409
+
+    template = TargetTemplate.query.filter_by(name=data["template"]).first()
+    if not template:
+        return jsonify({"message": "Template non trovato"}), 404
+
+    lobby.template_id = template.id
+    err = db_commit_or_error()
+    if err:
+        return err
+
+    return jsonify({"message": f"Mappa impostata: {template.name}", "template": template.name}), 200
+
+
 @app.route("/set_team", methods=["POST"])
 def set_team():
     data = get_json()
     if not data:
         return jsonify({"success": False, "message": "JSON mancante o non valido"}), 400
 
-    user_id = data.get("user_id")
+    user_id, claims, err = request_user(data.get("user_id"))
+    if err:
+        return err
     team = (data.get("team") or "").strip().upper()
 
     if not user_id or not team:
@@ -811,6 +4466,10 @@ def set_team():
     if team not in ALLOWED_TEAMS:
         return jsonify({"success": False, "message": "Team non valido (usa RED o BLUE)"}), 400
 
+    forward = lobby_owner_redirect(routing_lobby(user_id, claims))
+    if forward:
+        return forward
+
     user = User.query.get(user_id)
     if not user:
         return jsonify({"success": False, "message": "Utente non trovato"}), 404
@@ -823,90 +4482,104 @@ def set_team():
         err = db_commit_or_error()
         if err:
             return err
+        roster_tracker.touch(None, user.id)
+        refresh_token_for(user)
         return jsonify({"success": True, "message": f"Team aggiornato a {team}"}), 200
 
     # ---------- UTENTE IN LOBBY ----------
-    lobby = Lobby.query.get(user.lobby_id)
-    if not lobby:
-        return jsonify({"success": False, "message": "Lobby non valida"}), 400
-
-    # limite dimensione team
-    team_count = User.query.filter_by(
-        lobby_id=lobby.id,
-        team=team
-    ).count()
+    # limite dimensione team e avvio partita nell'attore della lobby
+    body, code = lobby_actors.call(user.lobby_id, "set_team", user.id, team)
+    if code == 200:
+        refresh_token_for(user)
+    return jsonify(body), code
 
-    if user.team != team and team_count >= LOBBY_TEAM_SIZE:
-        return jsonify({
-            "success": False,
-            "message": f"Team {team} completo nella lobby"
-        }), 409
-
-    user.team = team
 
-    err = db_commit_or_error()
-    if err:
-        return err
+# ---------- TARGETS ----------
 
-    # ---------- VERIFICA AVVIO MATCH ----------
-    total_players = User.query.filter_by(lobby_id=lobby.id).count()
-    red_count = User.query.filter_by(lobby_id=lobby.id, team="RED").count()
-    blue_count = User.query.filter_by(lobby_id=lobby.id, team="BLUE").count()
+def targets_scope_for(user_id, claims=None):
+    """Lobby dei target visibili all'utente: quella in cui gioca, altrimenti None (target globali)."""
+    if claims:
+        return claims["lobby"]  # token verificato: nessun lookup
+    if user_id:
+        user = User.query.get(user_id)
+        if user and user.lobby_id:
+            return user.lobby_id
+    return None
 
-    should_start = False
 
-    # lobby privata → basta 2 giocatori
-    if lobby.is_private and total_players >= 2:
-        should_start = True
+def routing_lobby(user_id, claims=None):
+    """Lobby su cui instradare la richiesta: dai claim o dalla memoria, senza accessi al DB."""
+    if claims:
+        return claims["lobby"]
+    try:
+        return roster_tracker.lobby_of(int(user_id))
+    except (ValueError, TypeError):
+        return None
 
-    # lobby pubblica → almeno 1 per team
-    if not lobby.is_private and red_count >= 1 and blue_count >= 1:
-        should_start = True
 
-    if lobby.status == "WAITING" and should_start:
-        lobby.status = "ACTIVE"
-        lobby.match_start_time = time.time()
+def targets_nearby(lobby_id, lat, lon, radius_m, limit):
+    hits = target_index.nearby(lobby_id, lat, lon, radius_m, limit)
+    if not hits:
+        return []
 
-        err2 = db_commit_or_error()
-        if err2:
-            return err2
+    by_id = {t.id: t for t in Target.query.filter(Target.id.in_([tid for tid, _ in hits])).all()}
+    results = []
+    for tid, d in hits:
+        t = by_id.get(tid)
+        if t:  # può mancare se eliminato dopo la costruzione dell'indice
+            payload = target_payload(t)
+            payload["distance_m"] = round(d, 1)
+            results.append(payload)
+    return results
 
-        # genera target lobby
-        err3 = generate_lobby_targets(lobby.id)
-        if err3:
-            return err3
 
-        return jsonify({
-            "success": True,
-            "message": "Match avviato",
-            "lobby_status": lobby.status
-        }), 200
+def parse_nearby_args():
+    """(lat, lon, radius_m, limit) dalla query string, oppure (None, errore)."""
+    try:
+        lat = float(request.args["lat"])
+        lon = float(request.args["lon"])
+        radius_m = float(request.args.get("radius_m", 1000))
+        limit = int(request.args.get("limit", NEARBY_DEFAULT_LIMIT))
+    except (KeyError, ValueError, TypeError):
+        return None, (jsonify({"message": "Parametri non validi (lat, lon, radius_m, limit)"}), 400)
 
-    return jsonify({
-        "success": True,
-        "message": f"Team aggiornato a {team}"
-    }), 200
+    if radius_m <= 0 or radius_m > NEARBY_MAX_RADIUS_M:
+        return None, (jsonify({"message": f"radius_m deve essere tra 0 e {NEARBY_MAX_RADIUS_M}"}), 400)
 
+    return (lat, lon, radius_m, max(1, limit)), None
 
-# ---------- TARGETS ----------
 
 @app.route("/targets", methods=["GET"])
 def get_targets():
-    user_id = request.args.get("user_id", type=int)
+    user_id, claims, err = request_user(request.args.get("user_id", type=int))
+    if err:
+        return err
+    lobby_id = targets_scope_for(user_id, claims)
 
-    if user_id:
-        user = User.query.get(user_id)
-        if user and user.lobby_id:
-            targets = Target.query.filter_by(lobby_id=user.lobby_id).all()
-        else:
-            targets = Target.query.filter(Target.lobby_id == None).all()
-    else:
-        targets = Target.query.filter(Target.lobby_id == None).all()
+    # filtro spaziale opzionale: /targets?user_id=&lat=&lon=&radius_m=
+    if "lat" in request.args or "lon" in request.args:
+        args, err = parse_nearby_args()
+        if err:
+            return err
+        return jsonify(targets_nearby(lobby_id, *args)), 200
 
-    return jsonify([
-        {"id": t.id, "name": t.name, "lat": t.lat, "lon": t.lon, "owner": t.owner_team, "lobby_id": t.lobby_id}
-        for t in targets
-    ]), 200
+    targets = Target.query.filter(Target.lobby_id == lobby_id).all()
+    if wire_requested():
+        return wire_targets(targets, with_static=request.args.get("static") != "0"), 200
+    return jsonify([target_payload(t) for t in targets]), 200
+
+
+@app.route("/targets/nearby", methods=["GET"])
+def get_targets_nearby():
+    args, err = parse_nearby_args()
+    if err:
+        return err
+
+    user_id, claims, err = request_user(request.args.get("user_id", type=int))
+    if err:
+        return err
+    lobby_id = targets_scope_for(user_id, claims)
+    return jsonify(targets_nearby(lobby_id, *args)), 200
 
 
 @app.route("/hack", methods=["POST"])
@@ -915,62 +4588,20 @@ def hack_target():
     if not data:
         return jsonify({"message": "JSON non valido"}), 400
 
-    user_id = data.get("user_id")
+    user_id, claims, err = request_user(data.get("user_id"))
+    if err:
+        return err
     target_id = data.get("target_id")
 
     if not user_id or not target_id:
         return jsonify({"message": "Dati mancanti (user_id, target_id)"}), 400
 
-    user = User.query.get(user_id)
-    target = Target.query.get(target_id)
-
-    if not user or user.banned:
-        return jsonify({"message": "Utente non valido"}), 403
-    if not target:
-        return jsonify({"message": "Target non trovato"}), 404
-    if not user.team:
-        return jsonify({"message": "Utente senza team"}), 400
-
-    # target accessibile solo se globale o della stessa lobby
-    if target.lobby_id is not None and target.lobby_id != user.lobby_id:
-        return jsonify({"message": "Target non accessibile"}), 403
-
-    # se target è di lobby, l'utente deve essere in lobby
-    if target.lobby_id is not None and user.lobby_id is None:
-        return jsonify({"message": "Devi essere in una lobby per hackare questo target"}), 403
-
-    lobby = Lobby.query.get(user.lobby_id)
-    if lobby and lobby.status == "FINISHED":
-        return jsonify({"message": "La partita è già terminata"}), 400
-
-    old_owner = target.owner_team
-    new_owner = user.team
-
-    # log sempre (anche se già tuo? a te la scelta: qui logghiamo solo se cambia)
-    if old_owner == new_owner:
-        return jsonify({"message": "Target già conquistato dal tuo team"}), 200
-
-    log = HackLog(user_id=user.id, target_id=target.id, team=user.team)
-    db.session.add(log)
-
-    # aggiorna contatori SOLO per target di lobby (per i globali non hai contatori lobby)
-    if target.lobby_id is not None:
-        lobby_adjust_target_counters(lobby, old_owner, new_owner)
-
-    # aggiorna target
-    target.owner_team = new_owner
-    target.last_hacked = time.time()
-
-    # Condizione di vittoria #1: 10 target
-    if lobby and (lobby.targets_red >= TARGET_WIN_CONDITION or lobby.targets_blue >= TARGET_WIN_CONDITION):
-        lobby.status = "FINISHED"
-        lobby.winner_team = new_owner
-
-    err = db_commit_or_error()
-    if err:
-        return err
+    forward = lobby_owner_redirect(routing_lobby(user_id, claims))
+    if forward:
+        return forward
 
-    return jsonify({"message": "Hack registrato"}), 200
+    body, code = apply_hack(user_id, target_id)
+    return jsonify(body), code
 
 
 # ---------- LIVE POSITIONS ----------
@@ -980,37 +4611,27 @@ def update_position():
     if not data:
         return jsonify({"message": "JSON non valido"}), 400
 
-    user_id = data.get("user_id")
+    user_id, claims, err = request_user(data.get("user_id"))
+    if err:
+        return err
+
+    try:
+        user_id = int(user_id)
+    except (ValueError, TypeError):
+        return jsonify({"message": "Utente non trovato"}), 404
+
     try:
         lat = float(data.get("lat", 0))
         lon = float(data.get("lon", 0))
     except (ValueError, TypeError):
         return jsonify({"message": "Coordinate non numeriche"}), 400
 
-    user = User.query.get(user_id)
-    if not user:
-        return jsonify({"message": "Utente non trovato"}), 404
-
-    # 1. Protezione contro coordinate 0,0 (spesso errori GPS)
-    if lat == 0.0 or lon == 0.0:
-        return jsonify({"success": False, "message": "Coordinate GPS non valide"}), 400
-
-    # 2. Gestione Timestamp (Usa il tempo del server per la validazione)
-    # Se proprio vuoi usare il timestamp del client per l'ordine,
-    # assicurati che siano entrambi in secondi.
-    current_server_time = time.time()
+    forward = lobby_owner_redirect(routing_lobby(user_id, claims))
+    if forward:
+        return forward
 
-    # Aggiorniamo sempre la posizione se il pacchetto è valido
-    user.lat = lat
-    user.lon = lon
-    user.last_active = current_server_time # <--- Importante: usa il tempo del server qui
-
-    try:
-        db.session.commit()
-        return jsonify({"success": True}), 200
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({"success": False, "message": str(e)}), 500
+    body, code = record_position(user_id, lat, lon, claims)
+    return jsonify(body), code
 # ---------- ADMIN ----------
 
 @app.route("/admin/users", methods=["GET"])
@@ -1032,6 +4653,9 @@ def ban_user(user_id):
     err = db_commit_or_error()
     if err:
         return err
+    token_revocations.revoke(user.id)
+    roster_tracker.remove(user.lobby_id, user.id)
+    lobby_hub.publish(user.lobby_id, "player_left", {"id": user.id})
     return jsonify({"message": f"Utente {user.username} bannato"}), 200
 
 
@@ -1045,6 +4669,9 @@ def unban_user(user_id):
     err = db_commit_or_error()
     if err:
         return err
+    token_revocations.restore(user.id)
+    roster_tracker.touch(user.lobby_id, user.id, profile=True)
+    lobby_hub.publish(user.lobby_id, "player", lobby_user_payload(user, time.time()))
     return jsonify({"message": f"Utente {user.username} sbannato"}), 200
 
 
@@ -1072,6 +4699,8 @@ def create_target():
     if err:
         return err
 
+    target_index.invalidate(None)
+
     return jsonify({"message": "Target creato"}), 200
 
 
@@ -1081,74 +4710,132 @@ def delete_target(target_id):
     if not target:
         return jsonify({"message": "Target non trovato"}), 404
 
+    lobby_id = target.lobby_id
     db.session.delete(target)
     err = db_commit_or_error()
     if err:
         return err
 
+    target_index.invalidate(lobby_id)
+
     return jsonify({"message": "Target eliminato"}), 200
 
 
-# ---------- DEBUG: RANDOM TARGETS (GLOBAL) ----------
+@app.route("/target_templates", methods=["GET"])
+def get_target_templates():
+    rows = (
+        db.session.query(TargetTemplate.id, TargetTemplate.name, func.count(TargetTemplatePoint.id))
+        .outerjoin(TargetTemplatePoint, TargetTemplatePoint.template_id == TargetTemplate.id)
+        .group_by(TargetTemplate.id, TargetTemplate.name)
+        .order_by(TargetTemplate.name)
+        .all()
+    )
+    return jsonify([
+        {"id": tid, "name": name, "targets": n, "default": name == DEFAULT_TARGET_TEMPLATE}
+        for tid, name, n in rows
+    ]), 200
 
-@app.route("/generate_random_targets", methods=["POST"])
-def generate_random_targets():
+
+@app.route("/admin/target_templates", methods=["POST"])
+def create_template():
     data = get_json()
     if not data:
-        return jsonify({"message": "JSON non valido"}), 400
+        return jsonify({"message": "JSON mancante"}), 400
 
-    lat = data.get("lat")
-    lon = data.get("lon")
-    count = int(data.get("count", 10))
-    radius_km = float(data.get("radius_km", 30))
+    name = (data.get("name") or "").strip()
+    points = parse_template_points(data.get("points"))
 
-    if lat is None or lon is None:
-        return jsonify({"message": "Dati mancanti (lat, lon)"}), 400
+    if not name or points is None:
+        return jsonify({"message": "Dati template non validi (name, points: [{name, lat, lon}])"}), 400
 
-    R = 6378.1  # km
+    if TargetTemplate.query.filter_by(name=name).first():
+        return jsonify({"message": "Template già esistente"}), 409
 
-    new_targets = []
-    for i in range(count):
-        radius_rad = radius_km / R
-        r = radius_rad * math.sqrt(random.random())
-        theta = 2 * math.pi * random.random()
-        lat_rad = math.radians(float(lat))
-        lon_rad = math.radians(float(lon))
+    template = create_target_template(name, points)
+    err = db_commit_or_error()
+    if err:
+        return err
 
-        new_lat_rad = math.asin(
-            math.sin(lat_rad) * math.cos(r) +
-            math.cos(lat_rad) * math.sin(r) * math.cos(theta)
-        )
-        new_lon_rad = lon_rad + math.atan2(
-            math.sin(theta) * math.sin(r) * math.cos(lat_rad),
-            math.cos(r) - math.sin(lat_rad) * math.sin(new_lat_rad)
-        )
+    return jsonify({"message": "Template creato", "id": template.id, "targets": len(points)}), 200
 
-        new_lat = math.degrees(new_lat_rad)
-        new_lon = math.degrees(new_lon_rad)
 
-        target_name = f"Obiettivo Casuale #{int(time.time()) % 1000 + i}"
+@app.route("/admin/target_templates/<int:template_id>", methods=["DELETE"])
+def delete_template(template_id):
+    template = TargetTemplate.query.get(template_id)
+    if not template:
+        return jsonify({"message": "Template non trovato"}), 404
+    if template.name == DEFAULT_TARGET_TEMPLATE:
+        return jsonify({"message": "Il template di default non può essere eliminato"}), 400
 
-        new_targets.append(Target(
-            name=target_name,
-            lat=new_lat,
-            lon=new_lon,
-            owner_team="NEUTRAL",
-            lobby_id=None
-        ))
+    # le lobby che lo usavano tornano alla mappa di default
+    Lobby.query.filter_by(template_id=template_id).update({"template_id": None})
+    TargetTemplatePoint.query.filter_by(template_id=template_id).delete()
+    db.session.delete(template)
+
+    err = db_commit_or_error()
+    if err:
+        return err
+
+    return jsonify({"message": "Template eliminato"}), 200
+
+
+# ---------- DEBUG: RANDOM TARGETS (GLOBAL) ----------
+
+@app.route("/generate_random_targets", methods=["POST"])
+def generate_random_targets():
+    data = get_json()
+    if not data:
+        return jsonify({"message": "JSON non valido"}), 400
+
+    if data.get("lat") is None or data.get("lon") is None:
+        return jsonify({"message": "Dati mancanti (lat, lon)"}), 400
+
+    try:
+        lat = float(data["lat"])
+        lon = float(data["lon"])
+        count = int(data.get("count", 10))
+        radius_km = float(data.get("radius_km", 30))
+        min_spacing_m = float(data.get("min_spacing_m", 0))
+    except (ValueError, TypeError):
+        return jsonify({"message": "Parametri non numerici"}), 400
+
+    if not 1 <= count <= RANDOM_TARGETS_MAX:
+        return jsonify({"message": f"count deve essere tra 1 e {RANDOM_TARGETS_MAX}"}), 400
+    if radius_km <= 0:
+        return jsonify({"message": "radius_km deve essere positivo"}), 400
+
+    lats, lons = random_points_in_cap(lat, lon, radius_km, count, min_spacing_m)
+
+    base = int(time.time()) % 1000
+    rows = [
+        {
+            "name": f"Obiettivo Casuale #{base + i}",
+            "lat": new_lat,
+            "lon": new_lon,
+            "owner_team": "NEUTRAL",
+            "last_hacked": 0.0,
+            "lobby_id": None,
+        }
+        for i, (new_lat, new_lon) in enumerate(zip(lats, lons))
+    ]
 
-    db.session.add_all(new_targets)
+    # un solo INSERT multi-riga (Core), senza istanziare un oggetto ORM per target
+    db.session.execute(Target.__table__.insert(), rows)
     err = db_commit_or_error()
     if err:
         return err
 
-    return jsonify({"message": f"{count} target casuali generati con successo"}), 200
+    target_index.invalidate(None)
+
+    return jsonify({"message": f"{len(rows)} target casuali generati con successo", "count": len(rows)}), 200
 
 # ---------------- BOMB GAME ----------------
 
 @app.route("/bomb/difficulty", methods=["GET"])
 def get_bomb_difficulty():
-    user_id = request.args.get("user_id", type=int)
+    user_id, claims, err = request_user(request.args.get("user_id", type=int))
+    if err:
+        return err
     if not user_id:
         return jsonify({"message": "User ID mancante"}), 400
 
@@ -1191,6 +4878,34 @@ def get_bomb_difficulty():
         "sensitivity_per_target": SENSITIVITY_PER_TARGET,
     }), 200
 
+# ---------------- METRICS ----------------
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics_text(), mimetype="text/plain; version=0.0.4")
+
+
+# ---------------- DEBUG: PROFILING ----------------
+
+@app.route("/debug/routes", methods=["GET", "DELETE"])
+def debug_routes():
+    if not PROFILE_REQUESTS:
+        return jsonify({"message": "Profilazione disattivata (PROFILE_REQUESTS=1)"}), 404
+
+    if request.method == "DELETE":
+        route_profiler.reset()
+        return jsonify({"message": "Statistiche azzerate"}), 200
+
+    return jsonify(route_profiler.routes_payload()), 200
+
+
+@app.route("/debug/profiles", methods=["GET"])
+def debug_profiles():
+    if not PROFILE_REQUESTS:
+        return jsonify({"message": "Profilazione disattivata (PROFILE_REQUESTS=1)"}), 404
+
+    return jsonify(route_profiler.slow_payload()), 200
+
 # -------------- LIVE APP -----------------
 
 if __name__ == "__main__":
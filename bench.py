@@ -0,0 +1,358 @@
+"""
+Benchmark di carico per app.py: simula N lobby piene (20 giocatori) con la cadenza reale del client Android.
+
+Per ogni giocatore (vedi MapViewModel.kt):
+    POST /update_position          ogni 3 s  (heartbeat)
+    GET  /lobby/<id>/users         ogni 3 s
+    GET  /targets?user_id=         ogni 5 s
+    GET  /lobby/<id>/status        ogni 5 s
+    GET  /lobbies                  ogni 5 s  (contatori RED/BLUE)
+    POST /hack                     ogni --hack-interval s, sul target raggiunto con l'ultimo heartbeat
+
+Con --sync heartbeat e poll diventano un'unica POST /lobby/<id>/sync ogni 3 s (più gli hack).
+
+L'app gira nello stesso processo (Flask test client, niente server HTTP): si misura il costo di
+route + DB, non la rete. Il DB è quello di --db (default SQLite temporaneo), quindi si può puntare
+a un MySQL locale per avvicinarsi alla produzione.
+
+Report: latenza p50/p95/p99 per route, throughput, query SQL per richiesta, commit al secondo.
+
+Avvio:  python bench.py --lobbies 5 --duration 60
+        python bench.py --db mysql+pymysql://user:pw@127.0.0.1/geowar_bench --workers 64
+        python bench.py --lobbies 5 --duration 60 --sync
+"""
+import argparse
+import heapq
+import itertools
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+PLAYERS_PER_LOBBY = 20
+HEARTBEAT_INTERVAL = 3.0
+USERS_POLL_INTERVAL = 3.0
+TARGETS_POLL_INTERVAL = 5.0
+STATUS_POLL_INTERVAL = 5.0
+LOBBIES_POLL_INTERVAL = 5.0
+SYNC_INTERVAL = 3.0
+HACK_JITTER_M = 0.0001  # ~10 m: il giocatore è "sul" target, entro HACK_MAX_DISTANCE_M
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+class Stats:
+    """Latenze e query per route, raccolte dai thread worker."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)  # route -> [secondi]
+        self.queries = defaultdict(int)  # route -> query SQL totali
+        self.status_codes = defaultdict(lambda: defaultdict(int))  # route -> code -> n
+        self.lags = []  # ritardo di dispatch rispetto alla cadenza prevista
+
+    def record(self, route, elapsed, code, queries, lag):
+        with self.lock:
+            self.latencies[route].append(elapsed)
+            self.queries[route] += queries
+            self.status_codes[route][code] += 1
+            self.lags.append(lag)
+
+
+class SqlCounter:
+    """Conta query (per thread, quindi per richiesta) e commit (globali) dall'engine SQLAlchemy."""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self.local = threading.local()
+        self.commits = 0
+        self.total_queries = 0
+        self.lock = threading.Lock()
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+        event.listen(engine, "commit", self._on_commit)
+
+    def _on_execute(self, *args):
+        self.local.count = getattr(self.local, "count", 0) + 1
+        with self.lock:
+            self.total_queries += 1
+
+    def _on_commit(self, conn):
+        with self.lock:
+            self.commits += 1
+
+    def reset_thread(self):
+        self.local.count = 0
+
+    def thread_count(self):
+        return getattr(self.local, "count", 0)
+
+
+class Player:
+    def __init__(self, user_id, lobby_id):
+        self.user_id = user_id
+        self.lobby_id = lobby_id
+        self.targets = []
+        self.goal = None  # target verso cui si muove
+        self.at_goal = False  # l'ultimo heartbeat era sul target: si può hackare
+        self.versions = {}  # "versions" dell'ultima risposta di /sync
+
+    def pick_goal(self):
+        self.goal = random.choice(self.targets) if self.targets else None
+        self.at_goal = False
+
+
+class Simulation:
+    def __init__(self, m, args):
+        self.m = m
+        self.args = args
+        self.stats = Stats()
+        self.sql = SqlCounter(self._engine())
+        self.local = threading.local()
+        self.players = []
+
+        self.heap = []  # (due, seq, player, action)
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.executor = ThreadPoolExecutor(args.workers, thread_name_prefix="bench")
+
+    def _engine(self):
+        with self.m.app.app_context():
+            return self.m.db.engine
+
+    def client(self):
+        c = getattr(self.local, "client", None)
+        if c is None:
+            c = self.local.client = self.m.app.test_client()
+        return c
+
+    # ---------- SETUP ----------
+    def setup(self):
+        """Utenti inseriti direttamente (l'hash password costa e non è ciò che si misura), join e team via API."""
+        m = self.m
+        n_players = self.args.lobbies * PLAYERS_PER_LOBBY
+        run_tag = f"b{int(time.time())}"
+        password_hash = m.generate_password_hash("benchmark")
+
+        with m.app.app_context():
+            lobby_ids = []
+            for _ in range(self.args.lobbies):
+                lobby = m.Lobby(status="WAITING")
+                m.db.session.add(lobby)
+                m.db.session.flush()
+                lobby_ids.append(lobby.id)
+
+            m.db.session.execute(m.User.__table__.insert(), [
+                {
+                    "username": f"{run_tag}_{i}",
+                    "email": f"{run_tag}_{i}@bench.local",
+                    "password_hash": password_hash,
+                }
+                for i in range(n_players)
+            ])
+            m.db.session.commit()
+
+            user_ids = [
+                u.id for u in m.User.query.filter(m.User.username.like(f"{run_tag}_%")).order_by(m.User.id)
+            ]
+
+        c = self.client()
+        for i, user_id in enumerate(user_ids):
+            lobby_id = lobby_ids[i // PLAYERS_PER_LOBBY]
+            c.post("/lobby/join", json={"user_id": user_id, "lobby_id": lobby_id})
+            self.players.append(Player(user_id, lobby_id))
+
+        # team alternati: la lobby parte al primo BLUE, gli altri entrano a partita in corso
+        for i, player in enumerate(self.players):
+            c.post("/set_team", json={"user_id": player.user_id, "team": "RED" if i % 2 == 0 else "BLUE"})
+
+        for player in self.players:
+            player.targets = c.get(f"/targets?user_id={player.user_id}").get_json() or []
+            player.pick_goal()
+
+    # ---------- AZIONI ----------
+    def position(self, p):
+        if p.goal:
+            return (p.goal["lat"] + random.uniform(-HACK_JITTER_M, HACK_JITTER_M),
+                    p.goal["lon"] + random.uniform(-HACK_JITTER_M, HACK_JITTER_M))
+        return 41.9 + random.random(), 12.5 + random.random()
+
+    def heartbeat(self, p):
+        lat, lon = self.position(p)
+        r = self.client().post("/update_position", json={"user_id": p.user_id, "lat": lat, "lon": lon})
+        p.at_goal = p.goal is not None
+        return r
+
+    def sync(self, p):
+        lat, lon = self.position(p)
+        r = self.client().post(f"/lobby/{p.lobby_id}/sync", json={
+            "user_id": p.user_id, "lat": lat, "lon": lon, "versions": p.versions,
+        })
+        p.at_goal = p.goal is not None
+        if r.status_code == 200:
+            body = r.get_json()
+            p.versions = body["versions"]
+            if "targets" in body:
+                p.targets = body["targets"]
+        return r
+
+    def poll_users(self, p):
+        return self.client().get(f"/lobby/{p.lobby_id}/users")
+
+    def poll_targets(self, p):
+        r = self.client().get(f"/targets?user_id={p.user_id}")
+        if r.status_code == 200:
+            p.targets = r.get_json() or []
+        return r
+
+    def poll_status(self, p):
+        return self.client().get(f"/lobby/{p.lobby_id}/status")
+
+    def poll_lobbies(self, p):
+        return self.client().get("/lobbies")
+
+    def hack(self, p):
+        if not p.at_goal:
+            return None  # non ancora arrivato: il client non mostra il popup di hack
+        r = self.client().post("/hack", json={"user_id": p.user_id, "target_id": p.goal["id"]})
+        p.pick_goal()
+        return r
+
+    def actions(self):
+        if self.args.sync:
+            return [
+                ("POST /lobby/<id>/sync", self.sync, SYNC_INTERVAL),
+                ("POST /hack", self.hack, self.args.hack_interval),
+            ]
+        return [
+            ("POST /update_position", self.heartbeat, HEARTBEAT_INTERVAL),
+            ("GET /lobby/<id>/users", self.poll_users, USERS_POLL_INTERVAL),
+            ("GET /targets", self.poll_targets, TARGETS_POLL_INTERVAL),
+            ("GET /lobby/<id>/status", self.poll_status, STATUS_POLL_INTERVAL),
+            ("GET /lobbies", self.poll_lobbies, LOBBIES_POLL_INTERVAL),
+            ("POST /hack", self.hack, self.args.hack_interval),
+        ]
+
+    # ---------- LOOP ----------
+    def schedule(self, due, player, action):
+        with self.cond:
+            heapq.heappush(self.heap, (due, next(self.seq), player, action))
+            self.cond.notify()
+
+    def run_action(self, due, player, action):
+        route, fn, interval = action
+        lag = max(0.0, time.perf_counter() - due)
+
+        self.sql.reset_thread()
+        start = time.perf_counter()
+        response = fn(player)
+        elapsed = time.perf_counter() - start
+
+        if response is not None:
+            self.stats.record(route, elapsed, response.status_code, self.sql.thread_count(), lag)
+
+        # come il client: attesa fissa dopo la risposta
+        if time.perf_counter() < self.deadline:
+            self.schedule(time.perf_counter() + interval, player, action)
+
+    def run(self):
+        start = time.perf_counter()
+        self.deadline = start + self.args.duration
+
+        # partenze sfalsate: i client non si sincronizzano tra loro
+        for player in self.players:
+            for action in self.actions():
+                self.schedule(start + random.uniform(0, action[2]), player, action)
+
+        while True:
+            with self.cond:
+                while True:
+                    now = time.perf_counter()
+                    if now >= self.deadline:
+                        break
+                    if self.heap and self.heap[0][0] <= now:
+                        due, _, player, action = heapq.heappop(self.heap)
+                        break
+                    timeout = (self.heap[0][0] if self.heap else self.deadline) - now
+                    self.cond.wait(min(timeout, self.deadline - now))
+                if now >= self.deadline:
+                    break
+            self.executor.submit(self.run_action, due, player, action)
+
+        self.executor.shutdown(wait=True)
+        return time.perf_counter() - start
+
+
+def report(sim, elapsed, out):
+    stats = sim.stats
+    total = sum(len(v) for v in stats.latencies.values())
+
+    out.write(f"lobby: {sim.args.lobbies}  giocatori: {len(sim.players)}  durata: {elapsed:.1f} s  "
+              f"worker: {sim.args.workers}  sync: {'sì' if sim.args.sync else 'no'}  db: {sim.args.db}\n\n")
+    out.write(f"{'route':<26}{'req':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+              f"{'max ms':>9}{'q/req':>7}  esiti\n")
+
+    for route in sorted(stats.latencies):
+        values = sorted(stats.latencies[route])
+        n = len(values)
+        codes = " ".join(f"{code}:{count}" for code, count in sorted(stats.status_codes[route].items()))
+        out.write(
+            f"{route:<26}{n:>8}{n / elapsed:>9.1f}"
+            f"{percentile(values, 50) * 1000:>9.2f}{percentile(values, 95) * 1000:>9.2f}"
+            f"{percentile(values, 99) * 1000:>9.2f}{values[-1] * 1000:>9.2f}"
+            f"{stats.queries[route] / n:>7.2f}  {codes}\n"
+        )
+
+    lags = sorted(stats.lags)
+    out.write(f"\ntotale: {total} richieste, {total / elapsed:.1f} req/s\n")
+    out.write(f"query SQL: {sim.sql.total_queries} ({sim.sql.total_queries / elapsed:.1f}/s, flush in background inclusi)\n")
+    out.write(f"commit: {sim.sql.commits} ({sim.sql.commits / elapsed:.1f}/s)\n")
+    out.write(f"ritardo di dispatch p95: {percentile(lags, 95) * 1000:.1f} ms"
+              f"  (alto = worker saturi, aumentare --workers)\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark di carico GeoWar (lobby piene, cadenza client reale)")
+    parser.add_argument("--lobbies", type=int, default=5)
+    parser.add_argument("--duration", type=float, default=60.0, help="secondi di simulazione")
+    parser.add_argument("--workers", type=int, default=32, help="richieste concorrenti massime")
+    parser.add_argument("--hack-interval", type=float, default=10.0, help="secondi tra due hack dello stesso giocatore")
+    parser.add_argument("--sync", action="store_true", help="client con /lobby/<id>/sync al posto dei poll separati")
+    parser.add_argument("--db", default=None, help="URL SQLAlchemy (default: SQLite temporaneo)")
+    parser.add_argument("--output", default=None, help="file di report (es. bench_output.txt)")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    if args.db is None:
+        args.db = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="geowar-bench-"), "bench.db")
+
+    # app.py legge la configurazione all'import
+    os.environ["DATABASE_URL"] = args.db
+    import app as m
+
+    sim = Simulation(m, args)
+    print(f"Setup di {args.lobbies} lobby da {PLAYERS_PER_LOBBY} giocatori...")
+    sim.setup()
+    print(f"Simulazione per {args.duration:.0f} s...")
+    elapsed = sim.run()
+
+    report(sim, elapsed, sys.stdout)
+    if args.output:
+        with open(args.output, "w") as f:
+            report(sim, elapsed, f)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""
+Verifica dei piani di esecuzione delle query calde di app.py su un dataset grande.
+
+Popola un DB (default: SQLite temporaneo) con --users utenti distribuiti in lobby da 20,
+target per le lobby in partita e uno storico di hack, poi esegue EXPLAIN su ogni query
+calda e controlla che le tabelle grandi siano lette tramite un indice e non con una scansione
+completa. Esce con codice 1 se almeno una query non usa un indice.
+
+Avvio:  python explain_check.py                       (1.000.000 utenti, qualche decina di secondi)
+        python explain_check.py --users 100000
+        python explain_check.py --db mysql+pymysql://user:pw@127.0.0.1/geowar_explain --reuse
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+PLAYERS_PER_LOBBY = 20
+ACTIVE_LOBBY_EVERY = 10  # una lobby su 10 è in partita e ha i suoi target
+TARGETS_PER_ACTIVE_LOBBY = 25
+HACKS_PER_TARGET = 4
+INSERT_CHUNK = 20000
+
+
+def chunked_insert(m, table, rows_iter):
+    chunk = []
+    for row in rows_iter:
+        chunk.append(row)
+        if len(chunk) >= INSERT_CHUNK:
+            m.db.session.execute(table.insert(), chunk)
+            chunk = []
+    if chunk:
+        m.db.session.execute(table.insert(), chunk)
+    m.db.session.commit()
+
+
+def seed(m, n_users):
+    n_lobbies = max(1, n_users // PLAYERS_PER_LOBBY)
+    now = time.time()
+    print(f"Seed: {n_users} utenti, {n_lobbies} lobby...")
+
+    chunked_insert(m, m.Lobby.__table__, (
+        {
+            "status": "ACTIVE" if i % ACTIVE_LOBBY_EVERY == 0 else random.choice(("WAITING", "FINISHED")),
+            "created_at": now,
+            "player_count": PLAYERS_PER_LOBBY,
+            "players_red": PLAYERS_PER_LOBBY // 2,
+            "players_blue": PLAYERS_PER_LOBBY // 2,
+            "targets_red": 0,
+            "targets_blue": 0,
+            "is_private": i % 4 == 0,
+        }
+        for i in range(n_lobbies)
+    ))
+    lobby_ids = [lid for (lid,) in m.db.session.query(m.Lobby.id).order_by(m.Lobby.id)]
+    active_ids = lobby_ids[::ACTIVE_LOBBY_EVERY]
+
+    chunked_insert(m, m.User.__table__, (
+        {
+            "username": f"giocatore_{i}",
+            "email": f"giocatore_{i}@explain.local",
+            "password_hash": "x",
+            "team": ("RED", "BLUE")[i % 2],
+            "lobby_id": lobby_ids[(i // PLAYERS_PER_LOBBY) % len(lobby_ids)],
+            "last_active": now,
+        }
+        for i in range(n_users)
+    ))
+
+    chunked_insert(m, m.Target.__table__, (
+        {
+            "name": f"Obiettivo {k} (Lobby {lid})",
+            "lat": 41.9 + random.uniform(-0.05, 0.05),
+            "lon": 12.5 + random.uniform(-0.05, 0.05),
+            "owner_team": random.choice(("NEUTRAL", "RED", "BLUE")),
+            "lobby_id": lid,
+        }
+        for lid in active_ids
+        for k in range(TARGETS_PER_ACTIVE_LOBBY)
+    ))
+
+    targets = m.db.session.query(m.Target.id, m.Target.lobby_id).all()
+    chunked_insert(m, m.HackLog.__table__, (
+        {
+            "user_id": random.randint(1, n_users),
+            "target_id": tid,
+            "lobby_id": lid,
+            "team": random.choice(("RED", "BLUE")),
+            "timestamp": now - random.uniform(0, 3600),
+        }
+        for tid, lid in targets
+        for _ in range(HACKS_PER_TARGET)
+    ))
+
+    # statistiche per il planner (SQLite: senza ANALYZE sceglie gli indici a intuito)
+    if m.db.engine.dialect.name == "sqlite":
+        m.db.session.execute(m.text("ANALYZE"))
+    else:
+        for table in ("user", "lobby", "target", "hack_log"):
+            m.db.session.execute(m.text(f"ANALYZE TABLE `{table}`"))
+    m.db.session.commit()
+
+
+def hot_queries(m):
+    """(nome, route, statement): le stesse query emesse dalle route."""
+    User, Lobby, Target, HackLog = m.User, m.Lobby, m.Target, m.HackLog
+    lobby_id = m.db.session.query(m.func.max(Lobby.id)).filter(Lobby.status == "ACTIVE").scalar()
+    target_id = m.db.session.query(m.func.max(Target.id)).scalar()
+
+    return [
+        ("roster lobby", "GET /lobby/<id>/users",
+         User.query.filter_by(lobby_id=lobby_id, banned=False).statement),
+        ("conteggi team (GROUP BY)", "set_team / leave_lobby (riallineamento)",
+         m.db.session.query(User.lobby_id, User.team, m.func.count(User.id))
+         .filter(User.lobby_id.in_([lobby_id])).group_by(User.lobby_id, User.team).statement),
+        ("target della lobby", "GET /targets",
+         Target.query.filter(Target.lobby_id == lobby_id).statement),
+        ("conteggio target per team", "lobby_recount_targets",
+         Target.query.filter_by(lobby_id=lobby_id, owner_team="RED").with_entities(m.func.count()).statement),
+        ("lobby pubbliche", "GET /lobbies",
+         Lobby.query.filter(Lobby.status.in_(["WAITING", "ACTIVE"]), Lobby.is_private == False).statement),
+        ("storico hack di un target", "hack_log(target_id, timestamp)",
+         HackLog.query.filter_by(target_id=target_id).order_by(HackLog.timestamp.desc()).limit(20).statement),
+        ("aggregati hack di partita", "aggregate_match_hacks",
+         m.db.session.query(HackLog.user_id, HackLog.team, HackLog.target_id, m.func.count(HackLog.id))
+         .filter(HackLog.lobby_id == lobby_id, HackLog.timestamp >= 0)
+         .group_by(HackLog.user_id, HackLog.team, HackLog.target_id).statement),
+        ("username per login", "POST /login",
+         User.query.filter_by(username="giocatore_12345").statement),
+    ]
+
+
+def explain(m, statement):
+    """Righe del piano: [(tabella, usa_indice, dettaglio)]."""
+    engine = m.db.engine
+    sql = str(statement.compile(dialect=engine.dialect, compile_kwargs={"literal_binds": True}))
+    if engine.dialect.paramstyle in ("format", "pyformat"):
+        sql = sql.replace("%", "%%")
+
+    conn = m.db.session.connection()
+    if engine.dialect.name == "sqlite":
+        rows = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + sql).fetchall()
+        plan = []
+        for row in rows:
+            detail = row[-1]
+            words = detail.split()
+            if words[0] in ("SCAN", "SEARCH"):
+                table = words[1]
+                uses_index = words[0] == "SEARCH" or "INDEX" in detail
+                plan.append((table, uses_index, detail))
+        return plan
+
+    result = conn.exec_driver_sql("EXPLAIN " + sql)
+    keys = list(result.keys())
+    plan = []
+    for row in result.fetchall():
+        r = dict(zip(keys, row))
+        uses_index = r.get("type") != "ALL" and r.get("key") is not None
+        plan.append((r.get("table"), uses_index, f"type={r.get('type')} key={r.get('key')} rows={r.get('rows')}"))
+    return plan
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EXPLAIN delle query calde di GeoWar su un dataset grande")
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--db", default=None, help="URL SQLAlchemy (default: SQLite temporaneo)")
+    parser.add_argument("--reuse", action="store_true", help="non popolare se il DB contiene già utenti")
+    args = parser.parse_args()
+
+    if args.db is None:
+        args.db = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="geowar-explain-"), "explain.db")
+
+    # app.py legge la configurazione all'import (e applica le migrazioni)
+    os.environ["DATABASE_URL"] = args.db
+    import app as m
+
+    failures = 0
+    with m.app.app_context():
+        if not (args.reuse and m.User.query.first()):
+            seed(m, args.users)
+
+        for name, route, statement in hot_queries(m):
+            plan = explain(m, statement)
+            ok = all(uses_index for _, uses_index, _ in plan)
+            failures += not ok
+            print(f"[{'OK' if ok else 'FAIL'}] {name}  ({route})")
+            for table, uses_index, detail in plan:
+                print(f"       {table}: {detail}")
+
+    print(f"\n{failures} query senza indice" if failures else "\nTutte le query calde usano un indice")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
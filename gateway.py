@@ -0,0 +1,197 @@
+"""
+Gateway WebSocket (asyncio) per il gioco in tempo reale, affiancato alle route Flask di app.py.
+
+Un'unica connessione per giocatore: il client invia posizioni e tentativi di hack,
+il server gli inoltra gli eventi della lobby (gli stessi dello stream SSE).
+Le connessioni sono coroutine, quindi un processo regge migliaia di client;
+il lavoro su DB gira in un thread pool limitato, dimensionato sul pool di connessioni.
+
+Protocollo (messaggi JSON):
+    -> {"type": "hello", "user_id": 1, "token": "..."}      (token di /login; obbligatorio con AUTH_REQUIRE_TOKEN=1)
+    <- {"type": "welcome", "lobby_id": 3, "snapshot": {...}}
+    -> {"type": "position", "lat": 41.9, "lon": 12.5}
+    -> {"type": "hack", "target_id": 7, "ref": "a1"}
+    <- {"type": "hack_result", "ref": "a1", "code": 200, "message": "Hack registrato"}
+    <- {"type": "event", "id": 12, "event": "target", "data": {...}}
+    -> {"type": "ping"}                     <- {"type": "pong"}
+
+Avvio: python gateway.py --port 5501   (richiede websockets >= 13)
+"""
+import argparse
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from websockets.asyncio.server import broadcast, serve
+from websockets.exceptions import ConnectionClosed
+
+from app import (
+    app, Lobby, User, LobbySubscription,
+    apply_hack, authenticate, record_position, lobby_stream_snapshot,
+    lobby_hub, match_scheduler, roster_tracker, state_backend,
+)
+
+GATEWAY_DB_WORKERS = int(os.getenv("GATEWAY_DB_WORKERS", "8"))  # <= pool_size + max_overflow
+GATEWAY_MAX_MESSAGE = 4096  # byte: i messaggi client sono piccoli
+
+
+def gateway_hello(user_id, token=None):
+    user_id, _, err = authenticate(token, user_id)
+    if err:
+        return err
+
+    user = User.query.get(user_id)
+    if not user or user.banned:
+        return {"message": "Utente non valido"}, 403
+    if not user.lobby_id:
+        return {"message": "Devi essere in una lobby"}, 400
+
+    lobby = Lobby.query.get(user.lobby_id)
+    if not lobby:
+        return {"message": "Lobby non trovata"}, 404
+
+    roster_tracker.track(user.id, user.lobby_id)
+    match_scheduler.schedule_lobby(lobby)  # match_end arriva dallo scheduler
+    return {"user_id": user.id, "lobby_id": lobby.id, "snapshot": lobby_stream_snapshot(lobby)}, 200
+
+
+class LoopSubscription(LobbySubscription):
+    """Iscrizione all'hub che consegna gli eventi a una callback sull'event loop asyncio."""
+
+    def __init__(self, loop, callback):
+        super().__init__(maxsize=1)
+        self._loop = loop
+        self._callback = callback
+
+    def put_nowait(self, message):
+        self._loop.call_soon_threadsafe(self._callback, message)
+
+
+class LobbyChannel:
+    """Socket connessi a una lobby: una sola iscrizione all'hub, ogni evento è serializzato una volta."""
+
+    def __init__(self, loop, lobby_id):
+        self.lobby_id = lobby_id
+        self.clients = set()
+        self.subscription = lobby_hub.subscribe(lobby_id, LoopSubscription(loop, self.deliver))
+
+    def deliver(self, message):
+        event_id, event, data = message
+        payload = json.dumps({"type": "event", "id": event_id, "event": event, "data": data}, separators=(",", ":"))
+        broadcast(self.clients, payload)
+
+    def close(self):
+        lobby_hub.unsubscribe(self.lobby_id, self.subscription)
+
+
+class Gateway:
+    def __init__(self, db_workers=GATEWAY_DB_WORKERS):
+        self.executor = ThreadPoolExecutor(db_workers, thread_name_prefix="gateway-db")
+        self.channels = {}  # lobby_id -> LobbyChannel
+        self.loop = None
+
+    async def run_db(self, fn, *args):
+        """Esegue una funzione che usa il DB nel thread pool, dentro un app context."""
+        def call():
+            with app.app_context():
+                return fn(*args)
+        return await self.loop.run_in_executor(self.executor, call)
+
+    async def handler(self, websocket):
+        user_id = None
+        channel = None
+        try:
+            async for raw in websocket:
+                try:
+                    msg = json.loads(raw)
+                except ValueError:
+                    msg = None
+                if not isinstance(msg, dict):
+                    await self.send(websocket, {"type": "error", "message": "JSON non valido"})
+                    continue
+
+                kind = msg.get("type")
+
+                if kind == "ping":
+                    await self.send(websocket, {"type": "pong"})
+
+                elif kind == "hello":
+                    if user_id is not None:
+                        await self.send(websocket, {"type": "error", "message": "Sessione già avviata"})
+                        continue
+                    body, code = await self.run_db(gateway_hello, msg.get("user_id"), msg.get("token"))
+                    if code != 200:
+                        await self.send(websocket, {"type": "error", "code": code, **body})
+                        continue
+
+                    user_id = body["user_id"]
+                    channel = self.join_channel(body["lobby_id"])
+                    channel.clients.add(websocket)
+                    await self.send(websocket, {"type": "welcome", "lobby_id": body["lobby_id"], "snapshot": body["snapshot"]})
+
+                elif user_id is None:
+                    await self.send(websocket, {"type": "error", "message": "Invia prima hello"})
+
+                elif kind == "position":
+                    try:
+                        lat = float(msg.get("lat", 0))
+                        lon = float(msg.get("lon", 0))
+                    except (ValueError, TypeError):
+                        await self.send(websocket, {"type": "error", "message": "Coordinate non numeriche"})
+                        continue
+
+                    # utente già noto dopo hello e stato in memoria: nessun I/O, si resta sull'event loop;
+                    # con il backend condiviso la scrittura è su socket e va nel thread pool
+                    if roster_tracker.knows(user_id) and not state_backend.shared:
+                        body, code = record_position(user_id, lat, lon)
+                    else:
+                        body, code = await self.run_db(record_position, user_id, lat, lon)
+                    if code != 200:
+                        await self.send(websocket, {"type": "error", "code": code, **body})
+
+                elif kind == "hack":
+                    body, code = await self.run_db(apply_hack, user_id, msg.get("target_id"))
+                    await self.send(websocket, {"type": "hack_result", "ref": msg.get("ref"), "code": code, **body})
+
+                else:
+                    await self.send(websocket, {"type": "error", "message": f"Tipo messaggio sconosciuto: {kind}"})
+        except ConnectionClosed:
+            pass
+        except Exception:
+            # errore inatteso: si chiude solo questa connessione, il client si ricollega
+            app.logger.exception("Errore nel gateway (utente %s)", user_id)
+            await websocket.close(1011, "Errore interno")
+        finally:
+            if channel:
+                channel.clients.discard(websocket)
+                if not channel.clients:
+                    channel.close()
+                    self.channels.pop(channel.lobby_id, None)
+
+    def join_channel(self, lobby_id):
+        channel = self.channels.get(lobby_id)
+        if channel is None:
+            channel = LobbyChannel(self.loop, lobby_id)
+            self.channels[lobby_id] = channel
+        return channel
+
+    async def send(self, websocket, payload):
+        await websocket.send(json.dumps(payload, separators=(",", ":")))
+
+    async def serve(self, host, port):
+        self.loop = asyncio.get_running_loop()
+        state_backend.ensure_listening()  # eventi pubblicati dai worker Flask e dagli altri gateway
+        async with serve(self.handler, host, port, max_size=GATEWAY_MAX_MESSAGE, ping_interval=20):
+            print(f"GeoWar gateway in ascolto su ws://{host}:{port}")
+            await asyncio.Future()  # gira finché il processo non viene fermato
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gateway WebSocket GeoWar")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5501)
+    parser.add_argument("--db-workers", type=int, default=GATEWAY_DB_WORKERS)
+    args = parser.parse_args()
+
+    asyncio.run(Gateway(args.db_workers).serve(args.host, args.port))